@@ -0,0 +1,340 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Benchmarks for the routing searches
+#
+#------------------------------------------------------
+# Usage:
+#   benchmark.py [number of queries] [size]
+#   benchmark.py synthetic [number of queries] [sizes] [compact]
+#   benchmark.py compare [old results] [new results]
+#
+# The first compares how many nodes the forward (A*) and bidirectional
+# (Dijkstra) searches expand on long routes across a grid and a random
+# geometric graph of size nodes (10000 by default), made up as for
+# "synthetic" below.
+#
+# "synthetic" generates grid and random geometric graphs of each
+# size (a comma-separated list of node counts), writes them out as an
+# OSM file and a routing.csv risk file, and measures loading them
+# (LoadOsm.loadOsm and readInRisk), the process's peak RSS, and a
+# fixed, seeded workload of queries: the time taken to snap both ends
+# (findNode), to search (as Router.doRoute does) and in all, and the
+# nodes expanded, as percentiles.  Each graph is benchmarked in a
+# fresh process, so its peak RSS is its own.  The results are printed
+# as JSON, and "compare" shows how two such files differ.
+#------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+try:
+  import resource
+except ImportError:  # Not on Windows
+  resource = None
+from route import Router
+from loadOsm import LoadOsm
+import nodeGrid
+
+# Layout of the results, bumped if it changes
+RESULTS_VERSION = 1
+# Where the synthetic graphs are put (about the size of lower Manhattan
+# for the default sizes)
+ORIGIN = (40.70, -74.02)
+SPACING = 0.0005
+PERCENTILES = (50, 95, 99)
+SEARCH_MODES = ('forward', 'bidirectional')
+
+def longQueries(router, count, seed=1):
+  """Random pairs of nodes from the furthest-apart quarter of a sample"""
+  graph = router.graph
+  rnd = random.Random(seed)
+  nodes = graph.nodeIds()
+  pairs = []
+  for i in range(count * 4):
+    a = rnd.choice(nodes)
+    b = rnd.choice(nodes)
+    pairs.append((router.distance(graph.nodeIndex(a), graph.nodeIndex(b)), a, b))
+  pairs.sort(reverse=True)
+  return([(a, b) for (dist, a, b) in pairs[:count]])
+
+def compareSearches(router, queries):
+  """Run each query forwards and bidirectionally, and total the nodes
+  expanded and time taken by each"""
+  totals = {}
+  for name in SEARCH_MODES:
+    expanded = 0
+    start = time.time()
+    for (a, b) in queries:
+      expanded = expanded + router.search(a, b, mode=name).expanded
+    totals[name] = (expanded, time.time() - start)
+  return(totals)
+
+def syntheticRouter(kind, size, seed=1):
+  """A Router over a synthetic graph of one of the GRAPHS, loaded from
+  the OSM and risk files it would be written out as"""
+  nodes, ways = GRAPHS[kind](size, seed)
+  directory = tempfile.mkdtemp(prefix='pyroute-bench-')
+  try:
+    osmFile = os.path.join(directory, 'graph.osm')
+    riskFile = os.path.join(directory, 'graph.csv')
+    writeOsm(osmFile, nodes, ways)
+    writeRisk(riskFile, ways, seed)
+    return(Router(osmFile=osmFile, riskFile=riskFile))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+def gridGraph(size, seed=1):
+  """Nodes ({id: (lat, lon)}) and two-node ways of a square street grid of
+  about size nodes, slightly jittered and with a tenth of the blocks'
+  sides missing"""
+  rnd = random.Random(seed)
+  side = max(2, int(round(math.sqrt(size))))
+  nodes = {}
+  for i in range(side):
+    for j in range(side):
+      nodes[1 + i * side + j] = (ORIGIN[0] + SPACING * (i + rnd.uniform(-0.2, 0.2)),
+                                 ORIGIN[1] + SPACING * (j + rnd.uniform(-0.2, 0.2)))
+  ways = []
+  for i in range(side):
+    for j in range(side):
+      node = 1 + i * side + j
+      if j + 1 < side and rnd.random() < 0.9:
+        ways.append([node, node + 1])
+      if i + 1 < side and rnd.random() < 0.9:
+        ways.append([node, node + side])
+  return(nodes, ways)
+
+def geometricGraph(size, seed=1, degree=3):
+  """Nodes and two-node ways of a random geometric graph: size nodes
+  scattered over the same area as a grid of that size, each linked to its
+  degree nearest neighbours"""
+  rnd = random.Random(seed)
+  extent = SPACING * math.sqrt(size)
+  index = nodeGrid.NodeGrid(SPACING * 2)
+  nodes = {}
+  for node in range(1, size + 1):
+    nodes[node] = (ORIGIN[0] + rnd.uniform(0, extent), ORIGIN[1] + rnd.uniform(0, extent))
+    index.add(node, nodes[node][0], nodes[node][1])
+  links = set()
+  for node, (lat, lon) in nodes.items():
+    for other in index.nearest(lat, lon, degree + 1):
+      if other != node:
+        links.add((min(node, other), max(node, other)))
+  return(nodes, [list(link) for link in sorted(links)])
+
+GRAPHS = {'grid': gridGraph, 'geometric': geometricGraph}
+
+def writeOsm(filename, nodes, ways):
+  """Write the nodes and ways out as an OSM XML file of residential roads"""
+  with open(filename, 'w') as f:
+    f.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+    for node in sorted(nodes):
+      f.write(' <node id="%d" lat="%.7f" lon="%.7f"/>\n' % (node, nodes[node][0], nodes[node][1]))
+    for way, nds in enumerate(ways):
+      f.write(' <way id="%d">' % (way + 1))
+      for node in nds:
+        f.write('<nd ref="%d"/>' % node)
+      f.write('<tag k="highway" v="residential"/></way>\n')
+    f.write('</osm>\n')
+
+def writeRisk(filename, ways, seed=1):
+  """Write random risks for both directions of every link, in the
+  routing.csv format"""
+  rnd = random.Random(seed)
+  with open(filename, 'w') as f:
+    for nds in ways:
+      for a, b in zip(nds, nds[1:]):
+        f.write('%d,%d,%.9f,%.9f\n' % (a, b, rnd.gauss(0, 1), rnd.gauss(0, 1)))
+        f.write('%d,%d,%.9f,%.9f\n' % (b, a, rnd.gauss(0, 1), rnd.gauss(0, 1)))
+
+def workload(nodes, count, seed=1):
+  """count (lat1, lon1, lat2, lon2) queries between random points near
+  the nodes, as a client would send them"""
+  rnd = random.Random(seed)
+  ids = sorted(nodes)
+  queries = []
+  for i in range(count):
+    ends = []
+    for node in (rnd.choice(ids), rnd.choice(ids)):
+      ends.extend((nodes[node][0] + rnd.uniform(-0.3, 0.3) * SPACING,
+                   nodes[node][1] + rnd.uniform(-0.3, 0.3) * SPACING))
+    queries.append(tuple(ends))
+  return(queries)
+
+def percentiles(values):
+  """Nearest-rank percentiles of a list of numbers, and their mean"""
+  if not values:
+    return(None)
+  values = sorted(values)
+  summary = {'mean': sum(values) / float(len(values)), 'max': values[-1]}
+  for p in PERCENTILES:
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    summary['p%d' % p] = values[rank - 1]
+  return(summary)
+
+def peakRss():
+  """Peak resident set size of this process so far, in kilobytes"""
+  if resource is None:
+    return(None)
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    # Bytes there, kilobytes on Linux
+    peak = peak // 1024
+  return(peak)
+
+def runCase(case):
+  """Load one synthetic graph and run the workload over it"""
+  osmFile, riskFile, queries, modes, compact = case
+  result = {'rssBeforeKb': peakRss()}
+  start = time.time()
+  data = LoadOsm("foot")
+  data.loadOsm(osmFile)
+  loaded = time.time()
+  data.readInRisk(riskFile)
+  riskLoaded = time.time()
+  router = Router(data=data, compact=compact)
+  built = time.time()
+  result['load'] = {'osmSeconds': loaded - start, 'riskSeconds': riskLoaded - loaded,
+                    'routerSeconds': built - riskLoaded}
+  result['nodes'] = len(data.rnodes)
+  result['edges'] = sum(len(links) for links in data.routing.values())
+  graph = router.graph
+  result['modes'] = {}
+  for mode in modes:
+    snaps, searches, totals, expanded = [], [], [], []
+    outcomes = {}
+    # The searches print as they go; that is not what is being measured
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+      for (lat1, lon1, lat2, lon2) in queries:
+        t0 = time.time()
+        node1 = graph.findNode(lat1, lon1)
+        node2 = graph.findNode(lat2, lon2)
+        t1 = time.time()
+        search = router.search(node1, node2, mode=mode)
+        if search.result == 'success':
+          [graph.position(graph.nodeIndex(node)) for node in search.route]
+        t2 = time.time()
+        snaps.append(1000 * (t1 - t0))
+        searches.append(1000 * (t2 - t1))
+        totals.append(1000 * (t2 - t0))
+        expanded.append(search.expanded)
+        outcomes[search.result] = outcomes.get(search.result, 0) + 1
+    result['modes'][mode] = {
+      'latencyMs': {'findNode': percentiles(snaps), 'search': percentiles(searches),
+                    'total': percentiles(totals)},
+      'expanded': percentiles(expanded),
+      'results': outcomes}
+  result['peakRssKb'] = peakRss()
+  return(result)
+
+def synthetic(sizes=(1000, 10000, 50000), queries=200, seed=1, modes=SEARCH_MODES,
+              compact=False, kinds=('grid', 'geometric')):
+  """Benchmark each kind of synthetic graph at each size, returning the
+  results as a dict ready for JSON"""
+  results = {'version': RESULTS_VERSION, 'seed': seed, 'queries': queries,
+             'compact': compact, 'python': platform.python_version(),
+             'machine': platform.machine(), 'cases': []}
+  directory = tempfile.mkdtemp(prefix='pyroute-bench-')
+  # A fresh process for each graph, so the RSS figures aren't shared
+  context = multiprocessing.get_context('spawn')
+  try:
+    for kind in kinds:
+      for size in sizes:
+        nodes, ways = GRAPHS[kind](size, seed)
+        osmFile = os.path.join(directory, '%s-%d.osm' % (kind, size))
+        riskFile = os.path.join(directory, '%s-%d.csv' % (kind, size))
+        writeOsm(osmFile, nodes, ways)
+        writeRisk(riskFile, ways, seed)
+        case = (osmFile, riskFile, workload(nodes, queries, seed), modes, compact)
+        with context.Pool(1) as pool:
+          result = pool.apply(runCase, (case,))
+        result['graph'] = kind
+        result['size'] = size
+        results['cases'].append(result)
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  return(results)
+
+def compare(old, new):
+  """Lines showing how each measurement of each case in new differs from
+  the same one in old"""
+  lines = []
+  before = dict(((case['graph'], case['size']), case) for case in old['cases'])
+  for case in new['cases']:
+    was = before.get((case['graph'], case['size']))
+    if was is None:
+      continue
+    name = '%s %d' % (case['graph'], case['size'])
+    figures = [('load', sum(was['load'].values()), sum(case['load'].values())),
+               ('peak rss', was['peakRssKb'], case['peakRssKb'])]
+    for mode, stats in sorted(case['modes'].items()):
+      wasStats = was['modes'].get(mode)
+      if wasStats is None:
+        continue
+      for p in PERCENTILES:
+        key = 'p%d' % p
+        figures.append(('%s total %s' % (mode, key), wasStats['latencyMs']['total'][key],
+                        stats['latencyMs']['total'][key]))
+      figures.append(('%s expanded p50' % mode, wasStats['expanded']['p50'], stats['expanded']['p50']))
+    for label, a, b in figures:
+      if a and b is not None:
+        lines.append('%-20s %-28s %12.3f %12.3f %+7.1f%%' % (name, label, a, b, 100.0 * (b - a) / a))
+  return(lines)
+
+if __name__ == "__main__":
+  if sys.argv[1:2] == ['synthetic']:
+    args = sys.argv[2:]
+    queries = int(args[0]) if len(args) > 0 else 200
+    sizes = [int(size) for size in args[1].split(',')] if len(args) > 1 else (1000, 10000, 50000)
+    compact = len(args) > 2 and args[2] == 'compact'
+    json.dump(synthetic(sizes, queries, compact=compact), sys.stdout, indent=1, sort_keys=True)
+    print("")
+    sys.exit()
+  if sys.argv[1:2] == ['compare']:
+    try:
+      with open(sys.argv[2]) as f:
+        old = json.load(f)
+      with open(sys.argv[3]) as f:
+        new = json.load(f)
+    except IndexError:
+      sys.stderr.write("Usage: benchmark.py compare old.json new.json\n")
+      sys.exit(1)
+    for line in compare(old, new):
+      print(line)
+    sys.exit()
+  try:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+  except ValueError:
+    sys.stderr.write("Usage: benchmark.py [number of queries] [size]\n")
+    sys.exit(1)
+  for kind in sorted(GRAPHS):
+    router = syntheticRouter(kind, size)
+    # The searches print as they go
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+      totals = compareSearches(router, longQueries(router, count))
+    print("%s graph of %d nodes, %d queries:" % (kind, len(router.graph.nodeIds()), count))
+    for name, (expanded, seconds) in sorted(totals.items()):
+      print("  %-14s %10d nodes expanded %8.3fs" % (name, expanded, seconds))
+    print("  bidirectional expands %.1f%% of the forward search's nodes" % ( \
+      100.0 * totals['bidirectional'][0] / max(totals['forward'][0], 1)))
@@ -0,0 +1,516 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Compact, array-backed routing graph
+#
+# The same graph as LoadOsm.routing/rnodes, but with nodes renumbered densely
+# (0..n-1) and every attribute held in a flat typed array:
+#
+#   ids[i]                      OSM id of node i
+#   lat[i], lon[i]              position of node i
+#   offsets[i]..offsets[i+1]    range of edge numbers leaving node i
+#   targets[e]                  node at the far end of edge e
+#   risk0[e], risk1[e]          the two risk columns of edge e
+#
+# Edge costs are alpha*exp(risk0)+beta*exp(risk1).  costArray works out the
+# exp() columns once, and the cost of every edge for a given (alpha, beta),
+# kept in a small LRU of cost arrays, so a search just reads costs[e].  A
+# search with weights that have no array yet gets an EdgeCosts instead,
+# which works out each cost as it is read: building a whole array would
+# cost the query O(edges) before it had looked at a single node.
+#
+# It offers the same search interface as LoadOsm (nodeIndex, nodeId,
+# position, weighting, neighbours, findNode), so Router can search either.
+#
+# It can be built from a LoadOsm datastore, or straight from the columns of a
+# risk file (fromRiskFile), which skips building LoadOsm's dicts altogether.
+#
+# A compact graph can be saved as a binary snapshot and opened again with
+# mmap, so a new process does not need to parse the OSM and risk files:
+#   compactGraph.py [osm file] [risk file] [snapshot file]
+# A snapshot only ever opens as a CompactGraph: LoadOsm keeps its graph in
+# dicts, which can't be mapped, so use Router(snapshot=...) or loadSnapshot.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import os
+import sys
+import math
+import mmap
+import json
+import zlib
+import struct
+import bisect
+import itertools
+from array import array
+try:
+  import numpy
+except ImportError:
+  numpy = None
+import nodeGrid
+import lruCache
+import riskCsv
+
+SNAPSHOT_MAGIC = b'PYROUTE\0'
+SNAPSHOT_VERSION = 1
+# magic, version, metadata length, node count, edge count, payload crc32
+SNAPSHOT_HEADER = struct.Struct('<8sIIQQI4x')
+
+class CompactGraph:
+  """Routing graph in CSR (compressed sparse row) form"""
+  def __init__(self, ids, lat, lon, offsets, targets, risk0, risk1):
+    self.ids = ids
+    self.lat = lat
+    self.lon = lon
+    self.offsets = offsets
+    self.targets = targets
+    self.risk0 = risk0
+    self.risk1 = risk1
+    self.grid = None
+    self.mmap = None
+    self.expRisk = None
+    self.costs = lruCache.LRUCache(8)
+    self.reverseOffsets = None
+
+  @classmethod
+  def fromLoadOsm(cls, data):
+    """Build a compact graph from a loaded LoadOsm datastore.
+
+    Only nodes with a known position are kept, along with the edges between
+    them; a search could never reach any of the others anyway."""
+    order = sorted(data.rnodes.keys())
+    ids = array('q', order)
+    lat = array('d', [data.rnodes[node_id][0] for node_id in order])
+    lon = array('d', [data.rnodes[node_id][1] for node_id in order])
+    return(cls.fromRouting(ids, lat, lon, data.routing))
+
+  @classmethod
+  def fromRouting(cls, ids, lat, lon, routing):
+    """Build a compact graph over the given nodes (sorted by id) from a
+    LoadOsm-style {parent: {child: [risk0, risk1]}} dict"""
+    index = dict((node_id, i) for (i, node_id) in enumerate(ids))
+    offsets = array('q', [0])
+    targets = array('q')
+    risk0 = array('d')
+    risk1 = array('d')
+    for node_id in ids:
+      for child, weight in routing.get(node_id, {}).items():
+        if weight == 0 or not child in index:
+          continue
+        targets.append(index[child])
+        risk0.append(weight[0])
+        risk1.append(weight[1])
+      offsets.append(len(targets))
+    return(cls(ids, lat, lon, offsets, targets, risk0, risk1))
+
+  @classmethod
+  def fromRiskFile(cls, filename, rnodes=None):
+    """Build a compact graph straight from a risk file, without going
+    through LoadOsm's dicts.
+
+    Node positions come from rnodes (LoadOsm.rnodes) if it is given, and
+    otherwise from the lat/lon columns of the file."""
+    columns = riskCsv.readColumns(filename, positions=rnodes is None)
+    if rnodes is None:
+      rnodes = columns.nodePositions()
+      if rnodes is None:
+        raise ValueError("%s has no lat/lon columns" % filename)
+    order = sorted(rnodes.keys())
+    ids = array('q', order)
+    lat = array('d', [rnodes[node_id][0] for node_id in order])
+    lon = array('d', [rnodes[node_id][1] for node_id in order])
+    return(cls.fromColumns(ids, lat, lon, columns))
+
+  @classmethod
+  def fromColumns(cls, ids, lat, lon, columns):
+    """Build a compact graph over the given nodes (sorted by id) from a
+    riskCsv.RiskColumns.
+
+    Gives the same graph as fromRouting on the dict LoadOsm.readInRisk
+    would make of the same file: edges to or from nodes that aren't in ids
+    are left out, each node's edges keep the order they first appear in,
+    and where an edge appears more than once the last risks win."""
+    if numpy is not None:
+      edges = cls.groupEdgesNumpy(ids, columns)
+    else:
+      edges = cls.groupEdges(ids, columns)
+    return(cls(ids, lat, lon, *edges))
+
+  @staticmethod
+  def groupEdges(ids, columns):
+    """(offsets, targets, risk0, risk1) of the CSR, from the columns"""
+    n = len(ids)
+    index = dict(zip(ids, range(n)))
+    sources = list(map(index.get, columns.parents))
+    targets = list(map(index.get, columns.children))
+    risk0 = columns.risk0
+    risk1 = columns.risk1
+    if None in sources or None in targets:
+      keep = [e for e in range(len(sources)) if sources[e] is not None and targets[e] is not None]
+      sources = [sources[e] for e in keep]
+      targets = [targets[e] for e in keep]
+      risk0 = array('d', map(risk0.__getitem__, keep))
+      risk1 = array('d', map(risk1.__getitem__, keep))
+    if len(set(zip(sources, targets))) != len(sources):
+      keys = list(zip(sources, targets))
+      # Repeated edges: keep the first one's place and the last one's risks
+      latest = dict(zip(keys, range(len(keys))))
+      first = {}
+      keep = [e for e in range(len(keys)) if first.setdefault(keys[e], e) == e]
+      risk0 = array('d', [risk0[latest[keys[e]]] for e in keep])
+      risk1 = array('d', [risk1[latest[keys[e]]] for e in keep])
+      sources = [sources[e] for e in keep]
+      targets = [targets[e] for e in keep]
+
+    # Group the edges by source node; sorted() is stable, so each node's
+    # edges stay in file order
+    order = sorted(range(len(sources)), key=sources.__getitem__)
+    sortedSources = array('q', map(sources.__getitem__, order))
+    offsets = array('q', map(bisect.bisect_left, itertools.repeat(sortedSources, n + 1), range(n + 1)))
+    return(offsets,
+           array('q', map(targets.__getitem__, order)),
+           array('d', map(risk0.__getitem__, order)),
+           array('d', map(risk1.__getitem__, order)))
+
+  @staticmethod
+  def groupEdgesNumpy(ids, columns):
+    """groupEdges, vectorized with NumPy"""
+    n = len(ids)
+    nodes = numpy.frombuffer(ids, dtype=numpy.int64)
+    def lookup(column):
+      found = numpy.frombuffer(column, dtype=numpy.int64)
+      if n == 0:
+        return(numpy.zeros(len(found), dtype=numpy.int64), numpy.zeros(len(found), dtype=bool))
+      # Searching for the ids in order is several times quicker
+      order = numpy.argsort(found)
+      i = numpy.empty_like(order)
+      i[order] = numpy.searchsorted(nodes, found[order])
+      i = numpy.minimum(i, n - 1)
+      return(i, nodes[i] == found)
+    sources, knownSources = lookup(columns.parents)
+    targets, knownTargets = lookup(columns.children)
+    keep = numpy.flatnonzero(knownSources & knownTargets)
+    sources = sources[keep]
+    targets = targets[keep]
+    risk0 = numpy.frombuffer(columns.risk0, dtype=numpy.float64)[keep]
+    risk1 = numpy.frombuffer(columns.risk1, dtype=numpy.float64)[keep]
+    keys = sources * n + targets
+    unique, first = numpy.unique(keys, return_index=True)
+    if len(unique) != len(keys):
+      # Repeated edges: keep the first one's place and the last one's risks
+      last = len(keys) - 1 - numpy.unique(keys[::-1], return_index=True)[1]
+      first.sort()
+      latest = last[numpy.searchsorted(unique, keys[first])]
+      sources = sources[first]
+      targets = targets[first]
+      risk0 = risk0[latest]
+      risk1 = risk1[latest]
+    order = numpy.argsort(sources, kind='stable')
+    sources = sources[order]
+    offsets = numpy.searchsorted(sources, numpy.arange(n + 1))
+    def toArray(code, values):
+      a = array(code)
+      a.frombytes(values.astype(numpy.int64 if code == 'q' else numpy.float64).tobytes())
+      return(a)
+    return(toArray('q', offsets), toArray('q', targets[order]),
+           toArray('d', risk0[order]), toArray('d', risk1[order]))
+
+  def withRisk(self, routing):
+    """A graph over the same nodes with the edges and risks in routing.
+
+    The node arrays and spatial index are shared with this graph, which is
+    left as it was."""
+    return(self.sharingNodes(self.fromRouting(self.ids, self.lat, self.lon, routing)))
+
+  def withRiskColumns(self, columns):
+    """withRisk, from a riskCsv.RiskColumns"""
+    return(self.sharingNodes(self.fromColumns(self.ids, self.lat, self.lon, columns)))
+
+  def sharingNodes(self, graph):
+    graph.grid = self.grid
+    # The node arrays may be views of this graph's snapshot
+    graph.mmap = self.mmap
+    return(graph)
+
+  def routing(self):
+    """The edges as a LoadOsm-style {parent: {child: [risk0, risk1]}} dict"""
+    routing = {}
+    ids = self.ids
+    for i in range(len(ids)):
+      a = self.offsets[i]
+      b = self.offsets[i + 1]
+      if a == b:
+        continue
+      routing[ids[i]] = dict((ids[j], [r0, r1]) for (j, r0, r1) in
+        zip(self.targets[a:b], self.risk0[a:b], self.risk1[a:b]))
+    return(routing)
+
+  def sameEdges(self, other):
+    """Do both graphs have the same nodes and edges (if not the same risks)?"""
+    return(len(self.ids) == len(other.ids) and len(self.targets) == len(other.targets)
+           and memoryview(self.ids) == memoryview(other.ids)
+           and memoryview(self.offsets) == memoryview(other.offsets)
+           and memoryview(self.targets) == memoryview(other.targets))
+
+  def __len__(self):
+    return(len(self.ids))
+
+  def edgeCount(self):
+    return(len(self.targets))
+
+  def nodeIndex(self, node_id):
+    """Dense index of an OSM node (raises KeyError if unknown)"""
+    i = bisect.bisect_left(self.ids, node_id)
+    if i == len(self.ids) or self.ids[i] != node_id:
+      raise KeyError(node_id)
+    return(i)
+
+  def nodeId(self, i):
+    """OSM id of a dense node index"""
+    return(self.ids[i])
+
+  def position(self, i):
+    return(self.lat[i], self.lon[i])
+
+  def nodeIds(self):
+    return(list(self.ids))
+
+  def weighting(self, alpha, beta):
+    """Costs of the edges for this alpha and beta, for a search: the cost
+    array if it has been built, or else an EdgeCosts"""
+    costs = self.costs.get((float(alpha), float(beta)))
+    if costs is None:
+      return(EdgeCosts(self, alpha, beta))
+    return(costs)
+
+  def costArray(self, alpha, beta):
+    """Array of the cost of every edge for this alpha and beta, worked out
+    with NumPy if it is available"""
+    key = (float(alpha), float(beta))
+    costs = self.costs.get(key)
+    if costs is None:
+      if self.expRisk is None:
+        self.expRisk = (array('d', map(math.exp, self.risk0)),
+                        array('d', map(math.exp, self.risk1)))
+      exp0, exp1 = self.expRisk
+      if numpy is not None and len(exp0):
+        values = key[0] * numpy.frombuffer(exp0, dtype=numpy.float64) + \
+                 key[1] * numpy.frombuffer(exp1, dtype=numpy.float64)
+        costs = array('d')
+        costs.frombytes(values.tobytes())
+      else:
+        costs = array('d', [alpha * a + beta * b for (a, b) in zip(exp0, exp1)])
+      self.costs.put(key, costs)
+    return(costs)
+
+  def neighbours(self, i, costs):
+    """(node, cost) for each edge leaving node i"""
+    a = self.offsets[i]
+    b = self.offsets[i + 1]
+    return(zip(self.targets[a:b], costs[a:b]))
+
+  def buildReverse(self):
+    """Index the edges by the node they lead to (a CSR of incoming edges)"""
+    n = len(self.ids)
+    counts = [0] * (n + 1)
+    for j in self.targets:
+      counts[j + 1] = counts[j + 1] + 1
+    for j in range(n):
+      counts[j + 1] = counts[j + 1] + counts[j]
+    fill = counts[:-1]
+    sources = array('q', [0]) * len(self.targets)
+    edges = array('q', [0]) * len(self.targets)
+    for i in range(n):
+      for e in range(self.offsets[i], self.offsets[i + 1]):
+        j = self.targets[e]
+        sources[fill[j]] = i
+        edges[fill[j]] = e
+        fill[j] = fill[j] + 1
+    self.reverseSources = sources
+    self.reverseEdges = edges
+    self.reverseOffsets = array('q', counts)
+
+  def reverseNeighbours(self, i, costs):
+    """(node, cost) for each edge leading into node i"""
+    if self.reverseOffsets is None:
+      self.buildReverse()
+    a = self.reverseOffsets[i]
+    b = self.reverseOffsets[i + 1]
+    return(zip(self.reverseSources[a:b], [costs[e] for e in self.reverseEdges[a:b]]))
+
+  def nodeGrid(self):
+    """Spatial index of the nodes, built on first use"""
+    if self.grid is None:
+      grid = nodeGrid.NodeGrid()
+      for i in range(len(self.ids)):
+        grid.add(i, self.lat[i], self.lon[i])
+      self.grid = grid
+    return(self.grid)
+
+  def findNode(self, lat, lon):
+    """OSM id of the node nearest to lat/lon"""
+    found = self.nodeGrid().nearest(lat, lon, 1)
+    if not found:
+      return(None)
+    return(self.ids[found[0]])
+
+  def findNodes(self, points):
+    """findNode for each (lat, lon) in a list, in one pass over the index"""
+    return([None if i is None else self.ids[i] for i in self.nodeGrid().nearestEach(points)])
+
+  def arrays(self):
+    return([self.ids, self.lat, self.lon, self.offsets, self.targets, self.risk0, self.risk1])
+
+  def saveSnapshot(self, filename, sources=(), **meta):
+    """Write the graph to a binary snapshot file.
+
+    sources are the files the graph was built from; their size and mtime are
+    recorded so that a snapshot can tell when it has gone stale."""
+    meta['byteorder'] = sys.byteorder
+    meta['sources'] = sourceFingerprint(sources)
+    metaBytes = json.dumps(meta, sort_keys=True).encode('utf-8')
+    metaBytes = metaBytes + b' ' * (-len(metaBytes) % 8)
+    crc = 0
+    for a in self.arrays():
+      crc = zlib.crc32(memoryview(a).cast('B'), crc)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+      f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+        len(metaBytes), len(self.ids), len(self.targets), crc & 0xffffffff))
+      f.write(metaBytes)
+      for a in self.arrays():
+        f.write(memoryview(a).cast('B'))
+    os.rename(tmpname, filename)
+
+  @classmethod
+  def openSnapshot(cls, filename, sources=None, verify=False):
+    """Map a snapshot file into memory without copying it.
+
+    Returns None if the file is missing, damaged, was written by another
+    version or for another byte order, if any of the given source files
+    changed since it was written, or (with verify=True) if its checksum is
+    wrong."""
+    try:
+      f = open(filename, 'rb')
+    except (IOError, OSError):
+      return(None)
+    with f:
+      try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+        return(None)
+    if len(mm) < SNAPSHOT_HEADER.size:
+      return(None)
+    magic, version, metaLength, n, e, crc = SNAPSHOT_HEADER.unpack_from(mm, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+      return(None)
+    offset = SNAPSHOT_HEADER.size
+    try:
+      meta = json.loads(mm[offset:offset + metaLength].decode('utf-8'))
+    except ValueError:
+      # Damaged metadata (bad UTF-8 or JSON)
+      return(None)
+    if not isinstance(meta, dict) or meta.get('byteorder') != sys.byteorder:
+      return(None)
+    if sources is not None and meta.get('sources') != sourceFingerprint(sources):
+      return(None)
+    offset = offset + metaLength
+    layout = (('q', n), ('d', n), ('d', n), ('q', n + 1), ('q', e), ('d', e), ('d', e))
+    if len(mm) != offset + 8 * sum(count for (code, count) in layout):
+      return(None)
+    view = memoryview(mm)
+    arrays = []
+    for code, count in layout:
+      arrays.append(view[offset:offset + 8 * count].cast(code))
+      offset = offset + 8 * count
+    if verify:
+      check = 0
+      for a in arrays:
+        check = zlib.crc32(a.cast('B'), check)
+      if check & 0xffffffff != crc:
+        return(None)
+    graph = cls(*arrays)
+    graph.mmap = mm
+    graph.meta = meta
+    return(graph)
+
+class EdgeCosts:
+  """A graph's edge costs for one alpha and beta, worked out as they are
+  read, in place of a cost array"""
+  def __init__(self, graph, alpha, beta):
+    self.alpha = float(alpha)
+    self.beta = float(beta)
+    if graph.expRisk is not None:
+      self.exp0, self.exp1 = graph.expRisk
+      self.exp = None
+    else:
+      self.exp0 = graph.risk0
+      self.exp1 = graph.risk1
+      self.exp = math.exp
+
+  def __len__(self):
+    return(len(self.exp0))
+
+  def __getitem__(self, e):
+    alpha = self.alpha
+    beta = self.beta
+    exp = self.exp
+    if isinstance(e, slice):
+      if exp is None:
+        return([alpha * a + beta * b for (a, b) in zip(self.exp0[e], self.exp1[e])])
+      return([alpha * exp(a) + beta * exp(b) for (a, b) in zip(self.exp0[e], self.exp1[e])])
+    if exp is None:
+      return(alpha * self.exp0[e] + beta * self.exp1[e])
+    return(alpha * exp(self.exp0[e]) + beta * exp(self.exp1[e]))
+
+def sourceFingerprint(sources):
+  """Size and modification time of each source file (None if missing)"""
+  fingerprint = []
+  for name in sources:
+    try:
+      st = os.stat(name)
+      fingerprint.append([name, st.st_size, st.st_mtime])
+    except OSError:
+      fingerprint.append([name, None, None])
+  return(fingerprint)
+
+def loadSnapshot(snapshot, osmFile, riskFile, transport, verify=False):
+  """Open a snapshot of the graph for osmFile and riskFile, rebuilding it
+  first if it is missing, stale or damaged.
+
+  Opening an existing file only checks its header, size and the sizes and
+  mtimes of the source files, so that startup doesn't read the whole file.
+  With verify=True the checksum is checked as well (which pages all of it
+  in); it is never checked after writing a new file."""
+  sources = [osmFile, riskFile]
+  graph = CompactGraph.openSnapshot(snapshot, sources, verify)
+  if graph is None or graph.meta.get('transport') != transport:
+    buildSnapshot(snapshot, osmFile, riskFile, transport)
+    graph = CompactGraph.openSnapshot(snapshot, sources)
+  return(graph)
+
+def buildSnapshot(snapshot, osmFile, riskFile, transport):
+  """Load the OSM and risk data and save them as a snapshot"""
+  from loadOsm import LoadOsm
+  data = LoadOsm(transport)
+  data.loadOsm(osmFile)
+  graph = CompactGraph.fromRiskFile(riskFile, data.rnodes)
+  graph.saveSnapshot(snapshot, [osmFile, riskFile], transport=transport)
+  return(graph)
+
+if __name__ == "__main__":
+  try:
+    graph = buildSnapshot(sys.argv[3], sys.argv[1], sys.argv[2], "foot")
+    print("Wrote %d nodes and %d edges to %s" % (len(graph), graph.edgeCount(), sys.argv[3]))
+  except IndexError:
+    sys.stderr.write("Usage: compactGraph.py osmfile riskfile snapshotfile\n")
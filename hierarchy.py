@@ -0,0 +1,294 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Customizable contraction hierarchy (CCH) over a CompactGraph
+#
+# Routing runs in three stages:
+#
+#  * Preprocessing depends only on the shape of the graph.  Nodes are given
+#    a contraction order (greedy minimum degree), and contracting them in
+#    that order gives a chordal supergraph whose arcs always point from a
+#    lower-ranked node to a higher-ranked one.  Every "lower triangle"
+#    (x, u, w) with x below u and w is listed, ready for customization.
+#
+#  * Customization takes an (alpha, beta) weighting of the two risk columns.
+#    Each arc gets an upward and a downward cost from the input edges.  The
+#    triangles are then relaxed bottom-up, which takes time linear in the
+#    number of triangles.  Customized metrics are kept in a small LRU.
+#
+#  * A query runs a Dijkstra search upwards from each end, and the two
+#    searches meet at the cheapest common node.  Shortcut arcs are then
+#    unpacked back into graph edges through their lower triangles.
+#
+# Unlike Router.doRoute this always finds the cheapest route.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import copy
+import heapq
+from array import array
+import lruCache
+
+INFINITY = float('inf')
+
+class CustomizableHierarchy:
+  """Metric-independent contraction hierarchy of a CompactGraph"""
+  def __init__(self, graph):
+    self.graph = graph
+    n = len(graph)
+    self.order = self.contractionOrder(graph)
+    self.rank = array('q', [0]) * n
+    for r, v in enumerate(self.order):
+      self.rank[v] = r
+    self.buildArcs()
+    self.buildTriangles()
+    self.buildInputMap()
+    self.metrics = lruCache.LRUCache(8)
+
+  def withGraph(self, graph):
+    """This hierarchy over another graph with the same nodes and edges
+    (see CompactGraph.sameEdges), such as one with reloaded risk data.
+    Only the customization has to be redone."""
+    hierarchy = copy.copy(self)
+    hierarchy.graph = graph
+    hierarchy.metrics = lruCache.LRUCache(8)
+    return(hierarchy)
+
+  def contractionOrder(self, graph):
+    """Greedy minimum-degree elimination order of the undirected graph.
+
+    Also records the upward neighbours each node has when it is
+    eliminated, which are the arcs of the chordal supergraph."""
+    n = len(graph)
+    adj = [set() for i in range(n)]
+    for v in range(n):
+      for e in range(graph.offsets[v], graph.offsets[v + 1]):
+        u = graph.targets[e]
+        if u != v:
+          adj[v].add(u)
+          adj[u].add(v)
+    heap = [(len(adj[v]), v) for v in range(n)]
+    heapq.heapify(heap)
+    eliminated = bytearray(n)
+    order = []
+    self.upward = [None] * n
+    while heap:
+      degree, v = heapq.heappop(heap)
+      if eliminated[v] or degree != len(adj[v]):
+        continue
+      eliminated[v] = 1
+      order.append(v)
+      neighbours = adj[v]
+      self.upward[v] = neighbours
+      for u in neighbours:
+        others = adj[u]
+        others.discard(v)
+        others.update(neighbours)
+        others.discard(u)
+        heapq.heappush(heap, (len(others), u))
+      adj[v] = None
+    return(order)
+
+  def buildArcs(self):
+    """Number the arcs of the chordal graph and store them as CSR"""
+    n = len(self.graph)
+    rank = self.rank
+    self.upOffsets = array('q', [0])
+    self.upTargets = array('q')
+    self.arcLow = array('q')
+    self.arcHigh = array('q')
+    self.arcIds = {}
+    for v in range(n):
+      for u in sorted(self.upward[v], key=lambda u: rank[u]):
+        self.arcIds[(v, u)] = len(self.upTargets)
+        self.upTargets.append(u)
+        self.arcLow.append(v)
+        self.arcHigh.append(u)
+      self.upOffsets.append(len(self.upTargets))
+
+  def arcCount(self):
+    return(len(self.upTargets))
+
+  def buildTriangles(self):
+    """List lower triangles in customization order, and by top arc"""
+    arcIds = self.arcIds
+    triTop = array('q')
+    triLow = array('q')
+    triHigh = array('q')
+    for x in self.order:
+      start = self.upOffsets[x]
+      end = self.upOffsets[x + 1]
+      for i in range(start, end):
+        u = self.upTargets[i]
+        for j in range(i + 1, end):
+          w = self.upTargets[j]
+          # upTargets are sorted by rank, so u is below w
+          triTop.append(arcIds[(u, w)])
+          triLow.append(i)
+          triHigh.append(j)
+    self.triTop = triTop
+    self.triLow = triLow
+    self.triHigh = triHigh
+
+    # The same triangles grouped by top arc, for unpacking shortcuts
+    counts = [0] * (self.arcCount() + 1)
+    for a in triTop:
+      counts[a + 1] = counts[a + 1] + 1
+    for a in range(self.arcCount()):
+      counts[a + 1] = counts[a + 1] + counts[a]
+    self.lowerOffsets = array('q', counts)
+    fill = list(counts[:-1])
+    self.lowerTriangles = array('q', [0]) * len(triTop)
+    for t, a in enumerate(triTop):
+      self.lowerTriangles[fill[a]] = t
+      fill[a] = fill[a] + 1
+    self.upward = None
+    self.arcIds = None
+
+  def buildInputMap(self):
+    """Map each input edge onto an arc, and whether it runs upwards"""
+    graph = self.graph
+    rank = self.rank
+    arcIds = dict(((self.arcLow[a], self.arcHigh[a]), a) for a in range(self.arcCount()))
+    self.inputArc = array('q')
+    self.inputUp = bytearray()
+    for v in range(len(graph)):
+      for e in range(graph.offsets[v], graph.offsets[v + 1]):
+        u = graph.targets[e]
+        if u == v:
+          self.inputArc.append(-1)
+          self.inputUp.append(0)
+        elif rank[v] < rank[u]:
+          self.inputArc.append(arcIds[(v, u)])
+          self.inputUp.append(1)
+        else:
+          self.inputArc.append(arcIds[(u, v)])
+          self.inputUp.append(0)
+
+  def customize(self, alpha, beta):
+    """Upward and downward costs of every arc for this alpha and beta"""
+    key = (float(alpha), float(beta))
+    metric = self.metrics.get(key)
+    if metric is not None:
+      return(metric)
+    costs = self.graph.costArray(alpha, beta)
+    up = array('d', [INFINITY]) * self.arcCount()
+    down = array('d', [INFINITY]) * self.arcCount()
+    inputUp = self.inputUp
+    for e, a in enumerate(self.inputArc):
+      if a < 0:
+        continue
+      cost = costs[e]
+      if inputUp[e]:
+        if cost < up[a]:
+          up[a] = cost
+      elif cost < down[a]:
+        down[a] = cost
+
+    # Relax every triangle (x, u, w), lowest x first:
+    #   u -> w can go u -> x -> w, and w -> u can go w -> x -> u
+    for top, low, high in zip(self.triTop, self.triLow, self.triHigh):
+      via = down[low] + up[high]
+      if via < up[top]:
+        up[top] = via
+      via = down[high] + up[low]
+      if via < down[top]:
+        down[top] = via
+    metric = (up, down)
+    self.metrics.put(key, metric)
+    return(metric)
+
+  def upwardSearch(self, source, weights):
+    """Dijkstra over the upward arcs from source.
+
+    Returns the settled distances and the arc each node was reached by."""
+    dist = {source: 0.0}
+    via = {source: -1}
+    settled = set()
+    queue = [(0.0, source)]
+    upOffsets, upTargets = self.upOffsets, self.upTargets
+    while queue:
+      d, v = heapq.heappop(queue)
+      if v in settled:
+        continue
+      settled.add(v)
+      for a in range(upOffsets[v], upOffsets[v + 1]):
+        cost = d + weights[a]
+        u = upTargets[a]
+        if cost < dist.get(u, INFINITY):
+          dist[u] = cost
+          via[u] = a
+          heapq.heappush(queue, (cost, u))
+    return(dist, via)
+
+  def query(self, source, target, alpha, beta):
+    """Cheapest route between two dense node indices.
+
+    Returns (cost, list of dense node indices), or (inf, []) if target
+    can't be reached."""
+    up, down = self.customize(alpha, beta)
+    forward, forwardVia = self.upwardSearch(source, up)
+    backward, backwardVia = self.upwardSearch(target, down)
+    best = INFINITY
+    meet = None
+    for v, d in forward.items():
+      total = d + backward.get(v, INFINITY)
+      if total < best:
+        best = total
+        meet = v
+    if meet is None:
+      return(INFINITY, [])
+
+    arcs = []
+    v = meet
+    while forwardVia[v] >= 0:
+      arcs.append(forwardVia[v])
+      v = self.arcLow[forwardVia[v]]
+    arcs.reverse()
+    route = [source]
+    for a in arcs:
+      self.unpack(a, True, up, down, route)
+    v = meet
+    while backwardVia[v] >= 0:
+      a = backwardVia[v]
+      self.unpack(a, False, up, down, route)
+      v = self.arcLow[a]
+    return(best, route)
+
+  def unpack(self, a, upwards, up, down, route):
+    """Append the graph nodes along arc a to route, leaving out the node it
+    is travelled from.  upwards means travelling it from its low end to its
+    high end, otherwise it is travelled high to low."""
+    stack = [(a, upwards)]
+    while stack:
+      a, upwards = stack.pop()
+      for i in range(self.lowerOffsets[a], self.lowerOffsets[a + 1]):
+        t = self.lowerTriangles[i]
+        low = self.triLow[t]    # arc (x, u)
+        high = self.triHigh[t]  # arc (x, w)
+        if upwards and down[low] + up[high] == up[a]:
+          # u -> x -> w; pushed in reverse so u -> x comes off first
+          stack.append((high, True))
+          stack.append((low, False))
+          break
+        if not upwards and down[high] + up[low] == down[a]:
+          # w -> x -> u
+          stack.append((low, True))
+          stack.append((high, False))
+          break
+      else:
+        # An original edge
+        if upwards:
+          route.append(self.arcHigh[a])
+        else:
+          route.append(self.arcLow[a])
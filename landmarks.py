@@ -0,0 +1,189 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Landmark (ALT) lower bounds for A* over a CompactGraph
+#
+# For a handful of landmark nodes L the shortest distances d(L,v) and d(v,L)
+# are stored for every node v, separately for each risk column (with edge
+# costs exp(risk0) and exp(risk1)).  By the triangle inequality
+#
+#   d(v,t) >= d(L,t) - d(L,v)    and    d(v,t) >= d(v,L) - d(t,L)
+#
+# and since an edge costs alpha*exp(risk0) + beta*exp(risk1), any route from
+# v to t costs at least alpha*bound0 + beta*bound1.  That holds for every
+# alpha, beta >= 0, so one table serves every request.
+#
+# Tables are saved next to the graph and checked against it when loaded.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import os
+import zlib
+import heapq
+import struct
+import random
+from array import array
+
+INFINITY = float('inf')
+LANDMARKS_MAGIC = b'PYRLMRK\0'
+LANDMARKS_VERSION = 1
+# magic, version, landmark count, node count, edge count, graph crc32
+LANDMARKS_HEADER = struct.Struct('<8sIIQQI4x')
+
+def graphChecksum(graph):
+  """crc32 of the graph's ids, edges (both ends) and risk columns"""
+  crc = 0
+  for a in (graph.ids, graph.offsets, graph.targets, graph.risk0, graph.risk1):
+    crc = zlib.crc32(memoryview(a).cast('B'), crc)
+  return(crc & 0xffffffff)
+
+def shortestDistances(graph, source, costs, reverse=False):
+  """Dijkstra distances from source to every node (or to source from every
+  node, if reverse is set), inf where there is no route"""
+  n = len(graph)
+  dist = array('d', [INFINITY]) * n
+  dist[source] = 0.0
+  queue = [(0.0, source)]
+  expand = graph.reverseNeighbours if reverse else graph.neighbours
+  while queue:
+    d, x = heapq.heappop(queue)
+    if d > dist[x]:
+      continue
+    for i, cost in expand(x, costs):
+      total = d + cost
+      if total < dist[i]:
+        dist[i] = total
+        heapq.heappush(queue, (total, i))
+  return(dist)
+
+class Landmarks:
+  """Distance tables to and from a few landmark nodes"""
+  def __init__(self, graph, nodes, tables):
+    self.graph = graph
+    self.nodes = nodes
+    # tables[k] = (from0, to0, from1, to1) for landmark k:
+    # fromC[v] = d(L,v) and toC[v] = d(v,L) with edge costs exp(riskC)
+    self.tables = tables
+
+  @classmethod
+  def build(cls, graph, count=6, seed=1):
+    """Pick landmarks by farthest-point selection and tabulate them"""
+    columns = (graph.costArray(1.0, 0.0), graph.costArray(0.0, 1.0))
+    nodes = []
+    tables = []
+    n = len(graph)
+    if n == 0:
+      return(cls(graph, nodes, tables))
+    # Nearest landmark distance of each node, so the next landmark can be
+    # the node furthest from all of them
+    nearest = array('d', [INFINITY]) * n
+    candidate = random.Random(seed).randrange(n)
+    while len(nodes) < min(count, n):
+      nodes.append(candidate)
+      table = []
+      for costs in columns:
+        table.append(shortestDistances(graph, candidate, costs))
+        table.append(shortestDistances(graph, candidate, costs, reverse=True))
+      tables.append(tuple(table))
+      best = -1.0
+      for v in range(n):
+        d = min(table[0][v], table[1][v])
+        if d < nearest[v]:
+          nearest[v] = d
+        if nearest[v] != INFINITY and nearest[v] > best and not v in nodes:
+          best = nearest[v]
+          candidate = v
+      if best < 0:
+        break
+    return(cls(graph, nodes, tables))
+
+  def save(self, filename):
+    tmpname = filename + '.tmp'
+    graph = self.graph
+    with open(tmpname, 'wb') as f:
+      f.write(LANDMARKS_HEADER.pack(LANDMARKS_MAGIC, LANDMARKS_VERSION,
+        len(self.nodes), len(graph), graph.edgeCount(), graphChecksum(graph)))
+      f.write(memoryview(array('q', self.nodes)).cast('B'))
+      for table in self.tables:
+        for column in table:
+          f.write(memoryview(column).cast('B'))
+    os.rename(tmpname, filename)
+
+  @classmethod
+  def load(cls, filename, graph):
+    """Read tables saved for this graph, or None if missing or stale"""
+    try:
+      with open(filename, 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      return(None)
+    if len(data) < LANDMARKS_HEADER.size:
+      return(None)
+    magic, version, k, n, e, crc = LANDMARKS_HEADER.unpack_from(data, 0)
+    if magic != LANDMARKS_MAGIC or version != LANDMARKS_VERSION:
+      return(None)
+    if n != len(graph) or e != graph.edgeCount() or crc != graphChecksum(graph):
+      return(None)
+    if len(data) != LANDMARKS_HEADER.size + 8 * k + 32 * k * n:
+      return(None)
+    offset = LANDMARKS_HEADER.size
+    nodes = list(array('q', data[offset:offset + 8 * k]))
+    offset = offset + 8 * k
+    tables = []
+    for i in range(k):
+      table = []
+      for c in range(4):
+        table.append(array('d', data[offset:offset + 8 * n]))
+        offset = offset + 8 * n
+      tables.append(tuple(table))
+    return(cls(graph, nodes, tables))
+
+  @classmethod
+  def loadOrBuild(cls, filename, graph, count=6):
+    """Tables saved for this graph, or else new ones for count landmarks,
+    saved to filename.  Tables for a different count are built again."""
+    landmarks = cls.load(filename, graph)
+    if landmarks is None or len(landmarks.nodes) != min(count, len(graph)):
+      landmarks = cls.build(graph, count)
+      landmarks.save(filename)
+    return(landmarks)
+
+  def heuristic(self, target, alpha, beta):
+    """Function giving a lower bound on the cost from a node to target"""
+    ends = [(table, table[0][target], table[1][target], table[2][target], table[3][target])
+            for table in self.tables]
+    def bound(v):
+      best0 = 0.0
+      best1 = 0.0
+      for (from0, to0, from1, to1), lt0, tl0, lt1, tl1 in ends:
+        # d(L,t) - d(L,v); unknown if L can't reach v
+        fv = from0[v]
+        if fv != INFINITY:
+          if lt0 - fv > best0:
+            best0 = lt0 - fv
+        # d(v,L) - d(t,L); unknown if t can't reach L
+        if tl0 != INFINITY:
+          if to0[v] - tl0 > best0:
+            best0 = to0[v] - tl0
+        fv = from1[v]
+        if fv != INFINITY:
+          if lt1 - fv > best1:
+            best1 = lt1 - fv
+        if tl1 != INFINITY:
+          if to1[v] - tl1 > best1:
+            best1 = to1[v] - tl1
+      if best0 == INFINITY or best1 == INFINITY:
+        # target can't be reached from v at all
+        return(INFINITY)
+      return(alpha * best0 + beta * best1)
+    return(bound)
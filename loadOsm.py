@@ -23,7 +23,10 @@
 #  2007-11-05  OJW  Multiple forms of transport
 #------------------------------------------------------
 import os
+import copy
+import math
 import json
+from xml.etree import ElementTree
 import re
 import sys
 import osmapi
@@ -31,6 +34,8 @@ import time
 import tiledata
 import tilenames
 import weights
+import nodeGrid
+import riskCsv
 import json
 
 class LoadOsm:
@@ -39,6 +44,11 @@ class LoadOsm:
     """Initialise an OSM-file parser"""
     self.routing = {}
     self.rnodes = {}
+    self.reverse = None
+    # Bumped each time risk data is (re)loaded, so that anything derived
+    # from it (such as a Router's cached routes) can tell it is out of date
+    self.riskVersion = 0
+    self.index = nodeGrid.NodeGrid()
     self.transport = transport
     self.tiles = {}
     self.weights = weights.RoutingWeights()
@@ -62,13 +72,25 @@ class LoadOsm:
     return(self.loadOsm(filename))
 
   def loadOsm(self, filename):
+    """Load the routeable ways from an OSM file.
+
+    .json and .txt files hold JSON tokens (see loadJsonTokens); anything
+    else is read as OSM XML (see loadOsmXml).  Graph snapshots can't be
+    loaded here, as they map into a CompactGraph rather than these dicts:
+    open them with Router(snapshot=...) or compactGraph.loadSnapshot."""
     if(not os.path.exists(filename)):
       print("No such data file %s" % filename)
       return(False)
+    if filename.endswith(('.json', '.txt')):
+      return(self.loadJsonTokens(filename))
+    return(self.loadOsmXml(filename))
 
+  def loadJsonTokens(self, filename):
+    """Load a JSON list of {'type': 'node' or 'way', 'data': {...}} tokens"""
     nodes, ways = {}, {}
 
-    data = [json.loads(el) for el in open('jsonTokens.txt','r').readlines()][0]
+    with open(filename, 'r') as f:
+      data = [json.loads(el) for el in f.readlines()][0]
 
     for x in data:
       try:
@@ -92,14 +114,64 @@ class LoadOsm:
       self.storeWay(way_id, way_data['tag'], way_nodes)
 
     return(True)
-  
-  def storeWay(self, wayID, tags, nodes):
+
+  def loadOsmXml(self, filename):
+    """Stream an OSM XML file, in two passes so that memory stays bounded.
+
+    The first pass notes which nodes the routeable ways use; the second
+    keeps the coordinates of just those nodes, and stores each way as it
+    arrives.  Elements are cleared as soon as they have been read."""
+    needed = set()
+    for elem in self.iterOsmXml(filename, ('way',)):
+      if self.routeable(self.elementTags(elem)):
+        for nd in elem.iter('nd'):
+          needed.add(int(nd.get('ref')))
+
+    coords = {}
+    for elem in self.iterOsmXml(filename, ('node', 'way')):
+      if elem.tag == 'node':
+        node_id = int(elem.get('id'))
+        if node_id in needed:
+          coords[node_id] = (float(elem.get('lat')), float(elem.get('lon')))
+        continue
+      tags = self.elementTags(elem)
+      if not self.routeable(tags):
+        continue
+      way_nodes = []
+      for nd in elem.iter('nd'):
+        node_id = int(nd.get('ref'))
+        pos = coords.get(node_id)
+        if pos is not None:
+          way_nodes.append([node_id, pos[0], pos[1]])
+      self.storeWay(int(elem.get('id')), tags, way_nodes)
+    return(True)
+
+  def iterOsmXml(self, filename, wanted):
+    """Yield each complete top-level element whose tag is in wanted,
+    clearing every element once it has been dealt with"""
+    root = None
+    for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+      if event == 'start':
+        if root is None:
+          root = elem
+        continue
+      if elem.tag in wanted:
+        yield elem
+      if elem.tag in ('node', 'way', 'relation'):
+        elem.clear()
+        root.clear()
+
+  def elementTags(self, elem):
+    return(dict((tag.get('k'), tag.get('v')) for tag in elem.iter('tag')))
+
+  def routeable(self, tags):
+    """Can our transport use a way with these tags?"""
+    return(self.access(tags)[self.transport])
+
+  def access(self, tags):
+    """Which kinds of transport can use a way with these tags"""
     highway = self.equivalent(tags.get('highway', ''))
     railway = self.equivalent(tags.get('railway', ''))
-    oneway = tags.get('oneway', '')
-    reversible = not oneway in('yes','true','1')
-
-    # Calculate what vehicles can use this route
     # TODO: just use getWeight != 0
     access = {}
     access['cycle'] = highway in ('primary','secondary','tertiary','unclassified','minor','cycleway','residential', 'track','service')
@@ -107,6 +179,15 @@ class LoadOsm:
     access['train'] = railway in('rail','light_rail','subway')
     access['foot'] = access['cycle'] or highway in('footway','steps')
     access['horse'] = highway in ('track','unclassified','bridleway')
+    return(access)
+  
+  def storeWay(self, wayID, tags, nodes):
+    highway = self.equivalent(tags.get('highway', ''))
+    oneway = tags.get('oneway', '')
+    reversible = not oneway in('yes','true','1')
+
+    # Calculate what vehicles can use this route
+    access = self.access(tags)
 
     # Store routing information
     last = [None,None,None]
@@ -127,10 +208,17 @@ class LoadOsm:
       last = node
 
   def makeNodeRouteable(self,node):
+    old = self.rnodes.get(node[0])
+    if old is not None:
+      if old[0] == node[1] and old[1] == node[2]:
+        return
+      self.index.remove(node[0], old[0], old[1])
     self.rnodes[node[0]] = [node[1],node[2]]
+    self.index.add(node[0], node[1], node[2])
     
   def addLink(self,fr,to, weight=1):
     """Add a routeable edge to the scenario"""
+    self.reverse = None
     try:
       if to in list(self.routing[fr].keys()):
         return
@@ -168,41 +256,97 @@ class LoadOsm:
   def findNode(self,lat,lon):
     """Find the nearest node that can be the start of a route"""
     #self.getArea(lat,lon)
-    maxDist = 1E+20
-    nodeFound = None
-    posFound = None
-    for (node_id,pos) in list(self.rnodes.items()):
-      dy = pos[0] - lat
-      dx = pos[1] - lon
-      dist = dx * dx + dy * dy
-      if(dist < maxDist):
-        maxDist = dist
-        nodeFound = node_id
-        posFound = pos
-    return(nodeFound)
+    found = self.index.nearest(lat, lon, 1)
+    if not found:
+      return(None)
+    return(found[0])
       
+  def findNodes(self, points):
+    """findNode for each (lat, lon) in a list, in one pass over the index"""
+    return(self.index.nearestEach(points))
+
+  # The search interface shared with compactGraph.CompactGraph: nodes are
+  # addressed by their OSM ids here, so the id mapping is the identity
+  def nodeIndex(self, node_id):
+    return(node_id)
+
+  def nodeId(self, node_id):
+    return(node_id)
+
+  def position(self, node_id):
+    return(self.rnodes[node_id])
+
+  def nodeIds(self):
+    return(list(self.rnodes.keys()))
+
+  def weighting(self, alpha, beta):
+    return((alpha, beta))
+
+  def neighbours(self, node_id, weighting):
+    """Yield (node, cost) for each link leaving a node"""
+    alpha, beta = weighting
+    for i, weight in self.routing[node_id].items():
+      if(weight == 0):
+        continue
+      yield i, alpha*math.exp(weight[0])+beta*math.exp(weight[1])
+
+  def reverseNeighbours(self, node_id, weighting):
+    """Yield (node, cost) for each link leading into a node"""
+    if self.reverse is None:
+      reverse = {}
+      for fr, links in self.routing.items():
+        for to, weight in links.items():
+          reverse.setdefault(to, {})[fr] = weight
+      self.reverse = reverse
+    alpha, beta = weighting
+    for i, weight in self.reverse.get(node_id, {}).items():
+      if(weight == 0):
+        continue
+      yield i, alpha*math.exp(weight[0])+beta*math.exp(weight[1])
+
   def report(self):
     """Display some info about the loaded data"""
     print("Loaded %d nodes" % len(list(self.rnodes.keys())))
     print("Loaded %d %s routes" % (len(list(self.routing.keys())), self.transport))
   def readInRisk(self,file):
-        crimeData={}
-        with open(file, 'r') as f:
-                for line in f:
-                    splitLine = line.split(',')
-                    parentNode = int(splitLine[0])
-                    childNode = int(splitLine[1])
-                    if parentNode in crimeData:
-                        childDict = crimeData[parentNode]
-                        childDict[childNode] = [float(splitLine[-2]),float(splitLine[-1])]
-                        crimeData[parentNode] =  childDict
-                    else:
-                        childDict = {}
-                        childDict[childNode] = [float(splitLine[-2]),float(splitLine[-1])]
-                        crimeData[parentNode] =  childDict
-        self.routing=crimeData
-                        
+        self.routing=readRisk(file)
+        self.reverse = None
+        self.riskVersion = self.riskVersion + 1
+
+  def withRisk(self, routing):
+    """A copy of this datastore with different risk data.
+
+    The nodes and their spatial index are shared with this one, which is
+    left untouched, so searches already running on it are unaffected."""
+    data = copy.copy(self)
+    data.routing = routing
+    data.reverse = None
+    data.riskVersion = self.riskVersion + 1
+    return(data)
+
+
+
+def readRisk(file):
+    """Read a routing.csv risk file into {parent: {child: [risk0, risk1]}}"""
+    crimeData={}
+    columns = riskCsv.readColumns(file)
+    for parentNode, childNode, risk0, risk1 in zip(columns.parents, columns.children, columns.risk0, columns.risk1):
+        childDict = crimeData.get(parentNode)
+        if childDict is None:
+            childDict = crimeData[parentNode] = {}
+        childDict[childNode] = [risk0, risk1]
+    return(crimeData)
 
+def mergeRisk(routing, changes):
+    """routing with the edges in changes (read from a delta file in the
+    same format as routing.csv) added or replaced.  Only the child dicts of
+    the changed nodes are copied; routing itself is not modified."""
+    merged = dict(routing)
+    for parent, children in changes.items():
+        childDict = dict(merged.get(parent, {}))
+        childDict.update(children)
+        merged[parent] = childDict
+    return(merged)
 
 def routeToCSV(routes,nodes):
     outputFileName = 'C:/Users/Patrick/Columbia/Hackathon/PyrouteLib/pyroutelib2-master/routing.csv'
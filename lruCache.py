@@ -0,0 +1,112 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Small least-recently-used cache, with optional expiry
+#
+# By default maxsize counts entries.  Given a weigh function, it is instead
+# a budget for the total weight of the entries (bytes, say).
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+  """Mapping that holds at most maxsize entries, dropping the least
+  recently used one when it is full.  If ttl (seconds) is given, entries
+  also expire that long after they were stored.
+
+  weigh(value), if given, is each entry's share of maxsize instead of 1;
+  an entry heavier than maxsize on its own is still kept until the next
+  put.  evicted(key, value), if given, is called for each entry dropped to
+  make room or because it expired."""
+  def __init__(self, maxsize=8, ttl=None, clock=time.time, weigh=None, evicted=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.clock = clock
+    self.weigh = weigh
+    self.evicted = evicted
+    self.entries = OrderedDict()
+    self.weight = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key, default=None):
+    dropped = None
+    with self.lock:
+      try:
+        value, expires, weight = self.entries[key]
+      except KeyError:
+        self.misses = self.misses + 1
+        return(default)
+      if expires is not None and expires <= self.clock():
+        del self.entries[key]
+        self.weight = self.weight - weight
+        self.expirations = self.expirations + 1
+        self.misses = self.misses + 1
+        dropped = value
+      else:
+        self.entries.move_to_end(key)
+        self.hits = self.hits + 1
+        return(value)
+    if self.evicted is not None:
+      self.evicted(key, dropped)
+    return(default)
+
+  def put(self, key, value):
+    expires = None
+    if self.ttl is not None:
+      expires = self.clock() + self.ttl
+    weight = 1 if self.weigh is None else self.weigh(value)
+    dropped = []
+    with self.lock:
+      old = self.entries.get(key)
+      if old is not None:
+        self.weight = self.weight - old[2]
+      self.entries[key] = (value, expires, weight)
+      self.weight = self.weight + weight
+      self.entries.move_to_end(key)
+      while self.weight > self.maxsize and len(self.entries) > 1:
+        oldKey, (oldValue, oldExpires, oldWeight) = self.entries.popitem(last=False)
+        self.weight = self.weight - oldWeight
+        self.evictions = self.evictions + 1
+        dropped.append((oldKey, oldValue))
+    if self.evicted is not None:
+      for oldKey, oldValue in dropped:
+        self.evicted(oldKey, oldValue)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.weight = 0
+
+  def stats(self):
+    """Counters, as a dict"""
+    return({
+      'size': len(self.entries),
+      'maxsize': self.maxsize,
+      'weight': self.weight,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'expirations': self.expirations})
+
+  def __len__(self):
+    return(len(self.entries))
+
+  def __contains__(self, key):
+    return(key in self.entries)
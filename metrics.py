@@ -0,0 +1,155 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Counters and histograms describing the router's queries
+#
+# Each query is described by a dict of its own figures (see
+# Router.getRoutes):
+#
+#   status       success, no_route, gave_up, no_such_node, ...
+#   cached       whether the route came from the route cache
+#   seconds      {phase: seconds} for findNode, search, path and total
+#   expanded     nodes the search expanded
+#   pushes       items the search put on its queue(s)
+#   peakQueue    most items in the queue(s) at once
+#   limit        the budget the search ran out of (expansions or time), if any
+#   partial      whether the route stops short of the destination
+#
+# QueryMetrics adds these up, and writes the totals out in the Prometheus
+# text exposition format for the server's /metrics page.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+# Statuses that are always listed, even before any query has had them
+STATUSES = ('success', 'no_route', 'gave_up', 'no_such_node')
+PHASES = ('findNode', 'search', 'path', 'total')
+PREFIX = 'pyroute_'
+
+class Histogram:
+  """Counts of observations at or below each of a list of bounds"""
+  def __init__(self, buckets):
+    self.buckets = buckets
+    # The last count is for everything over the largest bound
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum = self.sum + value
+    self.count = self.count + 1
+
+  def lines(self, name, labels=''):
+    """The histogram's _bucket, _sum and _count samples"""
+    prefix = labels and labels + ',' or ''
+    lines = []
+    total = 0
+    for bound, count in zip(self.buckets, self.counts):
+      total = total + count
+      lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, formatNumber(bound), total))
+    lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, self.count))
+    labels = labels and '{%s}' % labels
+    lines.append('%s_sum%s %s' % (name, labels, formatNumber(self.sum)))
+    lines.append('%s_count%s %d' % (name, labels, self.count))
+    return(lines)
+
+class QueryMetrics:
+  """Totals over every query recorded so far.  Safe to share between
+  threads."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.statuses = dict.fromkeys(STATUSES, 0)
+    self.cacheHits = 0
+    self.limits = {'expansions': 0, 'time': 0}
+    self.partial = 0
+    self.phases = dict((phase, Histogram(SECONDS_BUCKETS)) for phase in PHASES)
+    self.expanded = Histogram(COUNT_BUCKETS)
+    self.pushes = Histogram(COUNT_BUCKETS)
+    self.peakQueue = Histogram(COUNT_BUCKETS)
+
+  def record(self, stats):
+    """Add in one query's figures"""
+    with self.lock:
+      status = stats.get('status')
+      self.statuses[status] = self.statuses.get(status, 0) + 1
+      for phase, seconds in stats.get('seconds', {}).items():
+        histogram = self.phases.get(phase)
+        if histogram is not None:
+          histogram.observe(seconds)
+      limit = stats.get('limit')
+      if limit is not None:
+        self.limits[limit] = self.limits.get(limit, 0) + 1
+      if stats.get('partial'):
+        self.partial = self.partial + 1
+      if stats.get('cached'):
+        self.cacheHits = self.cacheHits + 1
+      elif 'expanded' in stats:
+        # A cached route didn't search, so has nothing to add here
+        self.expanded.observe(stats['expanded'])
+        self.pushes.observe(stats['pushes'])
+        self.peakQueue.observe(stats['peakQueue'])
+
+  def render(self, gauges=()):
+    """The totals in the Prometheus text format, followed by any
+    (name, help, value) gauges"""
+    with self.lock:
+      lines = []
+      name = PREFIX + 'queries_total'
+      lines.append('# HELP %s Queries answered, by result.' % name)
+      lines.append('# TYPE %s counter' % name)
+      for status, count in sorted(self.statuses.items(), key=lambda item: str(item[0])):
+        lines.append('%s{status="%s"} %d' % (name, status, count))
+      name = PREFIX + 'query_cache_hits_total'
+      lines.append('# HELP %s Queries answered from the route cache.' % name)
+      lines.append('# TYPE %s counter' % name)
+      lines.append('%s %d' % (name, self.cacheHits))
+      name = PREFIX + 'search_limits_total'
+      lines.append('# HELP %s Searches stopped by their budget, by limit.' % name)
+      lines.append('# TYPE %s counter' % name)
+      for limit, count in sorted(self.limits.items()):
+        lines.append('%s{limit="%s"} %d' % (name, limit, count))
+      name = PREFIX + 'partial_routes_total'
+      lines.append('# HELP %s Partial routes returned by searches that ran out of budget.' % name)
+      lines.append('# TYPE %s counter' % name)
+      lines.append('%s %d' % (name, self.partial))
+      name = PREFIX + 'query_phase_seconds'
+      lines.append('# HELP %s Time spent in each phase of a query.' % name)
+      lines.append('# TYPE %s histogram' % name)
+      for phase in PHASES:
+        lines.extend(self.phases[phase].lines(name, 'phase="%s"' % phase))
+      for histogram, suffix, help in (
+          (self.expanded, 'expanded_nodes', 'Nodes expanded by each search.'),
+          (self.pushes, 'queue_pushes', 'Items pushed onto the queue by each search.'),
+          (self.peakQueue, 'peak_queue_size', 'Largest queue size reached by each search.')):
+        name = PREFIX + 'search_' + suffix
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        lines.extend(histogram.lines(name))
+    for name, help, value in gauges:
+      name = PREFIX + name
+      lines.append('# HELP %s %s' % (name, help))
+      lines.append('# TYPE %s gauge' % name)
+      lines.append('%s %s' % (name, formatNumber(value)))
+    return('\n'.join(lines) + '\n')
+
+def formatNumber(value):
+  """A number as Prometheus writes it"""
+  if value == int(value) and abs(value) < 1e15:
+    return(str(int(value)))
+  return(repr(float(value)))
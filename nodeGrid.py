@@ -0,0 +1,199 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Spatial index of routeable nodes, for snapping positions onto the graph
+#
+# Nodes are bucketed into square cells of a fixed size (in degrees), and
+# queries search outwards ring by ring from the cell containing the query
+# point, so only the cells near it are ever examined.
+#
+# Distances are measured the same way as LoadOsm.findNode always has: the
+# squared difference in degrees, with no projection.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import math
+import heapq
+
+class NodeGrid:
+  """Grid-bucket index of node positions"""
+  def __init__(self, cellSize=0.002):
+    self.cellSize = cellSize
+    self.cells = {}
+    self.count = 0
+    self.bounds = None  # (minX, minY, maxX, maxY) of occupied cells
+
+  def cell(self, lat, lon):
+    return(int(math.floor(lon / self.cellSize)), int(math.floor(lat / self.cellSize)))
+
+  def add(self, node_id, lat, lon):
+    """Add a node, or move it if it is already indexed at this position"""
+    key = self.cell(lat, lon)
+    try:
+      bucket = self.cells[key]
+    except KeyError:
+      bucket = self.cells[key] = {}
+      x, y = key
+      if self.bounds is None:
+        self.bounds = (x, y, x, y)
+      else:
+        self.bounds = (min(self.bounds[0], x), min(self.bounds[1], y),
+                       max(self.bounds[2], x), max(self.bounds[3], y))
+    if not node_id in bucket:
+      self.count = self.count + 1
+    bucket[node_id] = (lat, lon)
+
+  def remove(self, node_id, lat, lon):
+    """Remove a node that was indexed at lat/lon"""
+    key = self.cell(lat, lon)
+    bucket = self.cells.get(key)
+    if bucket is None or not node_id in bucket:
+      return
+    del bucket[node_id]
+    self.count = self.count - 1
+    if not bucket:
+      del self.cells[key]
+
+  def __len__(self):
+    return(self.count)
+
+  def ring(self, cx, cy, r):
+    """Yield the buckets on the square ring r cells away from (cx,cy),
+    looking only at the part of it inside the occupied bounds"""
+    if self.bounds is None:
+      return
+    minX, minY, maxX, maxY = self.bounds
+    if r == 0:
+      bucket = self.cells.get((cx, cy))
+      if bucket:
+        yield bucket
+      return
+    x0 = max(cx - r, minX)
+    x1 = min(cx + r, maxX)
+    for y in (cy - r, cy + r):
+      if minY <= y <= maxY:
+        for x in range(x0, x1 + 1):
+          bucket = self.cells.get((x, y))
+          if bucket:
+            yield bucket
+    y0 = max(cy - r + 1, minY)
+    y1 = min(cy + r - 1, maxY)
+    for x in (cx - r, cx + r):
+      if minX <= x <= maxX:
+        for y in range(y0, y1 + 1):
+          bucket = self.cells.get((x, y))
+          if bucket:
+            yield bucket
+
+  def minRing(self, cx, cy):
+    """First ring around (cx,cy) that reaches the occupied bounds"""
+    if self.bounds is None:
+      return(0)
+    minX, minY, maxX, maxY = self.bounds
+    return(max(minX - cx, cx - maxX, minY - cy, cy - maxY, 0))
+
+  def maxRing(self, cx, cy):
+    """Number of rings needed around (cx,cy) to cover every occupied cell"""
+    if self.bounds is None:
+      return(-1)
+    minX, minY, maxX, maxY = self.bounds
+    return(max(cx - minX, maxX - cx, cy - minY, maxY - cy, 0))
+
+  def nearest(self, lat, lon, k=1):
+    """Return the k nodes closest to lat/lon, closest first"""
+    return([node_id for (node_id, pos) in self.nearestEntries(lat, lon, k)])
+
+  def nearestEntries(self, lat, lon, k=1):
+    """(node_id, position) of the k nodes closest to lat/lon"""
+    cx, cy = self.cell(lat, lon)
+    last = self.maxRing(cx, cy)
+    best = []  # max-heap of (-dist, -order, node_id, pos), at most k long
+    order = 0
+    r = self.minRing(cx, cy)
+    while r <= last:
+      for bucket in self.ring(cx, cy, r):
+        for node_id, pos in bucket.items():
+          dy = pos[0] - lat
+          dx = pos[1] - lon
+          dist = dx * dx + dy * dy
+          order = order + 1
+          if len(best) < k:
+            heapq.heappush(best, (-dist, -order, node_id, pos))
+          elif dist < -best[0][0]:
+            heapq.heapreplace(best, (-dist, -order, node_id, pos))
+      # Anything in rings further out is at least r cells away
+      reach = r * self.cellSize
+      if len(best) == k and -best[0][0] <= reach * reach:
+        break
+      r = r + 1
+    best.sort(reverse=True)
+    return([(node_id, pos) for (dist, order, node_id, pos) in best])
+
+  def nearestEach(self, points):
+    """The nearest node to each (lat, lon) in points (None if the index is
+    empty).  Points in the same cell share one scan for candidates."""
+    found = []
+    candidates = {}
+    halfCell = 0.5 * self.cellSize
+    for (lat, lon) in points:
+      key = self.cell(lat, lon)
+      near = candidates.get(key)
+      if near is None:
+        # For any point in the cell, the node nearest the cell's centre is
+        # at most D + half a diagonal away, so its nearest node is within
+        # D + a whole diagonal of the centre
+        clat = key[1] * self.cellSize + halfCell
+        clon = key[0] * self.cellSize + halfCell
+        centre = self.nearestEntries(clat, clon, 1)
+        near = []
+        if centre:
+          pos = centre[0][1]
+          reach = math.sqrt((pos[0] - clat) ** 2 + (pos[1] - clon) ** 2) + 2 * math.sqrt(2) * halfCell
+          near = self.scan(clat, clon, reach)
+        candidates[key] = near
+      best = None
+      bestDist = 1E+20
+      for node_id, pos in near:
+        dy = pos[0] - lat
+        dx = pos[1] - lon
+        dist = dx * dx + dy * dy
+        if dist < bestDist:
+          bestDist = dist
+          best = node_id
+      found.append(best)
+    return(found)
+
+  def scan(self, lat, lon, radius):
+    """(node_id, position) of every node within radius of lat/lon"""
+    cx, cy = self.cell(lat, lon)
+    last = min(self.maxRing(cx, cy), int(math.ceil(radius / self.cellSize)))
+    limit = radius * radius
+    found = []
+    for r in range(self.minRing(cx, cy), last + 1):
+      for bucket in self.ring(cx, cy, r):
+        for node_id, pos in bucket.items():
+          dy = pos[0] - lat
+          dx = pos[1] - lon
+          if dx * dx + dy * dy <= limit:
+            found.append((node_id, pos))
+    return(found)
+
+  def within(self, lat, lon, radius):
+    """Return all nodes within radius (degrees) of lat/lon, closest first"""
+    found = []
+    for node_id, pos in self.scan(lat, lon, radius):
+      dy = pos[0] - lat
+      dx = pos[1] - lon
+      found.append((dx * dx + dy * dy, len(found), node_id))
+    found.sort()
+    return([node_id for (dist, order, node_id) in found])
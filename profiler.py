@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Sampling profiler for server requests
+#
+# Profiling every request would slow them all down, so a RequestProfiler
+# only looks at some of them:
+#
+#  * a random fraction (sampleRate) of requests are run under cProfile, and
+#  * while any request runs for longer than slowSeconds, a background thread
+#    takes samples of its call stack every interval seconds.
+#
+# Only one request at a time is run under cProfile.  Sampled requests have
+# their stacks sampled too.  The cProfile stats and
+# the stack samples are kept for the last window seconds, in slices, and
+# can be had as pstats (for snakeviz, pstats.Stats etc.) or as collapsed
+# stacks, one "outer;...;inner count" line per stack, ready for
+# flamegraph.pl or speedscope.
+#
+# The server only calls through a profiler if it was given one, so it costs
+# nothing when profiling is off.  With worker processes, the queries run in
+# the workers, and all that is seen here is the wait for them.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import os
+import io
+import sys
+import time
+import random
+import marshal
+import pstats
+import cProfile
+import threading
+from collections import deque
+
+# Slices each window is kept in; the oldest slice is dropped whole
+SLICES = 10
+
+class Slice:
+  """Profile data gathered over one part of the window"""
+  def __init__(self, start):
+    self.start = start
+    self.stats = None
+    # {collapsed stack: samples}
+    self.stacks = {}
+    self.requests = 0
+    self.sampled = 0
+    self.slow = 0
+
+class RequestProfiler:
+  """Profiles a sample of the calls made through it (see call)"""
+  def __init__(self, sampleRate=0.0, slowSeconds=None, window=600, interval=0.005,
+               directory=None, clock=time.time):
+    self.sampleRate = sampleRate
+    self.slowSeconds = slowSeconds
+    self.window = window
+    self.interval = interval
+    self.directory = directory
+    self.clock = clock
+    self.random = random.Random()
+    self.lock = threading.Lock()
+    # Held by the call being run under cProfile
+    self.profiling = threading.Lock()
+    self.slices = deque()
+    # {thread ident: (time the call started, seconds before its stack is
+    # sampled)} for the calls being watched
+    self.active = {}
+    self.sampler = None
+
+  def call(self, func, *args, **kwargs):
+    """func(*args, **kwargs), profiled if it is picked for the sample and
+    no other call is being profiled (Python 3.12 allows only one active
+    cProfile).  Nothing that goes wrong in the profiler reaches the
+    caller."""
+    profile = None
+    if (self.sampleRate > 0 and self.random.random() < self.sampleRate
+        and self.profiling.acquire(False)):
+      profile = startProfile()
+      if profile is None:
+        self.profiling.release()
+    sampled = profile is not None
+    watch = sampled or self.slowSeconds is not None
+    if watch:
+      self.watch(0.0 if sampled else self.slowSeconds)
+    start = self.clock()
+    try:
+      return(func(*args, **kwargs))
+    finally:
+      try:
+        if watch:
+          self.active.pop(threading.current_thread().ident, None)
+        if sampled:
+          profile.disable()
+        self.record(profile, self.clock() - start)
+      except Exception as e:
+        print("Couldn't profile request: %s" % e)
+      finally:
+        if sampled:
+          self.profiling.release()
+
+  def record(self, profile, elapsed):
+    """Count a call that took elapsed seconds, with its profile if it was
+    sampled"""
+    slow = self.slowSeconds is not None and elapsed >= self.slowSeconds
+    stats = pstats.Stats(profile) if profile is not None else None
+    with self.lock:
+      current = self.currentSlice()
+      current.requests = current.requests + 1
+      if slow:
+        current.slow = current.slow + 1
+      if stats is not None:
+        current.sampled = current.sampled + 1
+        if current.stats is None:
+          current.stats = stats
+        else:
+          current.stats.add(stats)
+
+  def watch(self, after):
+    """Sample this thread's stack once it has been running for after
+    seconds, starting the sampling thread if need be"""
+    self.active[threading.current_thread().ident] = (self.clock(), after)
+    if self.sampler is None:
+      with self.lock:
+        if self.sampler is None:
+          self.sampler = threading.Thread(target=self.sample, name='RequestProfiler')
+          self.sampler.daemon = True
+          self.sampler.start()
+
+  def sample(self):
+    """Sampling thread: note the stacks of the calls being watched"""
+    while True:
+      time.sleep(self.interval)
+      now = self.clock()
+      due = [ident for (ident, (start, after)) in list(self.active.items()) if now - start >= after]
+      if not due:
+        continue
+      frames = sys._current_frames()
+      stacks = [collapse(frames[ident]) for ident in due if ident in frames]
+      with self.lock:
+        current = self.currentSlice()
+        for stack in stacks:
+          current.stacks[stack] = current.stacks.get(stack, 0) + 1
+
+  def currentSlice(self):
+    """The slice for now, dropping slices that have left the window.  Call
+    with the lock held."""
+    now = self.clock()
+    while self.slices and self.slices[0].start <= now - self.window:
+      self.slices.popleft()
+    length = float(self.window) / SLICES
+    if not self.slices or self.slices[-1].start <= now - length:
+      self.slices.append(Slice(now))
+    return(self.slices[-1])
+
+  def stats(self):
+    """The cProfile stats of the sampled calls in the window, merged into
+    one pstats.Stats (None if there are none)"""
+    with self.lock:
+      self.currentSlice()
+      merged = None
+      for part in self.slices:
+        if part.stats is None:
+          continue
+        if merged is None:
+          merged = pstats.Stats()
+        merged.add(part.stats)
+      return(merged)
+
+  def pstatsBytes(self):
+    """The window's stats in the pstats file format (as dump_stats writes)"""
+    stats = self.stats()
+    return(marshal.dumps(stats.stats if stats is not None else {}))
+
+  def collapsed(self):
+    """The window's stack samples as collapsed stacks"""
+    with self.lock:
+      self.currentSlice()
+      counts = {}
+      for part in self.slices:
+        for stack, samples in part.stacks.items():
+          counts[stack] = counts.get(stack, 0) + samples
+    return(''.join('%s %d\n' % (stack, samples) for (stack, samples) in sorted(counts.items())))
+
+  def report(self, limit=40):
+    """The window's busiest functions, as pstats prints them"""
+    stats = self.stats()
+    if stats is None:
+      return('No sampled requests\n')
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(limit)
+    return(out.getvalue())
+
+  def summary(self):
+    """Counts of the requests seen in the window"""
+    with self.lock:
+      self.currentSlice()
+      return({'window': self.window,
+              'sampleRate': self.sampleRate,
+              'slowSeconds': self.slowSeconds,
+              'requests': sum(part.requests for part in self.slices),
+              'sampled': sum(part.sampled for part in self.slices),
+              'slow': sum(part.slow for part in self.slices),
+              'stacks': sum(sum(part.stacks.values()) for part in self.slices)})
+
+  def dump(self, directory=None):
+    """Write the window's stats to profile-<time>.pstats and .collapsed
+    files in directory, and return their names"""
+    directory = directory or self.directory or '.'
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    base = os.path.join(directory, 'profile-%s' % time.strftime('%Y%m%d-%H%M%S'))
+    with open(base + '.pstats', 'wb') as f:
+      f.write(self.pstatsBytes())
+    with open(base + '.collapsed', 'w') as f:
+      f.write(self.collapsed())
+    return([base + '.pstats', base + '.collapsed'])
+
+def startProfile():
+  """A running cProfile.Profile, or None if one can't be started (as when
+  another profiler is active)"""
+  profile = cProfile.Profile()
+  try:
+    profile.enable()
+  except ValueError:
+    return(None)
+  return(profile)
+
+def collapse(frame):
+  """A stack as one line, outermost call first"""
+  names = []
+  while frame is not None:
+    code = frame.f_code
+    names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+    frame = frame.f_back
+  names.reverse()
+  return(';'.join(names))
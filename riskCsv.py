@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Bulk reader for routing.csv risk files
+#
+# Each line of a risk file is one edge:
+#
+#   parent,child,risk0,risk1
+#
+# or, as written by loadOsm.routeToCSV with the risks added on the end,
+#
+#   parent,child,parent lat,parent lon,child lat,child lon,risk0,risk1
+#
+# Rather than splitting and converting the file a line at a time, it is read
+# in large chunks of whole lines, and each chunk is converted a column at a
+# time straight into typed arrays.  With NumPy installed, numpy.loadtxt does
+# the parsing; without it, the chunk is split into one flat list of fields
+# and each column converted with one map() over a slice of that list.
+# Either way almost all of the work happens in C.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import sys
+import itertools
+from array import array
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Characters of the file read per chunk
+CHUNK_SIZE = 1 << 23
+
+class RiskColumns:
+  """The edges of a risk file, one typed array per column"""
+  def __init__(self):
+    self.parents = array('q')
+    self.children = array('q')
+    self.risk0 = array('d')
+    self.risk1 = array('d')
+    # parent lat, parent lon, child lat, child lon, if the file has them
+    # and they were asked for
+    self.positions = None
+
+  def __len__(self):
+    return(len(self.parents))
+
+  def nodePositions(self):
+    """{node id: (lat, lon)} from the position columns (None without them)"""
+    if self.positions is None:
+      return(None)
+    parentLat, parentLon, childLat, childLon = self.positions
+    found = dict(zip(self.parents, zip(parentLat, parentLon)))
+    found.update(zip(self.children, zip(childLat, childLon)))
+    return(found)
+
+def readColumns(filename, positions=False, chunkSize=CHUNK_SIZE):
+  """Read a risk file into a RiskColumns.
+
+  With positions set, the lat/lon columns are kept too, provided every
+  line has them."""
+  columns = RiskColumns()
+  if positions:
+    columns.positions = tuple(array('d') for i in range(4))
+  with open(filename, 'r') as f:
+    while True:
+      lines = f.readlines(chunkSize)
+      if not lines:
+        break
+      width = lines[0].count(',') + 1
+      if width < 4 or set(map(str.count, lines, itertools.repeat(','))) != set([width - 1]):
+        # Lines of different lengths, or blank ones
+        addLines(columns, lines)
+        continue
+      if numpy is not None:
+        addTable(columns, lines, width)
+      else:
+        text = ''.join(lines)
+        if not text.endswith('\n'):
+          text = text + '\n'
+        fields = text.replace('\n', ',').split(',')
+        fields.pop()
+        addChunk(columns, fields, width)
+  return(columns)
+
+def addTable(columns, lines, width):
+  """Add a chunk of lines that all have width fields, using NumPy"""
+  names = ['parents', 'children', 'risk0', 'risk1']
+  usecols = [0, 1, width - 2, width - 1]
+  if columns.positions is not None:
+    if width < 8:
+      columns.positions = None
+    else:
+      names = names + ['position%d' % i for i in range(4)]
+      usecols = usecols + [2, 3, 4, 5]
+  dtype = numpy.dtype([(name, 'i8' if i < 2 else 'f8') for (i, name) in enumerate(names)])
+  table = numpy.loadtxt(lines, delimiter=',', usecols=usecols, dtype=dtype, ndmin=1)
+  for name in names[:4]:
+    getattr(columns, name).frombytes(table[name].tobytes())
+  if len(names) > 4:
+    for i, column in enumerate(columns.positions):
+      column.frombytes(table['position%d' % i].tobytes())
+
+def addChunk(columns, fields, width):
+  """Add a chunk of lines that all have width fields"""
+  columns.parents.extend(map(int, fields[0::width]))
+  columns.children.extend(map(int, fields[1::width]))
+  columns.risk0.extend(map(float, fields[width - 2::width]))
+  columns.risk1.extend(map(float, fields[width - 1::width]))
+  if columns.positions is not None:
+    if width < 8:
+      columns.positions = None
+      return
+    for i, column in enumerate(columns.positions):
+      column.extend(map(float, fields[2 + i::width]))
+
+def addLines(columns, lines):
+  """Add lines one at a time, skipping blank ones"""
+  for line in lines:
+    if not line.strip():
+      continue
+    splitLine = line.split(',')
+    columns.parents.append(int(splitLine[0]))
+    columns.children.append(int(splitLine[1]))
+    columns.risk0.append(float(splitLine[-2]))
+    columns.risk1.append(float(splitLine[-1]))
+    if columns.positions is not None:
+      if len(splitLine) < 8:
+        columns.positions = None
+        continue
+      for i, column in enumerate(columns.positions):
+        column.append(float(splitLine[2 + i]))
+
+if __name__ == "__main__":
+  import time
+  start = time.time()
+  columns = readColumns(sys.argv[1])
+  print("Read %d edges in %.3fs" % (len(columns), time.time() - start))
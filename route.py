@@ -5,7 +5,7 @@
 #------------------------------------------------------
 # Usage as library:
 #   datastore = loadOsm('transport type')
-#   router = Router(datastore)
+#   router = Router(data=datastore)
 #   result, route = router.doRoute(node1, node2)
 #
 # (where transport is cycle, foot, car, etc...)
@@ -28,142 +28,934 @@
 import time
 import sys
 import math 
+import heapq
+import threading
 try:
   from .loadOsm import *
+  from .compactGraph import CompactGraph, loadSnapshot
+  from .hierarchy import CustomizableHierarchy
+  from .landmarks import Landmarks
+  from .lruCache import LRUCache
+  from .riskCsv import readColumns
+  from .tiledGraph import TiledGraph, TileStore
+  from .metrics import QueryMetrics
 except (ImportError, SystemError):
   from loadOsm import *
+  from compactGraph import CompactGraph, loadSnapshot
+  from hierarchy import CustomizableHierarchy
+  from landmarks import Landmarks
+  from lruCache import LRUCache
+  from riskCsv import readColumns
+  from tiledGraph import TiledGraph, TileStore
+  from metrics import QueryMetrics
+
+def metres(lat1, lon1, lat2, lon2):
+  """Great-circle distance between two positions, in metres"""
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = math.sin((lat2 - lat1) / 2) ** 2 + \
+      math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+  return(2 * 6371000.0 * math.asin(min(1.0, math.sqrt(a))))
+
+# Most nodes a search may expand, unless told otherwise
+MAX_EXPANDED = 1000000
+# The kinds of search Search.run can do
+SEARCH_MODES = ('forward', 'bidirectional', 'hierarchy')
+
+class Search:
+  """State of one route search.
+
+  A Router's graph, hierarchy and landmarks are only ever read while
+  searching, and everything a search writes lives here, so one Router can
+  run any number of searches at once (e.g. from the server's threads).
+
+  A search gives up ('gave_up') once it has expanded maxExpanded nodes or
+  run for maxSeconds (timed from when it was set up, so whatever the graph
+  does to get its edge costs ready counts too), and notes which in limit.  With partial set, it then
+  returns the route to the node it settled nearest the end instead of
+  nothing, and sets isPartial."""
+  def __init__(self, graph, start, end, alpha, beta, hierarchy=None, landmarks=None,
+               maxExpanded=MAX_EXPANDED, maxSeconds=None, partial=False):
+    self.graph = graph
+    self.start = start
+    self.end = end
+    self.alpha = alpha
+    self.beta = beta
+    self.hierarchy = hierarchy
+    self.landmarks = landmarks
+    self.result = None
+    self.route = []
+    # Counters for the server's metrics: nodes expanded, items pushed onto
+    # the queue(s), and the most items queued at once
+    self.expanded = 0
+    self.pushes = 0
+    self.peakQueue = 0
+    self.maxExpanded = maxExpanded
+    self.deadline = None
+    if maxSeconds is not None:
+      self.deadline = time.time() + maxSeconds
+    self.partial = partial
+    self.limit = None
+    self.isPartial = False
+
+  def run(self, mode='forward'):
+    """Do the routing, returning (result, route).  mode is one of
+    SEARCH_MODES; anything else is a ValueError."""
+    if not mode in SEARCH_MODES:
+      raise ValueError("Unknown search mode %r" % (mode,))
+    graph = self.graph
+    try:
+      start = graph.nodeIndex(self.start)
+      end = graph.nodeIndex(self.end)
+    except KeyError:
+      return(self.finish('no_such_node'))
+    if mode == 'bidirectional':
+      return(self.bidirectional(start, end))
+    if mode == 'hierarchy':
+      return(self.contracted(start, end))
+    if self.landmarks is not None:
+      return(self.landmarkSearch(start, end))
+    return(self.forward(start, end))
+
+  def pushed(self, queued):
+    """Count a push onto a queue, which now holds queued items"""
+    self.pushes = self.pushes + 1
+    if queued > self.peakQueue:
+      self.peakQueue = queued
+
+  def outOfBudget(self):
+    """Has the search used up its expansions or its time?"""
+    if self.expanded >= self.maxExpanded:
+      self.limit = 'expansions'
+      return(True)
+    # Only look at the clock every so often
+    if self.deadline is not None and self.expanded % 64 == 0 and time.time() > self.deadline:
+      self.limit = 'time'
+      return(True)
+    return(False)
+
+  def giveUp(self, closed, parent, end):
+    """Finish a search that is out of budget, with the route (in the tree
+    given by parent) to the closed node nearest end if partial is set"""
+    if not self.partial or not closed:
+      return(self.finish('gave_up'))
+    nearest = min(closed, key=lambda x: self.distance(x, end))
+    self.parent = parent
+    self.isPartial = True
+    return(self.finish('gave_up', self.buildRoute(nearest)))
+
+  def finish(self, result, route=None):
+    self.result = result
+    self.route = route or []
+    return(self.result, self.route)
 
-class Router:
-  def __init__(self):
-    data = LoadOsm("foot")
-    file_name = "lowertown.osm"
-    data.loadOsm(file_name)
-    riskFile= 'routing.csv'
-    data.readInRisk(riskFile)
-    self.data = data
-    self.alpha=1
-    self.beta=.1
   def distance(self,n1,n2):
     """Calculate distance between two nodes"""
-    lat1 = self.data.rnodes[n1][0]
-    lon1 = self.data.rnodes[n1][1]
-    lat2 = self.data.rnodes[n2][0]
-    lon2 = self.data.rnodes[n2][1]
+    lat1, lon1 = self.graph.position(n1)
+    lat2, lon2 = self.graph.position(n2)
     # TODO: projection issues
     dlat = lat2 - lat1
     dlon = lon2 - lon1
     dist2 = dlat * dlat + dlon * dlon
     dist = math.sqrt(dist2)
     return(dist)
-  
-  def doRoute(self,start,end):
-    """Do the routing"""
+
+  def forward(self,start,end):
+    """Search outwards from start, in order of maxdistance"""
+    graph = self.graph
+    weighting = graph.weighting(self.alpha, self.beta)
     self.searchEnd = end
-    closed = [start]
+    closed = set([start])
+    # Binary heap of (maxdistance, sequence, distance, node).  The sequence
+    # number keeps equal-cost items in insertion order, as the old sorted
+    # list did.
     self.queue = []
+    self.sequence = 0
+    # Predecessor of every node that has been queued; a node is queued at
+    # most once, so this is also the route tree of the search
+    self.parent = {start: None}
     
     # Start by queueing all outbound links from the start node
-    blankQueueItem = {'end':-1,'distance':0,'nodes':str(start)}
-    print("Starting Node: " + str(start))
+    print("Starting Node: " + str(graph.nodeId(start)))
     try:
-      for i, weight in self.data.routing[start].items():
-        self.addToQueue(start,i, blankQueueItem, weight)
+      for i, distance in graph.neighbours(start, weighting):
+        self.addToQueue(start,i, 0, distance)
     except KeyError:
-      return('no_such_node',[])
+      return(self.finish('no_such_node'))
 
-    # Limit for how long it will search
-    count = 0
-    while count < 1000000:
-      count = count + 1
+    while True:
+      if self.outOfBudget():
+        return(self.giveUp(closed, self.parent, end))
       try:
-        nextItem = self.queue.pop(0)
+        maxdistance, sequence, distance, x = heapq.heappop(self.queue)
       except IndexError:
         # Queue is empty: failed
         # TODO: return partial route?
-        return('no_route',[])
-      x = nextItem['end']
+        return(self.finish('no_route'))
       if x in closed:
         continue
       if x == end:
         # Found the end node - success
-        routeNodes = [int(i) for i in nextItem['nodes'].split(",")]
-        return('success', routeNodes)
-      closed.append(x)
+        return(self.finish('success', self.buildRoute(x)))
+      closed.add(x)
+      self.expanded = self.expanded + 1
       try:
-        for i, weight in self.data.routing[x].items():
+        for i, cost in graph.neighbours(x, weighting):
           if not i in closed:
-            self.addToQueue(x,i,nextItem, weight)
+            self.addToQueue(x,i,distance, cost)
       except KeyError:
         pass
-    else:
-      return('gave_up',[])
-  
-  def addToQueue(self,start,end, queueSoFar, weight = 1):
+
+  def addToQueue(self,start,end, distanceSoFar, distance):
     """Add another potential route to the queue"""
 
-    # getArea() checks that map data is available around the end-point,
-    # and downloads it if necessary
-    #
-    # TODO: we could reduce downloads even more by only getting data around
-    # the tip of the route, rather than around all nodes linked from the tip
-    end_pos = self.data.rnodes[end]
-    #self.data.getArea(end_pos[0], end_pos[1])
+    # With a TiledGraph, map data around the end-point is loaded (from the
+    # tile cache) as soon as anything asks for it, position() included
     
     # If already in queue, ignore
-    for test in self.queue:
-      if test['end'] == end:
-        return
-    if(weight == 0):
+    if end in self.parent:
       return
     ##Weight will be "risk-value" precalculated by kernel clutsering and will be factors in
       #by (alpha*distance+beta*weight)^.5
      ##Distance precalculated on each edge and risk too
-    alpha=1
-    beta=.1
-    #distance = alpha*self.distance(start,end)+beta*self.data.routing[start][end][1]
-    distance = self.alpha*math.exp(self.data.routing[start][end][0])+self.beta*math.exp(self.data.routing[start][end][1])
-    # Create a hash for all the route's attributes
-    distanceSoFar = queueSoFar['distance']
-    queueItem = { \
-      'distance': distanceSoFar + distance,
-      'maxdistance': distanceSoFar + self.distance(end, self.searchEnd),
-      'nodes': queueSoFar['nodes'] + "," + str(end),
-      'end': end}
+    # distance is alpha*exp(risk0)+beta*exp(risk1), worked out by the graph
+    maxdistance = distanceSoFar + self.distance(end, self.searchEnd)
     
-    # Try to insert, keeping the queue ordered by decreasing worst-case distance
-    count = 0
-    for test in self.queue:
-      if test['maxdistance'] > queueItem['maxdistance']:
-        self.queue.insert(count,queueItem)
+    # Keep the queue ordered by increasing worst-case distance
+    self.sequence = self.sequence + 1
+    heapq.heappush(self.queue, (maxdistance, self.sequence, distanceSoFar + distance, end))
+    self.pushed(len(self.queue))
+    self.parent[end] = start
+
+  def buildRoute(self, end):
+    """Follow the predecessor links back from end to the start node"""
+    routeNodes = []
+    node = end
+    while node is not None:
+      routeNodes.append(self.graph.nodeId(node))
+      node = self.parent[node]
+    routeNodes.reverse()
+    return(routeNodes)
+
+  def landmarkSearch(self,start,end):
+    """A* guided by the landmark lower bounds.
+
+    The bounds are admissible and consistent, so the first time end comes
+    off the queue its route is the cheapest one."""
+    graph = self.graph
+    weighting = graph.weighting(self.alpha, self.beta)
+    bound = self.landmarks.heuristic(end, self.alpha, self.beta)
+    best = {start: 0.0}
+    self.parent = {start: None}
+    self.queue = [(bound(start), 0.0, start)]
+    closed = set()
+    while self.queue:
+      if self.outOfBudget():
+        return(self.giveUp(closed, self.parent, end))
+      estimate, distance, x = heapq.heappop(self.queue)
+      if x in closed:
+        continue
+      if x == end:
+        return(self.finish('success', self.buildRoute(x)))
+      closed.add(x)
+      self.expanded = self.expanded + 1
+      for i, cost in graph.neighbours(x, weighting):
+        if i in closed:
+          continue
+        total = distance + cost
+        if total < best.get(i, float('inf')):
+          remaining = bound(i)
+          if remaining == float('inf'):
+            continue
+          best[i] = total
+          self.parent[i] = x
+          heapq.heappush(self.queue, (total + remaining, total, i))
+          self.pushed(len(self.queue))
+    return(self.finish('no_route'))
+
+  def bidirectional(self,start,end):
+    """Dijkstra searches from each end.
+
+    The forward search follows links out of start and the backward search
+    follows links into end, always expanding whichever side has the smaller
+    queue head.  Once the two heads add up to no less than the cheapest
+    route found where the searches meet, that route is optimal."""
+    graph = self.graph
+    weighting = graph.weighting(self.alpha, self.beta)
+    expand = (graph.neighbours, graph.reverseNeighbours)
+    dist = ({start: 0.0}, {end: 0.0})
+    parent = ({start: None}, {end: None})
+    closed = (set(), set())
+    queues = ([(0.0, start)], [(0.0, end)])
+    best = float('inf')
+    meet = None
+    if start == end:
+      best = 0.0
+      meet = start
+
+    while queues[0] and queues[1]:
+      if queues[0][0][0] + queues[1][0][0] >= best:
         break
-      count = count + 1
+      if self.outOfBudget():
+        return(self.giveUp(closed[0], parent[0], end))
+      side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+      distance, x = heapq.heappop(queues[side])
+      if x in closed[side]:
+        continue
+      closed[side].add(x)
+      self.expanded = self.expanded + 1
+      mine = dist[side]
+      other = dist[1 - side]
+      try:
+        for i, cost in expand[side](x, weighting):
+          total = distance + cost
+          if total < mine.get(i, best):
+            mine[i] = total
+            parent[side][i] = x
+            heapq.heappush(queues[side], (total, i))
+            self.pushed(len(queues[0]) + len(queues[1]))
+            if i in other and total + other[i] < best:
+              best = total + other[i]
+              meet = i
+      except KeyError:
+        pass
+
+    if meet is None:
+      return(self.finish('no_route'))
+    routeNodes = []
+    node = meet
+    while node is not None:
+      routeNodes.append(graph.nodeId(node))
+      node = parent[0][node]
+    routeNodes.reverse()
+    node = parent[1][meet]
+    while node is not None:
+      routeNodes.append(graph.nodeId(node))
+      node = parent[1][node]
+    return(self.finish('success', routeNodes))
+
+  def toMany(self, targets):
+    """Dijkstra from the start node until every one of targets (dense
+    indices) is settled, or nothing more can be reached.
+
+    Returns dicts of cost, length in metres, and predecessor for each
+    node reached; the routes to settled targets are the cheapest ones."""
+    graph = self.graph
+    weighting = graph.weighting(self.alpha, self.beta)
+    start = graph.nodeIndex(self.start)
+    cost = {start: 0.0}
+    length = {start: 0.0}
+    self.parent = {start: None}
+    remaining = set(targets)
+    closed = set()
+    queue = [(0.0, start)]
+    while queue and remaining:
+      distance, x = heapq.heappop(queue)
+      if x in closed:
+        continue
+      closed.add(x)
+      remaining.discard(x)
+      self.expanded = self.expanded + 1
+      if not remaining:
+        break
+      xlat, xlon = graph.position(x)
+      try:
+        for i, edge in graph.neighbours(x, weighting):
+          total = distance + edge
+          if total < cost.get(i, float('inf')):
+            cost[i] = total
+            lat, lon = graph.position(i)
+            length[i] = length[x] + metres(xlat, xlon, lat, lon)
+            self.parent[i] = x
+            heapq.heappush(queue, (total, i))
+            self.pushed(len(queue))
+      except KeyError:
+        pass
+    self.closed = closed
+    return(cost, length, self.parent)
+
+  def pareto(self, start, end, epsilon=0.0, maxLabels=None):
+    """Multi-criteria label-setting search on the two risk columns.
+
+    Every node keeps a bag of labels (cost0, cost1) that don't dominate
+    each other, where costN is the sum of exp(riskN) along the route.
+    Labels are settled in lexicographic order, so a settled label is never
+    dominated later.  The labels reaching end give every Pareto-optimal
+    route: the cheapest route for any alpha/beta is among them.
+
+    For a bounded search, epsilon > 0 drops a label if another is within a
+    factor (1+epsilon) of it on both costs, and maxLabels caps the labels
+    kept at any one node.  Each dropped label is close to one that is kept,
+    but the slack can add up along a route, so the result is a good
+    approximation rather than a guaranteed one.  Returns a list of
+    (cost0, cost1, route), by increasing cost0."""
+    graph = self.graph
+    columns = (graph.weighting(1.0, 0.0), graph.weighting(0.0, 1.0))
+    scale = 1.0 + epsilon
+    # label id -> (cost0, cost1, node, parent label id)
+    labels = [(0.0, 0.0, start, -1)]
+    dead = set()
+    bags = {start: [0]}
+    found = []
+    queue = [(0.0, 0.0, 0)]
+
+    def dominated(bag, c0, c1):
+      for l in bag:
+        if labels[l][0] <= c0 * scale and labels[l][1] <= c1 * scale:
+          return(True)
+      return(False)
+
+    while queue:
+      if self.outOfBudget():
+        self.result = 'gave_up'
+        break
+      c0, c1, l = heapq.heappop(queue)
+      if l in dead:
+        continue
+      x = labels[l][2]
+      if x == end:
+        found.append(l)
+        continue
+      if dominated(found, c0, c1):
+        continue
+      self.expanded = self.expanded + 1
+      try:
+        for (i, e0), (j, e1) in zip(graph.neighbours(x, columns[0]), graph.neighbours(x, columns[1])):
+          n0 = c0 + e0
+          n1 = c1 + e1
+          if dominated(found, n0, n1):
+            continue
+          bag = bags.setdefault(i, [])
+          if dominated(bag, n0, n1):
+            continue
+          # Drop the labels the new one dominates
+          keep = []
+          for k in bag:
+            if n0 <= labels[k][0] and n1 <= labels[k][1]:
+              dead.add(k)
+            else:
+              keep.append(k)
+          if maxLabels is not None and len(keep) >= maxLabels:
+            bags[i] = keep
+            continue
+          keep.append(len(labels))
+          bags[i] = keep
+          labels.append((n0, n1, i, l))
+          heapq.heappush(queue, (n0, n1, len(labels) - 1))
+          self.pushed(len(queue))
+      except KeyError:
+        pass
+
+    routes = []
+    for l in found:
+      c0, c1 = labels[l][0], labels[l][1]
+      route = []
+      while l >= 0:
+        route.append(graph.nodeId(labels[l][2]))
+        l = labels[l][3]
+      route.reverse()
+      routes.append((c0, c1, route))
+    if self.result is None:
+      self.result = 'success' if routes else 'no_route'
+    self.route = routes
+    return(routes)
+
+  def contracted(self,start,end):
+    """Query the contraction hierarchy"""
+    if self.hierarchy is None:
+      return(self.finish('no_hierarchy'))
+    cost, route = self.hierarchy.query(start, end, self.alpha, self.beta)
+    if not route:
+      return(self.finish('no_route'))
+    return(self.finish('success', [self.graph.nodeId(i) for i in route]))
+
+def tighter(limit, requested):
+  """The smaller of two limits, where None is no limit"""
+  if requested is None:
+    return(limit)
+  if limit is None:
+    return(requested)
+  return(min(limit, requested))
+
+class Dataset:
+  """One version of the routing data, and everything built from it.
+
+  A Router swaps in a whole new Dataset when its risk data is reloaded, so
+  a query that has already picked up the old one finishes on it.
+
+  LoadOsm.readInRisk can also reload the risks of data in place.  Each
+  time it does, data.riskVersion goes up, and so does version."""
+  def __init__(self, data, graph, hierarchy=None, landmarks=None, version=0):
+    self.data = data
+    self.graph = graph
+    self.hierarchy = hierarchy
+    self.landmarks = landmarks
+    self.baseVersion = version
+    self.dataVersion = data.riskVersion if data is not None else 0
+
+  @property
+  def version(self):
+    if self.data is None:
+      return(self.baseVersion)
+    return(self.baseVersion + self.data.riskVersion - self.dataVersion)
+
+class Router:
+  def __init__(self, compact=False, snapshot=None, hierarchy=False, landmarks=False,
+               cacheSize=1024, cacheTTL=300, tiles=None, tileBudget=256 << 20,
+               osmFile="lowertown.osm", riskFile='routing.csv', data=None, landmarkCount=6,
+               verifySnapshot=False):
+    # Default weights, for searches that don't give their own
+    self.alpha=1
+    self.beta=.1
+    file_name = osmFile
+    self.riskFile = riskFile
+    self.landmarksFile = None
+    self.landmarkCount = landmarkCount
+    if tiles and (compact or snapshot or hierarchy or landmarks):
+      raise ValueError("Tiles can't be combined with compact, snapshot, hierarchy or landmarks")
+    if tiles:
+      # Load map tiles from the tiles directory as searches reach them,
+      # keeping at most about tileBudget bytes of them
+      store = TileStore(tiles, "foot", tileBudget)
+      self.dataset = Dataset(None, TiledGraph(store, readRisk(riskFile)))
+    elif snapshot:
+      # Map a prebuilt compact graph, (re)building it if it is stale (or,
+      # with verifySnapshot, if its checksum is wrong)
+      self.dataset = Dataset(None, loadSnapshot(snapshot, file_name, riskFile, "foot", verifySnapshot))
+    else:
+      if data is None:
+        data = LoadOsm("foot")
+        data.loadOsm(file_name)
+        data.readInRisk(riskFile)
+      self.dataset = Dataset(data, data)
+      if compact:
+        self.useCompactGraph()
+    if hierarchy:
+      self.useHierarchy()
+    if landmarks:
+      self.useLandmarks()
+    # Results of recent searches, keyed by snapped end nodes and weights
+    self.cache = LRUCache(cacheSize, cacheTTL)
+    self.cacheVersion = self.riskVersion()
+    # Totals of each query's figures, for the server's /metrics page
+    self.metrics = QueryMetrics()
+    # Risk reloads run one at a time, in the background
+    self.reloadLock = threading.Lock()
+    self.reloadState = {'state': 'idle', 'version': self.riskVersion(),
+                        'file': riskFile, 'delta': False, 'error': None}
+    # Default search budget (see Search); a query can ask for less
+    self.maxExpanded = MAX_EXPANDED
+    self.maxSeconds = None
+    self.prepareGraph(self.graph)
+
+  # The current dataset's parts.  A query should read self.dataset once and
+  # use that throughout, in case a reload swaps it part way through
+  @property
+  def data(self):
+    return(self.dataset.data)
+
+  @property
+  def graph(self):
+    return(self.dataset.graph)
+
+  @property
+  def hierarchy(self):
+    return(self.dataset.hierarchy)
+
+  @property
+  def landmarks(self):
+    return(self.dataset.landmarks)
+
+  def useCompactGraph(self):
+    """Search an array-backed copy of the graph instead of the dicts.  The
+    router lets go of the dicts (LoadOsm) once the copy is built, so they
+    can be freed: the compact graph has its own node lookup, and a risk
+    reload builds on the compact graph.  So data is None from then on, and
+    risks can't be reloaded in place with data.readInRisk."""
+    dataset = self.dataset
+    if isinstance(dataset.graph, TiledGraph):
+      raise ValueError("A tiled graph is only ever partly loaded, so it has no compact form")
+    graph = CompactGraph.fromLoadOsm(dataset.data)
+    self.prepareGraph(graph)
+    self.dataset = Dataset(None, graph, version=dataset.version)
+
+  def prepareGraph(self, graph):
+    """Build a compact graph's cost array for the default weights ahead of
+    the queries that use them.  Queries with other weights work out the
+    costs of just the edges they reach (see compactGraph.EdgeCosts)."""
+    if isinstance(graph, CompactGraph):
+      graph.costArray(self.alpha, self.beta)
+
+  def useHierarchy(self):
+    """Preprocess a contraction hierarchy and route through it from now on.
+
+    This swaps in a new dataset, so it is meant to be called while setting
+    the router up, not while it is serving queries."""
+    if not isinstance(self.graph, CompactGraph):
+      self.useCompactGraph()
+    dataset = self.dataset
+    self.dataset = Dataset(dataset.data, dataset.graph, CustomizableHierarchy(dataset.graph),
+                           dataset.landmarks, dataset.version)
+
+  def useLandmarks(self, filename=None, count=None):
+    """Load (or build and save) tables for count landmarks (by default the
+    router's landmarkCount), and search with A* on their lower bounds from
+    now on.  They are kept next to the risk file by default."""
+    if not isinstance(self.graph, CompactGraph):
+      self.useCompactGraph()
+    if filename is None:
+      filename = self.riskFile + '.landmarks'
+    if count is not None:
+      self.landmarkCount = count
+    self.landmarksFile = filename
+    dataset = self.dataset
+    landmarks = Landmarks.loadOrBuild(filename, dataset.graph, self.landmarkCount)
+    self.dataset = Dataset(dataset.data, dataset.graph, dataset.hierarchy, landmarks, dataset.version)
+
+  def riskVersion(self):
+    """Version of the loaded risk data, counting up from 0 with each reload"""
+    return(self.dataset.version)
+
+  def reloadRisk(self, filename=None, delta=False, wait=False, done=None):
+    """Load new risk data and swap it in once it is ready.
+
+    filename is a risk file in the format of routing.csv (by default the
+    one loaded at start up), or with delta set, a file of just the edges
+    that changed.  The loading happens in a background thread unless wait
+    is set, while queries carry on with the old data; done, if given, is
+    called with the new version after the swap.  Returns False if a reload
+    is already under way."""
+    if not self.reloadLock.acquire(False):
+      return(False)
+    if filename is None:
+      filename = self.riskFile
+    self.reloadState = {'state': 'loading', 'version': self.riskVersion(),
+                        'file': filename, 'delta': bool(delta), 'error': None}
+    def reload():
+      try:
+        dataset = self.loadRisk(filename, delta)
+        self.dataset = dataset
+        self.reloadState = {'state': 'idle', 'version': dataset.version,
+                            'file': filename, 'delta': bool(delta), 'error': None}
+      except Exception as e:
+        self.reloadState = {'state': 'failed', 'version': self.riskVersion(),
+                            'file': filename, 'delta': bool(delta), 'error': str(e)}
+        return
+      finally:
+        self.reloadLock.release()
+      if done is not None:
+        done(dataset.version)
+    if wait:
+      reload()
+    else:
+      thread = threading.Thread(target=reload, name='reloadRisk')
+      thread.daemon = True
+      thread.start()
+    return(True)
+
+  def loadRisk(self, filename, delta=False):
+    """A new Dataset like the current one, with the risk data from
+    filename (or changed by it, if delta is set)"""
+    old = self.dataset
+    if old.data is not None:
+      changes = readRisk(filename)
+      routing = mergeRisk(old.data.routing, changes) if delta else changes
+      data = old.data.withRisk(routing)
+      graph = data
+      if isinstance(old.graph, CompactGraph):
+        graph = old.graph.withRisk(routing)
+    elif delta:
+      # A graph mapped from a snapshot, or tiles, with no LoadOsm behind it
+      data = None
+      graph = old.graph.withRisk(mergeRisk(old.graph.routing(), readRisk(filename)))
+    elif isinstance(old.graph, CompactGraph):
+      data = None
+      graph = old.graph.withRiskColumns(readColumns(filename))
     else:
-      self.queue.append(queueItem)
+      data = None
+      graph = old.graph.withRisk(readRisk(filename))
+    hierarchy = None
+    if old.hierarchy is not None:
+      if graph.sameEdges(old.graph):
+        # Only the risks changed, so only the customization is redone
+        hierarchy = old.hierarchy.withGraph(graph)
+      else:
+        hierarchy = CustomizableHierarchy(graph)
+    landmarks = None
+    if old.landmarks is not None:
+      landmarks = Landmarks.loadOrBuild(self.landmarksFile, graph, self.landmarkCount)
+    self.prepareGraph(graph)
+    return(Dataset(data, graph, hierarchy, landmarks, old.version + 1))
+
+  def search(self, start, end, alpha=None, beta=None, mode='forward', dataset=None,
+             maxExpanded=None, maxSeconds=None, partial=False):
+    """Run a search between two nodes, and return its Search state.
+
+    The search's budget is the router's, or any smaller one given.  The
+    hierarchy mode needs a hierarchy built beforehand (see useHierarchy);
+    without one, the search's result is 'no_hierarchy'."""
+    if alpha is None:
+      alpha = self.alpha
+    if beta is None:
+      beta = self.beta
+    maxExpanded = tighter(self.maxExpanded, maxExpanded)
+    maxSeconds = tighter(self.maxSeconds, maxSeconds)
+    if dataset is None:
+      dataset = self.dataset
+    search = Search(dataset.graph, start, end, alpha, beta, dataset.hierarchy, dataset.landmarks,
+                    maxExpanded, maxSeconds, partial)
+    search.run(mode)
+    return(search)
+
+  def doRoute(self,start,end,alpha=None,beta=None):
+    """Do the routing"""
+    search = self.search(start, end, alpha, beta)
+    return(search.result, search.route)
 
-  def getRoutes(self,source_lat,source_long,dest_lat,dest_long, alpha, beta):
+  def doRouteBidirectional(self,start,end,alpha=None,beta=None):
+    """Do the routing with a Dijkstra search from each end"""
+    search = self.search(start, end, alpha, beta, 'bidirectional')
+    return(search.result, search.route)
+
+  def doRouteHierarchy(self,start,end,alpha=None,beta=None):
+    """Do the routing with the contraction hierarchy"""
+    search = self.search(start, end, alpha, beta, 'hierarchy')
+    return(search.result, search.route)
+
+  def cachedRoute(self, mode, node1, node2, alpha, beta, dataset=None, stats=None, limits=None):
+    """Search for a route, or reuse the result of the same search.
+
+    limits holds any of search's maxExpanded, maxSeconds and partial.  If
+    a stats dict is given, whether the route was cached, the search's
+    counters, and the limit it hit and whether its route is partial are
+    put in it.  Searches that hit a limit aren't cached."""
+    # Leave out the limits that weren't set, so those queries share keys
+    limits = dict((name, value) for (name, value) in (limits or {}).items()
+                  if value is not None and value is not False)
+    if dataset is None:
+      dataset = self.dataset
+    if dataset.version > self.cacheVersion:
+      # The risk data was reloaded, so every cached route may be wrong
+      self.cache.clear()
+      self.cacheVersion = dataset.version
+    # The version is part of the key, so queries still running on old data
+    # can't leave routes behind for the new
+    key = (dataset.version, mode, node1, node2, alpha, beta, tuple(sorted(limits.items())))
+    found = self.cache.get(key)
+    if stats is not None:
+      stats['cached'] = found is not None
+    if found is not None:
+      return(found)
+    search = self.search(node1, node2, alpha, beta, mode, dataset, **limits)
+    if stats is not None:
+      stats['expanded'] = search.expanded
+      stats['pushes'] = search.pushes
+      stats['peakQueue'] = search.peakQueue
+      stats['limit'] = search.limit
+      stats['partial'] = search.isPartial
+    found = (search.result, search.route)
+    if search.limit is None:
+      self.cache.put(key, found)
+    return(found)
+
+  def distance(self,n1,n2):
+    """Calculate distance between two nodes"""
+    return(Search(self.graph, n1, n2, self.alpha, self.beta).distance(n1, n2))
+
+  def getRoutes(self,source_lat,source_long,dest_lat,dest_long, alpha, beta, mode=None, stats=None,
+                maxExpanded=None, maxSeconds=None, partial=False):
+    """Route between two positions.
+
+    mode picks the search: 'forward' (doRoute), 'bidirectional' or
+    'hierarchy'.  By default the hierarchy is used if one has been built.
+    maxExpanded and maxSeconds lower the search's budget, and with partial
+    set a search that runs out of it returns the route as far as it got.
+
+    The query's figures (see metrics), including its status, the limit it
+    hit and whether the route is partial, are added to self.metrics, and
+    put in stats too if it is given."""
+    began = time.time()
+    if stats is None:
+      stats = {}
     source_lat = float(source_lat)
     source_long = float(source_long)
     dest_lat = float(dest_lat)
     dest_long = float(dest_long)
-    self.alpha = float(alpha)
-    self.beta= float(beta)
+    alpha = float(alpha)
+    beta= float(beta)
  
     #print(source_lat, source_long, dest_lat, dest_long) 
     start = (source_lat, source_long)
     end = (dest_lat, dest_long)
-    node1 = self.data.findNode(start[0],start[1])
-    node2 = self.data.findNode(end[0],end[1])
-    result, route = self.doRoute(node1, node2)
+    dataset = self.dataset
+    graph = dataset.graph
+    if isinstance(graph, TiledGraph):
+      # Start loading the tiles between the two ends
+      graph.prefetch(source_lat, source_long, dest_lat, dest_long)
+    node1 = graph.findNode(start[0],start[1])
+    node2 = graph.findNode(end[0],end[1])
+    stats['seconds'] = {'findNode': time.time() - began}
+    limits = {'maxExpanded': maxExpanded, 'maxSeconds': maxSeconds, 'partial': bool(partial)}
+    result, steps = self.routeSteps(dataset, node1, node2, alpha, beta, mode, stats, limits)
+    if result != 'success':
+      print("Failed (%s)" % result)
+    stats['seconds']['total'] = time.time() - began
+    self.metrics.record(stats)
+
+    return steps 
+
+  def routeSteps(self, dataset, node1, node2, alpha, beta, mode=None, stats=None, limits=None):
+    """Route between two snapped nodes, as (result, list of [lat, lon]).
+
+    limits are as for cachedRoute.  If a stats dict is given, the result,
+    the search's counters and the time spent searching and building the
+    path are put in it."""
+    if mode is None:
+      mode = 'forward' if dataset.hierarchy is None else 'hierarchy'
+    began = time.time()
+    result, route = self.cachedRoute(mode, node1, node2, alpha, beta, dataset, stats, limits)
+    searched = time.time()
+    graph = dataset.graph
     
     steps=[]
-    if result == 'success':
-      # list the nodes
+    if route:
+      # list the nodes (of a partial route too, if that's what we have)
 
       for i in route:
-        node = self.data.rnodes[i]
+        node = graph.position(graph.nodeIndex(i))
         #print("%f,%f" % (node[0],node[1]))
         steps.append([node[0],node[1]])
-    else:
-      print("Failed (%s)" % result)
+    if stats is not None:
+      stats['status'] = result
+      seconds = stats.setdefault('seconds', {})
+      seconds['search'] = searched - began
+      seconds['path'] = time.time() - searched
+    return(result, steps)
 
-    return steps 
+  def getMatrix(self, origins, destinations, alpha=1, beta=.1, paths=False):
+    """Costs between every origin and every destination ((lat, lon) pairs).
+
+    Runs one search per origin, each stopping as soon as all the
+    destinations are settled.  Returns a dict holding the snapped
+    'origins' and 'destinations' (OSM ids), and 'costs' and 'lengths'
+    (metres) as lists of rows, one row per origin, with None where there
+    is no route, so that it is ready to send as JSON.  With paths set,
+    'paths' also holds each route's node ids."""
+    graph = self.graph
+    alpha = float(alpha)
+    beta = float(beta)
+    points = [(float(lat), float(lon)) for (lat, lon) in list(origins) + list(destinations)]
+    nodes = graph.findNodes(points)
+    fromNodes = nodes[:len(origins)]
+    toNodes = nodes[len(origins):]
+    targets = [graph.nodeIndex(n) for n in toNodes if n is not None]
+    matrix = {'origins': fromNodes, 'destinations': toNodes, 'costs': [], 'lengths': []}
+    if paths:
+      matrix['paths'] = []
+    for origin in fromNodes:
+      costRow = [None] * len(toNodes)
+      lengthRow = [None] * len(toNodes)
+      pathRow = [None] * len(toNodes)
+      if origin is not None:
+        search = Search(graph, origin, None, alpha, beta)
+        cost, length, parent = search.toMany(targets)
+        for j, node in enumerate(toNodes):
+          if node is None:
+            continue
+          i = graph.nodeIndex(node)
+          if not i in search.closed:
+            continue
+          costRow[j] = cost[i]
+          lengthRow[j] = length[i]
+          if paths:
+            route = []
+            while i is not None:
+              route.append(graph.nodeId(i))
+              i = parent[i]
+            route.reverse()
+            pathRow[j] = route
+      matrix['costs'].append(costRow)
+      matrix['lengths'].append(lengthRow)
+      if paths:
+        matrix['paths'].append(pathRow)
+    return(matrix)
+
+  def getParetoRoutes(self, source_lat, source_long, dest_lat, dest_long,
+                      epsilon=0.0, maxLabels=None, stats=None, maxExpanded=None, maxSeconds=None):
+    """Every route between two positions that is cheapest for some
+    alpha/beta, from a single search (see Search.pareto).
+
+    Returns (result, routes), where each route is a dict with 'cost0' and
+    'cost1' (its totals of exp(risk0) and exp(risk1), so it costs
+    alpha*cost0 + beta*cost1) and 'coords'.  The search has the same
+    budget as search gives a route search; if it runs out, the result is
+    'gave_up' and routes holds the routes found by then.  If a stats dict
+    is given, the search's counters and the limit it hit are put in it."""
+    graph = self.graph
+    node1 = graph.findNode(float(source_lat), float(source_long))
+    node2 = graph.findNode(float(dest_lat), float(dest_long))
+    search = Search(graph, node1, node2, self.alpha, self.beta,
+                    maxExpanded=tighter(self.maxExpanded, maxExpanded),
+                    maxSeconds=tighter(self.maxSeconds, maxSeconds))
+    try:
+      start = graph.nodeIndex(node1)
+      end = graph.nodeIndex(node2)
+    except KeyError:
+      return('no_such_node', [])
+    routes = []
+    for cost0, cost1, route in search.pareto(start, end, epsilon, maxLabels):
+      coords = [list(graph.position(graph.nodeIndex(i))) for i in route]
+      routes.append({'cost0': cost0, 'cost1': cost1, 'coords': coords})
+    if stats is not None:
+      stats['expanded'] = search.expanded
+      stats['pushes'] = search.pushes
+      stats['peakQueue'] = search.peakQueue
+      stats['limit'] = search.limit
+    return(search.result, routes)
+
+  def getRoutesBatch(self, queries, alpha=1, beta=.1, mode=None, stats=None):
+    """Route many origin/destination pairs at once.
+
+    Each query is a dict with curr_lat, curr_lng, dest_lat and dest_lng (the
+    same names /query takes) and optionally its own alpha and beta.  All
+    end points are snapped in one pass, then the searches run one after
+    another: they are pure Python, so threads would only take turns, and a
+    RouterPool shares a batch out among processes instead.  Returns one
+    dict per query, in order, with the search's 'status' and the route's
+    'coords' ('bad_query' and None for a query that can't be read).
+
+    Each query's figures are added to self.metrics, and appended to stats
+    if it is a list.  The end points are snapped together, so there is no
+    findNode time for each query."""
+    dataset = self.dataset
+    graph = dataset.graph
+    parsed = []
+    points = []
+    for query in queries:
+      try:
+        weights = (float(query.get('alpha', alpha)), float(query.get('beta', beta)))
+        ends = [(float(query['curr_lat']), float(query['curr_lng'])),
+                (float(query['dest_lat']), float(query['dest_lng']))]
+      except (KeyError, TypeError, ValueError, AttributeError):
+        weights = None
+        ends = [(0.0, 0.0), (0.0, 0.0)]
+      parsed.append(weights)
+      points.extend(ends)
+    nodes = graph.findNodes(points)
+
+    def route(i):
+      if parsed[i] is None:
+        return({'status': 'bad_query', 'coords': None})
+      began = time.time()
+      figures = {}
+      try:
+        result, steps = self.routeSteps(dataset, nodes[2 * i], nodes[2 * i + 1],
+                                        parsed[i][0], parsed[i][1], mode, figures)
+      except Exception as e:
+        return({'status': 'error', 'coords': None, 'error': str(e)})
+      figures['seconds']['total'] = time.time() - began
+      self.metrics.record(figures)
+      if stats is not None:
+        stats.append(figures)
+      return({'status': result, 'coords': steps})
+
+    return([route(i) for i in range(len(parsed))])
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Serve routing queries from several worker processes
+#
+#------------------------------------------------------
+# Usage as library:
+#   router = Router(snapshot='graph.snapshot')
+#   pool = RouterPool(router, 4)
+#   steps = pool.getRoutes(lat1, lon1, lat2, lon2, alpha, beta)
+#
+# The graph is loaded once, in the parent, and the workers are then
+# forked from it, so they all share the parent's copy of the graph
+# (copy-on-write) instead of loading their own.  A graph mapped from
+# a snapshot is shared outright, through the page cache, and never
+# gets copied however long the workers run.
+#
+# A server hands out its pool through a PoolKeeper, which forks a new
+# pool (after a risk reload, say) only while no request is using the
+# router, and closes the old one once nothing can still be using it.
+#------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------
+import gc
+import threading
+import contextlib
+import multiprocessing
+
+# The router the workers inherit when they are forked
+sharedRouter = None
+
+def workerStart():
+  """A pool can be forked while other threads are using the router (after
+  a risk reload, say), and any lock they hold stays held in the worker, so
+  give the worker's caches and metrics new locks"""
+  dataset = sharedRouter.dataset
+  for cache in (sharedRouter.cache, sharedRouter.metrics, getattr(dataset.graph, 'costs', None),
+                getattr(dataset.hierarchy, 'metrics', None)):
+    if cache is not None:
+      cache.lock = threading.Lock()
+
+# The workers' metrics stay in the workers, so they send each query's
+# figures back with its result, for the parent's router to add up
+
+def workerGetRoutes(args):
+  args, limits = args
+  stats = {}
+  return(sharedRouter.getRoutes(*args, stats=stats, **limits), stats)
+
+def workerGetRoutesBatch(args):
+  queries, alpha, beta, mode = args
+  stats = []
+  return(sharedRouter.getRoutesBatch(queries, alpha, beta, mode, stats=stats), stats)
+
+def workerGetMatrix(args):
+  return(sharedRouter.getMatrix(*args))
+
+def workerGetParetoRoutes(args):
+  args, limits = args
+  stats = {}
+  return(sharedRouter.getParetoRoutes(*args, stats=stats, **limits), stats)
+
+class RouterPool:
+  """Pool of forked worker processes that run a shared Router's queries"""
+  def __init__(self, router, processes=None):
+    global sharedRouter
+    sharedRouter = router
+    self.router = router
+    if hasattr(gc, 'freeze'):
+      # Keep the garbage collector from touching (and so copying) the
+      # pages holding the graph in every worker
+      gc.collect()
+      gc.freeze()
+    context = multiprocessing.get_context('fork')
+    self.processes = processes or multiprocessing.cpu_count()
+    self.pool = context.Pool(self.processes, workerStart)
+
+  def getRoutes(self, *args, **kwargs):
+    """Router.getRoutes, run in whichever worker is free next"""
+    given = kwargs.pop('stats', None)
+    steps, stats = self.pool.apply(workerGetRoutes, ((args, kwargs),))
+    self.router.metrics.record(stats)
+    if given is not None:
+      given.update(stats)
+    return(steps)
+
+  def getRoutesBatch(self, queries, alpha=1, beta=.1, mode=None):
+    """Router.getRoutesBatch, with the queries split evenly between the
+    workers"""
+    size = max(1, -(-len(queries) // self.processes))
+    chunks = [(queries[i:i + size], alpha, beta, mode) for i in range(0, len(queries), size)]
+    results = []
+    for chunk, stats in self.pool.map(workerGetRoutesBatch, chunks):
+      results.extend(chunk)
+      for figures in stats:
+        self.router.metrics.record(figures)
+    return(results)
+
+  def getMatrix(self, origins, destinations, alpha=1, beta=.1, paths=False):
+    """Router.getMatrix, with the origins split evenly between the workers"""
+    size = max(1, -(-len(origins) // self.processes))
+    chunks = [(origins[i:i + size], destinations, alpha, beta, paths)
+              for i in range(0, len(origins), size)]
+    matrix = None
+    for part in self.pool.map(workerGetMatrix, chunks):
+      if matrix is None:
+        matrix = part
+        continue
+      for key in ('origins', 'costs', 'lengths', 'paths'):
+        if key in part:
+          matrix[key].extend(part[key])
+    if matrix is None:
+      matrix = sharedRouter.getMatrix(origins, destinations, alpha, beta, paths)
+    return(matrix)
+
+  def getParetoRoutes(self, *args, **kwargs):
+    """Router.getParetoRoutes, run in whichever worker is free next"""
+    given = kwargs.pop('stats', None)
+    found, stats = self.pool.apply(workerGetParetoRoutes, ((args, kwargs),))
+    if given is not None:
+      given.update(stats)
+    return(found)
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+class PoolKeeper:
+  """The RouterPool a server's requests run on, replaced as a whole.
+
+  Requests run inside using(), any number at once.  replace() waits for
+  those already inside to finish, holding new ones back, and forks the new
+  pool then, so no lock in this process is held part way through an update
+  by a request (the workers would inherit it held), and no request is left
+  with the old pool when it is closed."""
+  def __init__(self, router, processes=None):
+    self.pool = RouterPool(router, processes)
+    self.processes = self.pool.processes
+    self.condition = threading.Condition()
+    self.users = 0
+    self.replacing = False
+
+  @contextlib.contextmanager
+  def using(self):
+    """The current pool, for the length of one request"""
+    with self.condition:
+      while self.replacing:
+        self.condition.wait()
+      self.users = self.users + 1
+      pool = self.pool
+    try:
+      yield(pool)
+    finally:
+      with self.condition:
+        self.users = self.users - 1
+        if self.users == 0:
+          self.condition.notify_all()
+
+  def replace(self, router=None):
+    """Fork a new pool from router (by default the same one, reloaded), and
+    close the old one"""
+    with self.condition:
+      while self.replacing:
+        self.condition.wait()
+      self.replacing = True
+      try:
+        while self.users:
+          self.condition.wait()
+        old = self.pool
+        self.pool = RouterPool(router or old.router, self.processes)
+      finally:
+        self.replacing = False
+        self.condition.notify_all()
+    old.close()
+
+  def close(self):
+    with self.condition:
+      self.pool.close()
@@ -1,12 +1,44 @@
 import cherrypy
 import cherrypy_cors
 import sys
+import json
+import argparse
+import contextlib
 import route
+import routerPool
+import profiler
 
 class Server(object):
-	def __init__(self):
+	def __init__(self, workers=1, profiler=None, snapshot=None, hierarchy=False, landmarks=False, landmarkCount=6,
+			verifySnapshot=False):
 		object.__init__(self)
-		self.route = route.Router()
+		# A snapshot file is mapped straight into memory (and rebuilt first
+		# if the OSM or risk files have changed, or with verifySnapshot if
+		# its checksum is wrong), rather than parsing them.
+		# The hierarchy, if wanted, is built here: mode=hierarchy queries
+		# fail without one.  With landmarks, forward searches are A* on the
+		# landmarks' lower bounds (see landmarks.py); the workers share the
+		# tables along with the rest of the router
+		self.route = route.Router(snapshot=snapshot, hierarchy=hierarchy,
+			landmarks=landmarks, landmarkCount=landmarkCount, verifySnapshot=verifySnapshot)
+		# Optional profiler.RequestProfiler, for a sample of /query requests
+		self.profiler = profiler
+		# With more than one worker, queries are handed to forked processes
+		# sharing this router's graph, so they can use every core.  The
+		# pool is replaced after a risk reload (see reloaded)
+		self.pool = None
+		if workers > 1:
+			self.pool = routerPool.PoolKeeper(self.route, workers)
+
+	@contextlib.contextmanager
+	def router(self):
+		"""What to run a request's queries on: the worker pool, or the
+		router itself if there is none"""
+		if self.pool is None:
+			yield self.route
+			return
+		with self.pool.using() as pool:
+			yield pool
 
 	@cherrypy.expose
 	def index(self):
@@ -16,25 +48,237 @@ class Server(object):
 	#@cherrypy_cors.tools.expose()
 	@cherrypy.tools.json_out()
 	@cherrypy.tools.json_in(force=False)
-	def query(self, curr_lat=0.0, curr_lng=0.0, dest_lat=0.0, dest_lng=0.0, alpha=0.0, beta=0.0):
+	def query(self, curr_lat=0.0, curr_lng=0.0, dest_lat=0.0, dest_lng=0.0, alpha=0.0, beta=0.0, mode=None,
+			max_expanded=None, max_seconds=None, partial=0):
+		"""Route between two positions.  max_expanded and max_seconds can
+		lower the server's search budget; with partial=1, a search that runs
+		out of it returns the route to the point nearest the destination it
+		reached.  status says how the search went, limit which budget it
+		ran out of, and partial whether coords stop short."""
+		args = (curr_lat, curr_lng, dest_lat, dest_lng, alpha, beta, mode, max_expanded, max_seconds, partial)
+		if self.profiler is not None:
+			return self.profiler.call(self.routeQuery, *args)
+		return self.routeQuery(*args)
+
+	def routeQuery(self, curr_lat, curr_lng, dest_lat, dest_lng, alpha, beta, mode, max_expanded, max_seconds, partial):
 		ret = {
 			'coords': None,
+			'status': None,
+			'limit': None,
+			'partial': False,
 		}
 
+		limits = searchLimits(max_expanded, max_seconds)
+		try:
+			limits['partial'] = bool(int(partial))
+		except ValueError:
+			raise cherrypy.HTTPError(400, "Bad search limits")
+		if mode not in (None, '') and mode not in route.SEARCH_MODES:
+			raise cherrypy.HTTPError(400, "Unknown search mode")
+		mode = mode or None
+
+		stats = {}
 		try:
-			ret['coords'] = self.route.getRoutes(curr_lat, curr_lng, dest_lat, dest_lng, alpha, beta)
+			with self.router() as router:
+				ret['coords'] = router.getRoutes(curr_lat, curr_lng, dest_lat, dest_lng, alpha, beta, mode, stats=stats, **limits)
+			ret['status'] = stats.get('status')
+			ret['limit'] = stats.get('limit')
+			ret['partial'] = bool(stats.get('partial'))
 		except Exception as e:
 			print("ERROR: ", e)
 			ret['coords'] = None
+			ret['status'] = 'error'
+			self.route.metrics.record({'status': 'error'})
 			
 		return ret
 
+	@cherrypy.expose
+	@cherrypy.tools.json_out()
+	@cherrypy.tools.json_in()
+	def batch_query(self, alpha=0.0, beta=0.0, mode=None):
+		"""Route a JSON array of /query-style objects (or an object holding
+		one as "queries", with batch-wide "alpha", "beta" and "mode")"""
+		body = cherrypy.request.json
+		queries = body
+		if isinstance(body, dict):
+			queries = body.get('queries', [])
+			alpha = body.get('alpha', alpha)
+			beta = body.get('beta', beta)
+			mode = body.get('mode', mode)
+		if not isinstance(queries, list):
+			raise cherrypy.HTTPError(400, "Expected a list of queries")
+
+		try:
+			with self.router() as router:
+				results = router.getRoutesBatch(queries, alpha, beta, mode)
+		except Exception as e:
+			print("ERROR: ", e)
+			results = [{'status': 'error', 'coords': None}] * len(queries)
+
+		return {'results': results}
+
+	@cherrypy.expose
+	@cherrypy.tools.json_out()
+	@cherrypy.tools.json_in()
+	def matrix_query(self):
+		"""Cost matrix between a JSON object's "origins" and "destinations"
+		(lists of [lat, lng]), with "alpha", "beta" and optional "paths"."""
+		body = cherrypy.request.json
+		try:
+			args = (body['origins'], body['destinations'],
+				body.get('alpha', 0.0), body.get('beta', 0.0), bool(body.get('paths', False)))
+		except (KeyError, TypeError, AttributeError):
+			raise cherrypy.HTTPError(400, "Expected origins and destinations")
+
+		try:
+			with self.router() as router:
+				matrix = router.getMatrix(*args)
+		except Exception as e:
+			print("ERROR: ", e)
+			return {'costs': None, 'lengths': None}
+
+		# Unreachable pairs are null
+		return matrix
+
+	@cherrypy.expose
+	@cherrypy.tools.json_out()
+	def pareto_query(self, curr_lat=0.0, curr_lng=0.0, dest_lat=0.0, dest_lng=0.0, epsilon=0.05, max_labels=8,
+			max_expanded=None, max_seconds=None):
+		"""All the routes a fastest/safest slider can pick between, with the
+		totals of each risk column so the client can price them for any
+		alpha/beta.  epsilon=0 and max_labels=0 give the exact set.  The
+		search has the same budget as /query's; if it runs out, status is
+		gave_up, limit says which budget, and routes holds those found."""
+		ret = {
+			'status': None,
+			'limit': None,
+			'routes': None,
+		}
+		limits = searchLimits(max_expanded, max_seconds)
+
+		stats = {}
+		try:
+			args = (curr_lat, curr_lng, dest_lat, dest_lng, float(epsilon), int(max_labels) or None)
+			with self.router() as router:
+				ret['status'], ret['routes'] = router.getParetoRoutes(*args, stats=stats, **limits)
+			ret['limit'] = stats.get('limit')
+		except Exception as e:
+			print("ERROR: ", e)
+			ret['status'] = 'error'
+
+		return ret
+
+	@cherrypy.expose
+	@cherrypy.tools.json_out()
+	def reload_risk(self, file=None, delta=0, wait=0):
+		"""Admin endpoint: load a new risk file (or, with delta=1, a file of
+		changed edges) in the background and swap it in when it is ready.
+		Queries in flight finish on the old data.  Reloads are started by
+		a POST; a GET just shows how the last one went.  Only answers
+		requests from this machine."""
+		if cherrypy.request.remote.ip not in ('127.0.0.1', '::1'):
+			raise cherrypy.HTTPError(403)
+		if cherrypy.request.method == 'POST':
+			started = self.route.reloadRisk(file, bool(int(delta)), bool(int(wait)), self.reloaded)
+			if not started:
+				raise cherrypy.HTTPError(409, "A reload is already running")
+		return self.route.reloadState
+
+	@cherrypy.expose
+	def metrics(self):
+		"""Query counters and latency histograms, in the Prometheus text
+		format"""
+		gauges = [
+			('risk_version', 'Version of the risk data in use.', self.route.riskVersion()),
+			('worker_processes', 'Worker processes serving queries.', self.pool.processes if self.pool else 0),
+		]
+		cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+		return self.route.metrics.render(gauges)
+
+	@cherrypy.expose
+	def profile(self, format='summary'):
+		"""Admin endpoint: what the request profiler has seen lately, as a
+		JSON summary, a text report, a pstats file (format=pstats) or
+		collapsed stacks for flame graphs (format=collapsed).  A POST saves
+		the pstats and collapsed stacks to the profiler's directory.  Only
+		answers requests from this machine."""
+		if cherrypy.request.remote.ip not in ('127.0.0.1', '::1'):
+			raise cherrypy.HTTPError(403)
+		if self.profiler is None:
+			raise cherrypy.HTTPError(404, "Profiling is off")
+		headers = cherrypy.response.headers
+		if cherrypy.request.method == 'POST':
+			headers['Content-Type'] = 'application/json'
+			return json.dumps({'files': self.profiler.dump()}).encode('utf-8')
+		if format == 'pstats':
+			headers['Content-Type'] = 'application/octet-stream'
+			headers['Content-Disposition'] = 'attachment; filename="requests.pstats"'
+			return self.profiler.pstatsBytes()
+		if format == 'collapsed':
+			headers['Content-Type'] = 'text/plain; charset=utf-8'
+			return self.profiler.collapsed().encode('utf-8')
+		if format == 'text':
+			headers['Content-Type'] = 'text/plain; charset=utf-8'
+			return self.profiler.report().encode('utf-8')
+		headers['Content-Type'] = 'application/json'
+		return json.dumps(self.profiler.summary()).encode('utf-8')
+
+	def reloaded(self, version):
+		"""Fork a fresh set of workers from the reloaded router, once the
+		requests on the old ones are done"""
+		if self.pool is None:
+			return
+		self.pool.replace(self.route)
+
+def searchLimits(max_expanded, max_seconds):
+	"""The search budget a request asks for, as keyword arguments for the
+	router (None where it asks for nothing)"""
+	try:
+		return {
+			'maxExpanded': int(max_expanded) if max_expanded not in (None, '') else None,
+			'maxSeconds': float(max_seconds) if max_seconds not in (None, '') else None,
+		}
+	except ValueError:
+		raise cherrypy.HTTPError(400, "Bad search limits")
+
 def CORS():
 	cherrypy.response.headers["Access-Control-Allow-Origin"] = "*"
 
 
+def parseArgs(argv=None):
+	parser = argparse.ArgumentParser(description="Serve routes over HTTP")
+	parser.add_argument('workers', nargs='?', type=int, default=1,
+		help="worker processes to serve queries from")
+	# Profiles a sample of requests, and any that run longer than slow
+	# seconds; see profiler.py
+	parser.add_argument('sample_rate', nargs='?', type=float,
+		help="fraction of requests to profile")
+	parser.add_argument('slow_seconds', nargs='?', type=float,
+		help="profile requests that run longer than this")
+	parser.add_argument('--snapshot', metavar='FILE',
+		help="map the graph from this snapshot file (see compactGraph.py), building it if need be")
+	parser.add_argument('--verify-snapshot', action='store_true',
+		help="check the snapshot's checksum at start up, which reads all of it")
+	parser.add_argument('--hierarchy', action='store_true',
+		help="build a contraction hierarchy at start up, for mode=hierarchy queries")
+	parser.add_argument('--landmarks', action='store_true',
+		help="route forward searches with A* on landmark lower bounds, loading the tables (or building them at start up) next to the risk file")
+	parser.add_argument('--landmark-count', type=int, default=6, metavar='N',
+		help="landmarks to tabulate (default 6)")
+	return parser.parse_args(argv)
+
+def makeServer(args):
+	"""The Server the command line asks for"""
+	sampler = None
+	if args.sample_rate is not None:
+		sampler = profiler.RequestProfiler(args.sample_rate, args.slow_seconds, directory='profiles')
+	return Server(args.workers, sampler, args.snapshot, args.hierarchy, args.landmarks, args.landmark_count,
+		args.verify_snapshot)
+
 if __name__ == '__main__':
 	cherrypy.tools.CORS = cherrypy.Tool('before_finalize', CORS)
-	cherrypy.config.update({'tools.CORS.on': True,})
+	# Router searches keep their state per call, so every worker thread can
+	# serve /query at once
+	cherrypy.config.update({'tools.CORS.on': True, 'server.thread_pool': 16,})
 	cherrypy.server.socket_host = '0.0.0.0'
-	cherrypy.quickstart(Server())
+	cherrypy.quickstart(makeServer(parseArgs()))
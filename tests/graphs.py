@@ -0,0 +1,113 @@
+#----------------------------------------------------------------------------
+# Graphs and reference searches shared by the tests
+#
+# The bundled routing.csv has risks but no positions (those come from
+# lowertown.osm, which isn't in the repository), so its nodes are given
+# made-up positions from a seeded random number generator.  gridData makes
+# a small synthetic street grid instead, for anything that wants a graph
+# with a sensible shape.
+#
+# Run the tests from the top of the tree with
+#   python -m unittest discover -s tests
+#----------------------------------------------------------------------------
+import os
+import io
+import sys
+import math
+import heapq
+import random
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not ROOT in sys.path:
+  sys.path.insert(0, ROOT)
+
+from loadOsm import LoadOsm
+
+RISK_FILE = os.path.join(ROOT, 'routing.csv')
+# (alpha, beta) pairs the tests route with
+WEIGHTINGS = ((1, .1), (0.5, 2), (2, 0), (0, 1))
+
+def riskData(seed=1):
+  """A LoadOsm of the bundled routing.csv, with a random position for each
+  node in a small box"""
+  data = LoadOsm("foot")
+  data.readInRisk(RISK_FILE)
+  nodes = set(data.routing)
+  for links in data.routing.values():
+    nodes.update(links)
+  rnd = random.Random(seed)
+  for node in sorted(nodes):
+    data.makeNodeRouteable([node, 40.7 + rnd.random() * 0.05, -74 + rnd.random() * 0.05])
+  return(data)
+
+def gridData(size, seed=1, oneWay=0.1):
+  """A LoadOsm of a size x size street grid with random risks.  A
+  fraction oneWay of the links only go one way."""
+  data = LoadOsm("foot")
+  rnd = random.Random(seed)
+  def node(x, y):
+    return(1000 + y * size + x)
+  for y in range(size):
+    for x in range(size):
+      data.makeNodeRouteable([node(x, y), 40.7 + y * 0.0005, -74 + x * 0.0005])
+  for y in range(size):
+    for x in range(size):
+      for (nx, ny) in ((x + 1, y), (x, y + 1)):
+        if nx >= size or ny >= size:
+          continue
+        a = node(x, y)
+        b = node(nx, ny)
+        risk = [rnd.uniform(-3, 1), rnd.uniform(-3, 1)]
+        ways = rnd.random() < oneWay and [(a, b)] or [(a, b), (b, a)]
+        for fr, to in ways:
+          data.routing.setdefault(fr, {})[to] = list(risk)
+  return(data)
+
+def pairs(data, count, seed=1):
+  """count random (start, end) node pairs"""
+  nodes = sorted(data.routing)
+  rnd = random.Random(seed)
+  return([(rnd.choice(nodes), rnd.choice(nodes)) for i in range(count)])
+
+def dijkstra(graph, start, alpha, beta):
+  """Cheapest cost from start (an OSM id) to every node it reaches, by
+  OSM id, over any graph with the search interface"""
+  weighting = graph.weighting(alpha, beta)
+  source = graph.nodeIndex(start)
+  best = {source: 0.0}
+  queue = [(0.0, source)]
+  while queue:
+    d, x = heapq.heappop(queue)
+    if d > best[x]:
+      continue
+    try:
+      for i, cost in graph.neighbours(x, weighting):
+        if d + cost < best.get(i, float('inf')):
+          best[i] = d + cost
+          heapq.heappush(queue, (d + cost, i))
+    except KeyError:
+      pass
+  return(dict((graph.nodeId(i), d) for (i, d) in best.items()))
+
+def routeCost(data, route, alpha, beta):
+  """Cost of a route (OSM ids) over a LoadOsm's links, or None if it uses
+  a link that doesn't exist"""
+  total = 0.0
+  for fr, to in zip(route, route[1:]):
+    weight = data.routing.get(fr, {}).get(to)
+    if not weight:
+      return(None)
+    total = total + alpha * math.exp(weight[0]) + beta * math.exp(weight[1])
+  return(total)
+
+def writeRisk(filename, routing):
+  """Write a LoadOsm routing dict out in the routing.csv format"""
+  with open(filename, 'w') as f:
+    for fr, links in sorted(routing.items()):
+      for to, risk in sorted(links.items()):
+        f.write('%d,%d,%r,%r\n' % (fr, to, risk[0], risk[1]))
+
+def quiet():
+  """Context manager hiding what searches print"""
+  return(contextlib.redirect_stdout(io.StringIO()))
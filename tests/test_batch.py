@@ -0,0 +1,78 @@
+#----------------------------------------------------------------------------
+# Batch routing, and snapping many points at once
+#----------------------------------------------------------------------------
+import random
+import unittest
+
+import graphs
+from route import Router
+from nodeGrid import NodeGrid
+
+class NearestEachTest(unittest.TestCase):
+  def testSameAsNearest(self):
+    data = graphs.riskData()
+    rnd = random.Random(1)
+    # Points in and around the nodes, some in the same cells, and some far
+    # outside them
+    points = [(40.69 + rnd.random() * 0.07, -74.01 + rnd.random() * 0.07) for i in range(300)]
+    points.extend([(40.7, -74.0), (40.7, -74.0), (0.0, 0.0), (41.5, -73.0)])
+    found = data.index.nearestEach(points)
+    self.assertEqual(len(found), len(points))
+    for (lat, lon), node in zip(points, found):
+      # Ties may go either way, so compare distances
+      expected = data.index.nearest(lat, lon)[0]
+      self.assertAlmostEqual(self.distance(data, node, lat, lon), self.distance(data, expected, lat, lon))
+
+  def distance(self, data, node, lat, lon):
+    pos = data.rnodes[node]
+    return((pos[0] - lat) ** 2 + (pos[1] - lon) ** 2)
+
+  def testEmpty(self):
+    self.assertEqual(NodeGrid().nearestEach([(40.7, -74.0), (0.0, 0.0)]), [None, None])
+    self.assertEqual(NodeGrid().nearestEach([]), [])
+
+class BatchTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.data = graphs.gridData(15)
+    cls.router = Router(data=cls.data)
+
+  def query(self, start, end, **extra):
+    query = {'curr_lat': self.data.rnodes[start][0], 'curr_lng': self.data.rnodes[start][1],
+             'dest_lat': self.data.rnodes[end][0], 'dest_lng': self.data.rnodes[end][1]}
+    query.update(extra)
+    return(query)
+
+  def testSameAsSingleQueries(self):
+    queries = []
+    for n, (start, end) in enumerate(graphs.pairs(self.data, 30)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      queries.append(self.query(start, end, alpha=alpha, beta=beta))
+    with graphs.quiet():
+      results = self.router.getRoutesBatch(queries, mode='bidirectional')
+      expected = [self.router.getRoutes(q['curr_lat'], q['curr_lng'], q['dest_lat'], q['dest_lng'],
+                                        q['alpha'], q['beta'], 'bidirectional') for q in queries]
+    self.assertEqual([result['coords'] for result in results], expected)
+    self.assertEqual(set(result['status'] for result in results), set(['success']))
+
+  def testMalformedQueries(self):
+    start, end = graphs.pairs(self.data, 1, seed=2)[0]
+    good = self.query(start, end)
+    queries = [good, {'curr_lat': 40.7}, self.query(start, end, alpha='lots'), None,
+               dict(good, dest_lng=[1]), good]
+    stats = []
+    with graphs.quiet():
+      results = self.router.getRoutesBatch(queries, 1, .1, stats=stats)
+    self.assertEqual([result['status'] for result in results],
+                     ['success', 'bad_query', 'bad_query', 'bad_query', 'bad_query', 'success'])
+    self.assertEqual(results[0], results[5])
+    self.assertTrue(results[0]['coords'])
+    self.assertIsNone(results[1]['coords'])
+    # Figures for just the queries that were routed
+    self.assertEqual(len(stats), 2)
+
+  def testEmpty(self):
+    self.assertEqual(self.router.getRoutesBatch([]), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,157 @@
+#----------------------------------------------------------------------------
+# Search budgets: expansion and time limits, and partial routes
+#----------------------------------------------------------------------------
+import time
+import unittest
+
+import graphs
+from compactGraph import EdgeCosts
+from route import Router, Search, MAX_EXPANDED
+
+SIZE = 30
+MODES = ('forward', 'bidirectional')
+
+class SlowWeighting:
+  """A graph whose edge costs take a while to work out, as a big compact
+  graph's do the first time an alpha and beta are used"""
+  def __init__(self, graph, seconds):
+    self.graph = graph
+    self.seconds = seconds
+
+  def __getattr__(self, name):
+    return(getattr(self.graph, name))
+
+  def weighting(self, alpha, beta):
+    time.sleep(self.seconds)
+    return(self.graph.weighting(alpha, beta))
+
+class BudgetTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.data = graphs.gridData(SIZE, oneWay=0)
+    # Opposite corners of the grid
+    cls.start = 1000
+    cls.end = 1000 + SIZE * SIZE - 1
+    cls.routers = [Router(data=cls.data), Router(data=cls.data, compact=True)]
+
+  def search(self, router, mode, **limits):
+    with graphs.quiet():
+      return(router.search(self.start, self.end, 1, .1, mode, **limits))
+
+  def searches(self, **limits):
+    for router in self.routers:
+      for mode in MODES:
+        yield(self.search(router, mode, **limits))
+
+  def nearness(self, node):
+    """Squared distance of a node from the end"""
+    lat, lon = self.data.rnodes[node]
+    elat, elon = self.data.rnodes[self.end]
+    return((lat - elat) ** 2 + (lon - elon) ** 2)
+
+  def testNoLimit(self):
+    for search in self.searches():
+      self.assertEqual((search.result, search.limit, search.isPartial), ('success', None, False))
+      self.assertEqual((search.route[0], search.route[-1]), (self.start, self.end))
+
+  def testExpansions(self):
+    for search in self.searches(maxExpanded=50):
+      self.assertEqual((search.result, search.limit), ('gave_up', 'expansions'))
+      self.assertEqual(search.expanded, 50)
+      self.assertEqual(search.route, [])
+      self.assertFalse(search.isPartial)
+
+  def testTime(self):
+    for search in self.searches(maxSeconds=1e-6):
+      self.assertEqual((search.result, search.limit), ('gave_up', 'time'))
+      self.assertEqual(search.expanded % 64, 0)
+      self.assertLess(search.expanded, SIZE * SIZE)
+
+  def testPartial(self):
+    for maxExpanded in (50, 200):
+      for search in self.searches(maxExpanded=maxExpanded, partial=True):
+        self.assertEqual((search.result, search.limit), ('gave_up', 'expansions'))
+        self.assertTrue(search.isPartial)
+        route = search.route
+        self.assertEqual(route[0], self.start)
+        for fr, to in zip(route, route[1:]):
+          self.assertIn(to, self.data.routing[fr])
+        # It heads for the end, and no node on the way is nearer to it
+        self.assertLess(self.nearness(route[-1]), self.nearness(self.start))
+        self.assertEqual(min(route, key=self.nearness), route[-1])
+    # A search that finishes isn't partial
+    for search in self.searches(maxExpanded=MAX_EXPANDED, partial=True):
+      self.assertEqual((search.result, search.isPartial), ('success', False))
+
+  def testRouterBudget(self):
+    # A request can lower the router's budget, but not raise it
+    for router in self.routers:
+      router.maxExpanded = 50
+      router.maxSeconds = None
+      try:
+        search = self.search(router, 'forward', maxExpanded=MAX_EXPANDED)
+        self.assertEqual((search.limit, search.expanded), ('expansions', 50))
+        search = self.search(router, 'forward', maxExpanded=20)
+        self.assertEqual((search.limit, search.expanded), ('expansions', 20))
+        router.maxExpanded = MAX_EXPANDED
+        router.maxSeconds = 1e-6
+        search = self.search(router, 'forward', maxSeconds=60)
+        self.assertEqual((search.result, search.limit), ('gave_up', 'time'))
+      finally:
+        router.maxExpanded = MAX_EXPANDED
+        router.maxSeconds = None
+
+  def testColdWeighting(self):
+    # Getting the edge costs ready takes longer than the whole budget, and
+    # counts against it
+    for router in self.routers:
+      graph = SlowWeighting(router.graph, 0.3)
+      for mode in MODES:
+        search = Search(graph, self.start, self.end, 1, .1, maxSeconds=0.2)
+        with graphs.quiet():
+          search.run(mode)
+        self.assertEqual((search.result, search.limit), ('gave_up', 'time'))
+        self.assertEqual(search.expanded, 0)
+
+  def testNewWeights(self):
+    # New weights don't build a cost array for the whole graph: the search
+    # works out the costs of the edges it reaches
+    graph = Router(data=self.data, compact=True).graph
+    self.assertEqual(list(graph.costs.entries), [(1.0, 0.1)])
+    for alpha, beta in graphs.WEIGHTINGS:
+      costs = graph.weighting(alpha, beta)
+      if (alpha, beta) != (1, .1):
+        self.assertIsInstance(costs, EdgeCosts)
+      search = Search(graph, self.start, self.end, alpha, beta)
+      with graphs.quiet():
+        search.run()
+      self.assertEqual(search.result, 'success')
+      self.assertEqual(list(graph.costs.entries), [(1.0, 0.1)])
+    # Worked out one at a time, the costs are the array's
+    for alpha, beta in graphs.WEIGHTINGS:
+      lazy = [EdgeCosts(graph, alpha, beta)]
+      graph.costArray(alpha, beta)
+      lazy.append(EdgeCosts(graph, alpha, beta))
+      expected = list(graph.weighting(alpha, beta))
+      for costs in lazy:
+        self.assertEqual(len(costs), len(expected))
+        self.assertEqual(costs[0:len(costs)], expected)
+        self.assertEqual([costs[e] for e in range(0, len(costs), 7)], expected[::7])
+
+  def testNotCached(self):
+    router = Router(data=self.data)
+    for i in range(2):
+      stats = {}
+      with graphs.quiet():
+        found = router.cachedRoute('forward', self.start, self.end, 1, .1, stats=stats,
+                                   limits={'maxExpanded': 50, 'partial': True})
+      self.assertFalse(stats['cached'])
+      self.assertEqual((found[0], stats['limit'], stats['partial']), ('gave_up', 'expansions', True))
+    for cached in (False, True):
+      stats = {}
+      with graphs.quiet():
+        found = router.cachedRoute('forward', self.start, self.end, 1, .1, stats=stats)
+      self.assertEqual((found[0], stats['cached']), ('success', cached))
+
+if __name__ == '__main__':
+  unittest.main()
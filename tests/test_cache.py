@@ -0,0 +1,67 @@
+#----------------------------------------------------------------------------
+# Router's cache of search results
+#----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+
+import graphs
+from route import Router
+
+class CacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.data = graphs.riskData()
+    self.router = Router(data=self.data)
+    # A pair of nodes with a route of a few links
+    for start, end in graphs.pairs(self.data, 100, seed=5):
+      with graphs.quiet():
+        result, route = self.router.doRoute(start, end, 1, 0)
+      if result == 'success' and len(route) > 3:
+        break
+    self.start = start
+    self.end = end
+    self.route = route
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def cached(self):
+    stats = {}
+    with graphs.quiet():
+      found = self.router.cachedRoute('forward', self.start, self.end, 1, 0, stats=stats)
+    return(found, stats)
+
+  def testRepeatedQuery(self):
+    first, stats = self.cached()
+    self.assertFalse(stats['cached'])
+    self.assertEqual(first, ('success', self.route))
+    again, stats = self.cached()
+    self.assertTrue(stats['cached'])
+    self.assertNotIn('expanded', stats)
+    self.assertEqual(again, first)
+    self.assertEqual((self.router.cache.hits, self.router.cache.misses), (1, 1))
+
+  def testReadInRiskClearsCache(self):
+    self.cached()
+    self.assertEqual(self.router.riskVersion(), 0)
+    # Make the cached route's links much riskier
+    routing = dict((fr, dict((to, list(risk)) for (to, risk) in links.items()))
+                   for (fr, links) in self.data.routing.items())
+    for fr, to in zip(self.route, self.route[1:]):
+      routing[fr][to][0] = routing[fr][to][0] + 5
+    riskFile = os.path.join(self.directory, 'routing.csv')
+    graphs.writeRisk(riskFile, routing)
+    self.router.data.readInRisk(riskFile)
+    self.assertEqual(self.router.riskVersion(), 1)
+
+    found, stats = self.cached()
+    self.assertFalse(stats['cached'])
+    self.assertNotEqual(found[1], self.route)
+    fresh = Router(data=self.data)
+    with graphs.quiet():
+      self.assertEqual(found, fresh.doRoute(self.start, self.end, 1, 0))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+#----------------------------------------------------------------------------
+# Customizable contraction hierarchy against Dijkstra
+#----------------------------------------------------------------------------
+import unittest
+
+import graphs
+from route import Router
+from compactGraph import CompactGraph
+from hierarchy import CustomizableHierarchy
+
+class HierarchyTest(unittest.TestCase):
+  def checkCheapest(self, data, router, count, seed=1):
+    for n, (start, end) in enumerate(graphs.pairs(data, count, seed)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      best = graphs.dijkstra(router.graph, start, alpha, beta).get(end)
+      result, route = router.doRouteHierarchy(start, end, alpha, beta)
+      if best is None:
+        self.assertEqual(result, 'no_route')
+        continue
+      self.assertEqual(result, 'success')
+      self.assertEqual((route[0], route[-1]), (start, end))
+      self.assertAlmostEqual(graphs.routeCost(data, route, alpha, beta), best)
+
+  def testRiskData(self):
+    data = graphs.riskData()
+    self.checkCheapest(data, Router(data=data, hierarchy=True), 40)
+
+  def testGrid(self):
+    data = graphs.gridData(25)
+    self.checkCheapest(data, Router(data=data, hierarchy=True), 40, seed=2)
+
+  def testSameNode(self):
+    data = graphs.gridData(5)
+    router = Router(data=data, hierarchy=True)
+    node = min(data.routing)
+    self.assertEqual(router.doRouteHierarchy(node, node), ('success', [node]))
+
+  def testNewRisks(self):
+    data = graphs.gridData(15)
+    graph = CompactGraph.fromLoadOsm(data)
+    hierarchy = CustomizableHierarchy(graph)
+    # The same links with other risks
+    routing = dict((fr, dict((to, [r[1], r[0] * 0.5]) for (to, r) in links.items()))
+                   for (fr, links) in data.routing.items())
+    other = graph.withRisk(routing)
+    self.assertTrue(other.sameEdges(graph))
+    rehung = hierarchy.withGraph(other)
+    for start, end in graphs.pairs(data, 20):
+      best = graphs.dijkstra(other, start, 1, .1).get(end)
+      cost, route = rehung.query(other.nodeIndex(start), other.nodeIndex(end), 1, .1)
+      if best is None:
+        self.assertEqual(route, [])
+      else:
+        self.assertAlmostEqual(cost, best)
+
+if __name__ == '__main__':
+  unittest.main()
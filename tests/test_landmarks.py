@@ -0,0 +1,65 @@
+#----------------------------------------------------------------------------
+# Landmark (ALT) searches and their saved tables
+#----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+from array import array
+import unittest
+
+import graphs
+from route import Router
+from compactGraph import CompactGraph
+from landmarks import Landmarks
+
+class LandmarksTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    cls.data = graphs.riskData()
+    cls.router = Router(data=cls.data)
+    cls.router.useLandmarks(os.path.join(cls.directory, 'routing.csv.landmarks'))
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  def testCheapest(self):
+    for n, (start, end) in enumerate(graphs.pairs(self.data, 40)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      best = graphs.dijkstra(self.router.graph, start, alpha, beta).get(end)
+      result, route = self.router.doRoute(start, end, alpha, beta)
+      if best is None:
+        self.assertEqual(result, 'no_route')
+        continue
+      self.assertEqual(result, 'success')
+      self.assertAlmostEqual(graphs.routeCost(self.data, route, alpha, beta), best)
+
+  def testLowerBound(self):
+    graph = self.router.graph
+    for start, end in graphs.pairs(self.data, 20, seed=2):
+      bound = self.router.landmarks.heuristic(graph.nodeIndex(end), 0.5, 2)
+      best = graphs.dijkstra(graph, start, 0.5, 2).get(end)
+      if best is None:
+        continue
+      self.assertLessEqual(bound(graph.nodeIndex(start)), best + 1e-9)
+
+  def testSavedTables(self):
+    graph = self.router.graph
+    loaded = Landmarks.load(self.router.landmarksFile, graph)
+    self.assertIsNotNone(loaded)
+    self.assertEqual(loaded.nodes, self.router.landmarks.nodes)
+    self.assertEqual(loaded.tables, self.router.landmarks.tables)
+    # Tables for other risks are stale
+    routing = dict((fr, dict((to, [r[0] + 1, r[1]]) for (to, r) in links.items()))
+                   for (fr, links) in self.data.routing.items())
+    self.assertIsNone(Landmarks.load(self.router.landmarksFile, graph.withRisk(routing)))
+    # So are tables for the same edges leaving different nodes
+    offsets = array('q', graph.offsets)
+    i = next(i for i in range(len(graph)) if offsets[i + 1] > offsets[i])
+    offsets[i + 1] = offsets[i + 1] - 1
+    moved = CompactGraph(graph.ids, graph.lat, graph.lon, offsets, graph.targets, graph.risk0, graph.risk1)
+    self.assertIsNone(Landmarks.load(self.router.landmarksFile, moved))
+
+if __name__ == '__main__':
+  unittest.main()
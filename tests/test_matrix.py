@@ -0,0 +1,65 @@
+#----------------------------------------------------------------------------
+# Many-to-many cost matrices against Dijkstra for each pair
+#----------------------------------------------------------------------------
+import unittest
+
+import graphs
+from route import Router, metres
+
+class MatrixTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    # The risk data, and an island of two nodes that can't reach it
+    cls.data = graphs.riskData()
+    cls.island = [1, 2]
+    cls.data.makeNodeRouteable([1, 40.8, -74.1])
+    cls.data.makeNodeRouteable([2, 40.8, -74.101])
+    cls.data.routing[1] = {2: [0.0, 0.0]}
+    cls.data.routing[2] = {1: [0.0, 0.0]}
+    cls.router = Router(data=cls.data, compact=True)
+
+  def points(self, nodes):
+    return([list(self.data.rnodes[node]) for node in nodes])
+
+  def testSameAsDijkstra(self):
+    nodes = sorted(node for node in self.data.rnodes if not node in self.island)
+    origins = nodes[::401][:6] + self.island[:1]
+    destinations = nodes[7::353][:8] + self.island
+    for alpha, beta in graphs.WEIGHTINGS[:2]:
+      matrix = self.router.getMatrix(self.points(origins), self.points(destinations), alpha, beta, paths=True)
+      self.assertEqual((matrix['origins'], matrix['destinations']), (origins, destinations))
+      unreachable = 0
+      for i, origin in enumerate(origins):
+        best = graphs.dijkstra(self.router.graph, origin, alpha, beta)
+        for j, destination in enumerate(destinations):
+          cost = matrix['costs'][i][j]
+          if not destination in best:
+            unreachable = unreachable + 1
+            self.assertIsNone(cost)
+            self.assertIsNone(matrix['lengths'][i][j])
+            self.assertIsNone(matrix['paths'][i][j])
+            continue
+          self.assertAlmostEqual(cost, best[destination])
+          path = matrix['paths'][i][j]
+          self.assertEqual((path[0], path[-1]), (origin, destination))
+          self.assertAlmostEqual(graphs.routeCost(self.data, path, alpha, beta), cost)
+          length = sum(metres(*(self.data.rnodes[a] + self.data.rnodes[b])) for a, b in zip(path, path[1:]))
+          self.assertAlmostEqual(matrix['lengths'][i][j], length, places=6)
+      self.assertGreater(unreachable, 0)
+
+  def testNoPaths(self):
+    nodes = sorted(self.data.rnodes)[:3]
+    matrix = self.router.getMatrix(self.points(nodes), self.points(nodes))
+    self.assertNotIn('paths', matrix)
+    for i in range(3):
+      self.assertEqual(matrix['costs'][i][i], 0.0)
+
+  def testEmpty(self):
+    nodes = sorted(self.data.rnodes)[:2]
+    matrix = self.router.getMatrix([], self.points(nodes))
+    self.assertEqual((matrix['costs'], matrix['lengths']), ([], []))
+    matrix = self.router.getMatrix(self.points(nodes), [], paths=True)
+    self.assertEqual((matrix['costs'], matrix['lengths'], matrix['paths']), ([[], []], [[], []], [[], []]))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+#----------------------------------------------------------------------------
+# Query counters and histograms, and their Prometheus text
+#----------------------------------------------------------------------------
+import re
+import unittest
+
+import metrics
+from metrics import QueryMetrics, Histogram
+
+# A query of each kind, with the seconds each phase took
+QUERIES = [
+  {'status': 'success', 'cached': False, 'expanded': 50, 'pushes': 120, 'peakQueue': 30,
+   'seconds': {'findNode': 0.0002, 'search': 0.004, 'path': 0.0001, 'total': 0.0045}},
+  {'status': 'success', 'cached': True, 'seconds': {'findNode': 0.0003, 'total': 0.0004}},
+  {'status': 'no_route', 'cached': False, 'expanded': 5000, 'pushes': 9000, 'peakQueue': 800,
+   'seconds': {'findNode': 0.0002, 'search': 0.3, 'total': 0.31}},
+  {'status': 'gave_up', 'cached': False, 'expanded': 1000000, 'pushes': 2000000, 'peakQueue': 50000,
+   'limit': 'expansions', 'partial': True,
+   'seconds': {'findNode': 0.0002, 'search': 12.0, 'path': 0.002, 'total': 12.5}},
+  {'status': 'gave_up', 'cached': False, 'expanded': 64, 'pushes': 100, 'peakQueue': 40,
+   'limit': 'time', 'seconds': {'findNode': 0.0002, 'search': 0.05, 'total': 0.05}},
+  {'status': 'no_such_node', 'seconds': {'findNode': 0.001, 'total': 0.001}},
+]
+
+def samples(text):
+  """{sample name with labels: value} of a Prometheus text page"""
+  found = {}
+  for line in text.splitlines():
+    if line and not line.startswith('#'):
+      name, value = line.rsplit(' ', 1)
+      found[name] = float(value)
+  return(found)
+
+class HistogramTest(unittest.TestCase):
+  def testBuckets(self):
+    histogram = Histogram((1, 10, 100))
+    for value in (0.5, 1, 2, 10, 50, 1000):
+      histogram.observe(value)
+    # Cumulative, with the bounds themselves counted in their bucket
+    self.assertEqual(histogram.lines('h'), [
+      'h_bucket{le="1"} 2', 'h_bucket{le="10"} 4', 'h_bucket{le="100"} 5', 'h_bucket{le="+Inf"} 6',
+      'h_sum 1063.5', 'h_count 6'])
+    self.assertEqual(histogram.lines('h', 'phase="search"')[-3:], [
+      'h_bucket{phase="search",le="+Inf"} 6', 'h_sum{phase="search"} 1063.5', 'h_count{phase="search"} 6'])
+
+class QueryMetricsTest(unittest.TestCase):
+  def setUp(self):
+    self.metrics = QueryMetrics()
+    for query in QUERIES:
+      self.metrics.record(query)
+    self.text = self.metrics.render([('risk_version', 'Version of the risk data in use.', 3)])
+    self.samples = samples(self.text)
+
+  def testCounters(self):
+    self.assertEqual(self.metrics.statuses, {'success': 2, 'no_route': 1, 'gave_up': 2, 'no_such_node': 1})
+    self.assertEqual(self.metrics.limits, {'expansions': 1, 'time': 1})
+    self.assertEqual((self.metrics.cacheHits, self.metrics.partial), (1, 1))
+    prefix = metrics.PREFIX
+    for status, count in (('success', 2), ('no_route', 1), ('gave_up', 2), ('no_such_node', 1)):
+      self.assertEqual(self.samples['%squeries_total{status="%s"}' % (prefix, status)], count)
+    self.assertEqual(self.samples[prefix + 'query_cache_hits_total'], 1)
+    self.assertEqual(self.samples[prefix + 'search_limits_total{limit="expansions"}'], 1)
+    self.assertEqual(self.samples[prefix + 'search_limits_total{limit="time"}'], 1)
+    self.assertEqual(self.samples[prefix + 'partial_routes_total'], 1)
+    self.assertEqual(self.samples[prefix + 'risk_version'], 3)
+
+  def testPhases(self):
+    name = metrics.PREFIX + 'query_phase_seconds'
+    for phase in metrics.PHASES:
+      values = [query['seconds'][phase] for query in QUERIES if phase in query['seconds']]
+      labels = 'phase="%s"' % phase
+      for bound in metrics.SECONDS_BUCKETS:
+        sample = '%s_bucket{%s,le="%s"}' % (name, labels, metrics.formatNumber(bound))
+        self.assertEqual(self.samples[sample], len([v for v in values if v <= bound]), sample)
+      self.assertEqual(self.samples['%s_bucket{%s,le="+Inf"}' % (name, labels)], len(values))
+      self.assertEqual(self.samples['%s_count{%s}' % (name, labels)], len(values))
+      self.assertAlmostEqual(self.samples['%s_sum{%s}' % (name, labels)], sum(values))
+    # 12.5 seconds is past the largest bound: only in +Inf
+    self.assertEqual(self.samples[name + '_bucket{phase="total",le="10"}'], 5)
+    self.assertEqual(self.samples[name + '_bucket{phase="total",le="+Inf"}'], 6)
+
+  def testSearchHistograms(self):
+    # The cached query and the unknown node didn't search
+    name = metrics.PREFIX + 'search_expanded_nodes'
+    self.assertEqual(self.samples[name + '_count'], 4)
+    self.assertEqual(self.samples[name + '_sum'], 50 + 5000 + 1000000 + 64)
+    self.assertEqual(self.samples[name + '_bucket{le="100"}'], 2)
+    self.assertEqual(self.samples[name + '_bucket{le="1000000"}'], 4)
+    self.assertEqual(self.samples[name + '_bucket{le="+Inf"}'], 4)
+    self.assertEqual(self.samples[metrics.PREFIX + 'search_peak_queue_size_count'], 4)
+
+  def testFormat(self):
+    self.assertTrue(self.text.endswith('\n'))
+    helps = {}
+    types = {}
+    for line in self.text.splitlines():
+      if line.startswith('# HELP '):
+        name = line.split(' ')[2]
+        helps[name] = line
+      elif line.startswith('# TYPE '):
+        name, kind = line.split(' ')[2:]
+        self.assertIn(name, helps, 'TYPE before HELP for ' + name)
+        types[name] = kind
+      else:
+        self.assertRegex(line, r'^[a-z_]+(\{[a-zA-Z]+="[^"]*"(,[a-zA-Z]+="[^"]*")*\})? [0-9.e+-]+$')
+        # Every sample belongs to a family with HELP and TYPE
+        family = re.match(r'[a-z_]+', line).group(0)
+        if not family in types:
+          family = re.sub(r'_(bucket|sum|count)$', '', family)
+        self.assertIn(family, types, line)
+    self.assertEqual(set(helps), set(types))
+    for name, kind in types.items():
+      self.assertTrue(name.startswith(metrics.PREFIX))
+      self.assertIn(kind, ('counter', 'histogram', 'gauge'))
+      if kind == 'counter':
+        self.assertTrue(name.endswith('_total'), name)
+    self.assertEqual(types[metrics.PREFIX + 'query_phase_seconds'], 'histogram')
+    self.assertEqual(types[metrics.PREFIX + 'risk_version'], 'gauge')
+    for phase in metrics.PHASES:
+      self.assertIn('query_phase_seconds_count{phase="%s"}' % phase, self.text)
+
+  def testEmpty(self):
+    found = samples(QueryMetrics().render())
+    for status in metrics.STATUSES:
+      self.assertEqual(found['%squeries_total{status="%s"}' % (metrics.PREFIX, status)], 0)
+    self.assertEqual(found[metrics.PREFIX + 'query_phase_seconds_bucket{phase="total",le="+Inf"}'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
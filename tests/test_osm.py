@@ -0,0 +1,87 @@
+#----------------------------------------------------------------------------
+# Streaming OSM XML loader against the old whole-file token load
+#----------------------------------------------------------------------------
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+import graphs
+from loadOsm import LoadOsm
+
+OSM_FILE = os.path.join(graphs.ROOT, 'tests', 'data', 'small.osm')
+TRANSPORTS = ('foot', 'cycle', 'car', 'train', 'horse')
+
+def writeTokens(osmFile, filename):
+  """Convert an OSM file to the JSON tokens the old loader read, parsing
+  the whole document at once"""
+  tokens = []
+  for elem in ElementTree.parse(osmFile).getroot():
+    if elem.tag == 'node':
+      tokens.append({'type': 'node', 'data': {'id': int(elem.get('id')),
+        'lat': float(elem.get('lat')), 'lon': float(elem.get('lon'))}})
+    elif elem.tag == 'way':
+      tokens.append({'type': 'way', 'data': {'id': int(elem.get('id')),
+        'nd': [int(nd.get('ref')) for nd in elem.iter('nd')],
+        'tag': dict((tag.get('k'), tag.get('v')) for tag in elem.iter('tag'))}})
+    else:
+      tokens.append({'type': elem.tag})
+  with open(filename, 'w') as f:
+    f.write(json.dumps(tokens) + '\n')
+
+def links(data):
+  return(set((fr, to) for (fr, ends) in data.routing.items() for to in ends))
+
+class LoadOsmTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.tokens = os.path.join(self.directory, 'jsonTokens.txt')
+    writeTokens(OSM_FILE, self.tokens)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def load(self, transport, filename):
+    data = LoadOsm(transport)
+    with graphs.quiet():
+      self.assertTrue(data.loadOsm(filename))
+    return(data)
+
+  def testSameAsTokens(self):
+    for transport in TRANSPORTS:
+      streamed = self.load(transport, OSM_FILE)
+      expected = self.load(transport, self.tokens)
+      self.assertEqual(streamed.routing, expected.routing)
+      self.assertEqual(streamed.rnodes, expected.rnodes)
+      self.assertEqual(len(streamed.index), len(expected.index))
+
+  def testOneway(self):
+    # Walkers may go either way along a oneway street; cars may not
+    foot = links(self.load('foot', OSM_FILE))
+    self.assertEqual(foot, set([(1, 2), (2, 1), (2, 3), (3, 2), (3, 4), (4, 3), (4, 5), (5, 4),
+                                (5, 6), (6, 5), (2, 11), (11, 2)]))
+    car = links(self.load('car', OSM_FILE))
+    self.assertEqual(car, set([(1, 2), (2, 1), (2, 3), (3, 2), (3, 4), (4, 5), (7, 8), (2, 11), (11, 2)]))
+
+  def testAccess(self):
+    data = LoadOsm('foot')
+    self.assertTrue(data.routeable({'highway': 'steps'}))
+    self.assertTrue(data.routeable({'highway': 'trunk_link'}))
+    self.assertFalse(data.routeable({'highway': 'motorway'}))
+    self.assertFalse(data.routeable({'railway': 'rail'}))
+    self.assertFalse(data.routeable({}))
+    access = data.access({'highway': 'residential'})
+    self.assertEqual(sorted(t for t in TRANSPORTS if access[t]), ['car', 'cycle', 'foot', 'horse'])
+    # Only routeable nodes are kept, and a way's missing nodes are skipped
+    self.assertEqual(sorted(self.load('train', OSM_FILE).rnodes), [9, 10])
+    self.assertEqual(sorted(self.load('foot', OSM_FILE).rnodes), [1, 2, 3, 4, 5, 6, 11])
+
+  def testMissingFile(self):
+    data = LoadOsm('foot')
+    with graphs.quiet():
+      self.assertFalse(data.loadOsm(os.path.join(self.directory, 'none.osm')))
+
+if __name__ == '__main__':
+  unittest.main()
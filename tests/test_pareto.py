@@ -0,0 +1,82 @@
+#----------------------------------------------------------------------------
+# Pareto route sets: every weighting's cheapest route has to be in them
+#----------------------------------------------------------------------------
+import unittest
+
+import graphs
+from route import Router, MAX_EXPANDED
+
+class ParetoTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.data = graphs.gridData(12)
+    cls.router = Router(data=cls.data, compact=True)
+
+  def routes(self, start, end, **kwargs):
+    source = self.data.rnodes[start]
+    target = self.data.rnodes[end]
+    return(self.router.getParetoRoutes(source[0], source[1], target[0], target[1], **kwargs))
+
+  def testCheapestForEveryWeighting(self):
+    weightings = graphs.WEIGHTINGS + ((1, 1), (0.1, 3))
+    for start, end in graphs.pairs(self.data, 15):
+      result, routes = self.routes(start, end)
+      costs = graphs.dijkstra(self.router.graph, start, 1.0, 0.0)
+      if not end in costs:
+        self.assertEqual((result, routes), ('no_route', []))
+        continue
+      self.assertEqual(result, 'success')
+      for alpha, beta in weightings:
+        best = graphs.dijkstra(self.router.graph, start, alpha, beta)[end]
+        cheapest = min(alpha * route['cost0'] + beta * route['cost1'] for route in routes)
+        self.assertAlmostEqual(cheapest, best)
+
+  def testNoneDominated(self):
+    for start, end in graphs.pairs(self.data, 15, seed=2):
+      result, routes = self.routes(start, end)
+      for route in routes:
+        for other in routes:
+          if other is not route:
+            self.assertFalse(other['cost0'] <= route['cost0'] and other['cost1'] <= route['cost1'])
+
+  def testCostsMatchRoutes(self):
+    positions = dict((tuple(pos), node) for (node, pos) in self.data.rnodes.items())
+    for start, end in graphs.pairs(self.data, 10, seed=3):
+      result, routes = self.routes(start, end)
+      for route in routes:
+        nodes = [positions[tuple(pos)] for pos in route['coords']]
+        self.assertEqual((nodes[0], nodes[-1]), (start, end))
+        self.assertAlmostEqual(graphs.routeCost(self.data, nodes, 1, 0), route['cost0'])
+        self.assertAlmostEqual(graphs.routeCost(self.data, nodes, 0, 1), route['cost1'])
+
+  def testApproximate(self):
+    # Looser bounds keep fewer routes, each within a factor of a kept one
+    for start, end in graphs.pairs(self.data, 10, seed=4):
+      exact = self.routes(start, end)[1]
+      rough = self.routes(start, end, epsilon=0.1)[1]
+      self.assertLessEqual(len(rough), len(exact))
+      for route in exact:
+        self.assertTrue(any(other['cost0'] <= route['cost0'] * 1.5 and other['cost1'] <= route['cost1'] * 1.5
+                            for other in rough))
+
+  def testBudget(self):
+    start, end = max(graphs.pairs(self.data, 10, seed=5),
+                     key=lambda pair: abs(pair[0] - pair[1]))
+    stats = {}
+    result, routes = self.routes(start, end, stats=stats, maxExpanded=5)
+    self.assertEqual((result, stats['limit'], stats['expanded']), ('gave_up', 'expansions', 5))
+    # A request can't raise the router's own budget
+    self.router.maxExpanded = 5
+    try:
+      stats = {}
+      result, routes = self.routes(start, end, stats=stats, maxExpanded=1000000)
+    finally:
+      self.router.maxExpanded = MAX_EXPANDED
+    self.assertEqual((result, stats['limit']), ('gave_up', 'expansions'))
+    stats = {}
+    result, routes = self.routes(start, end, stats=stats)
+    self.assertEqual((result, stats['limit']), ('success', None))
+    self.assertTrue(routes)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,171 @@
+#----------------------------------------------------------------------------
+# Worker process pools against the router they are forked from
+#----------------------------------------------------------------------------
+import time
+import threading
+import unittest
+
+import graphs
+from route import Router
+from routerPool import RouterPool, PoolKeeper
+
+WORKERS = 2
+
+def points(data, nodes):
+  return([list(data.rnodes[node]) for node in nodes])
+
+class RouterPoolTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.data = graphs.gridData(20)
+    cls.pairs = graphs.pairs(cls.data, 12, seed=3)
+
+  def setUp(self):
+    self.direct = Router(data=self.data, compact=True)
+    self.router = Router(data=self.data, compact=True)
+    # The workers inherit the redirected stdout, so they don't print
+    # what their searches print
+    with graphs.quiet():
+      self.pool = RouterPool(self.router, WORKERS)
+
+  def tearDown(self):
+    self.pool.close()
+
+  def ends(self, start, end):
+    return(tuple(self.data.rnodes[start]) + tuple(self.data.rnodes[end]))
+
+  def testGetRoutes(self):
+    for n, (start, end) in enumerate(self.pairs):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      for mode in (None, 'bidirectional'):
+        found = {}
+        expected = {}
+        steps = self.pool.getRoutes(*(self.ends(start, end) + (alpha, beta, mode)), stats=found)
+        with graphs.quiet():
+          self.assertEqual(steps, self.direct.getRoutes(*(self.ends(start, end) + (alpha, beta, mode)),
+                                                        stats=expected))
+        self.assertEqual(found['status'], expected['status'])
+        self.assertEqual(found['expanded'], expected['expanded'])
+    # Search budgets go through to the workers
+    start, end = self.pairs[0]
+    found = {}
+    self.pool.getRoutes(*(self.ends(start, end) + (1, .1)), stats=found, maxExpanded=1)
+    self.assertEqual((found['status'], found['limit']), ('gave_up', 'expansions'))
+
+  def testBatch(self):
+    queries = []
+    for start, end in self.pairs:
+      lat1, lon1, lat2, lon2 = self.ends(start, end)
+      queries.append({'curr_lat': lat1, 'curr_lng': lon1, 'dest_lat': lat2, 'dest_lng': lon2})
+    queries.append({'curr_lat': 'x'})
+    found = self.pool.getRoutesBatch(queries, 0.5, 2)
+    with graphs.quiet():
+      self.assertEqual(found, self.direct.getRoutesBatch(queries, 0.5, 2))
+    self.assertEqual(found[-1]['status'], 'bad_query')
+    self.assertEqual(self.pool.getRoutesBatch([]), [])
+
+  def testMatrix(self):
+    nodes = sorted(self.data.rnodes)
+    origins = points(self.data, nodes[::61])
+    destinations = points(self.data, nodes[5::47])
+    self.assertGreater(len(origins), WORKERS)
+    for paths in (False, True):
+      found = self.pool.getMatrix(origins, destinations, 1, .1, paths)
+      self.assertEqual(found, self.direct.getMatrix(origins, destinations, 1, .1, paths))
+    self.assertEqual(self.pool.getMatrix([], destinations), self.direct.getMatrix([], destinations))
+
+  def testMetrics(self):
+    # Every worker's queries are added up in the parent's router
+    queries = []
+    for n, (start, end) in enumerate(self.pairs):
+      self.pool.getRoutes(*(self.ends(start, end) + (1, .1)))
+      with graphs.quiet():
+        self.direct.getRoutes(*(self.ends(start, end) + (1, .1)))
+      lat1, lon1, lat2, lon2 = self.ends(start, end)
+      queries.append({'curr_lat': lat1, 'curr_lng': lon1, 'dest_lat': lat2, 'dest_lng': lon2})
+    self.pool.getRoutesBatch(queries, 2, 0)
+    with graphs.quiet():
+      self.direct.getRoutesBatch(queries, 2, 0)
+    found = self.router.metrics
+    expected = self.direct.metrics
+    self.assertEqual(sum(found.statuses.values()), 2 * len(self.pairs))
+    self.assertEqual(found.statuses, expected.statuses)
+    self.assertEqual(found.phases['total'].count, 2 * len(self.pairs))
+    self.assertEqual(found.expanded.counts, expected.expanded.counts)
+    self.assertEqual(found.expanded.sum, expected.expanded.sum)
+
+class PoolKeeperTest(unittest.TestCase):
+  def setUp(self):
+    self.data = graphs.gridData(20)
+    self.router = Router(data=self.data, compact=True)
+    with graphs.quiet():
+      self.keeper = PoolKeeper(self.router, WORKERS)
+    start, end = graphs.pairs(self.data, 1, seed=3)[0]
+    self.args = tuple(self.data.rnodes[start]) + tuple(self.data.rnodes[end]) + (1, .1)
+    with graphs.quiet():
+      self.expected = Router(data=self.data).getRoutes(*self.args)
+
+  def tearDown(self):
+    self.keeper.close()
+
+  def replace(self):
+    with graphs.quiet():
+      self.keeper.replace()
+
+  def testReplace(self):
+    old = self.keeper.pool
+    self.replace()
+    self.assertIsNot(self.keeper.pool, old)
+    self.assertEqual(self.keeper.processes, WORKERS)
+    # The old pool is closed, and the new one answers
+    self.assertRaises(ValueError, old.getRoutes, *self.args)
+    with self.keeper.using() as pool:
+      self.assertEqual(pool.getRoutes(*self.args), self.expected)
+
+  def testWaitsForRequests(self):
+    replaced = threading.Event()
+    def replace():
+      self.replace()
+      replaced.set()
+    with self.keeper.using() as pool:
+      thread = threading.Thread(target=replace)
+      thread.start()
+      time.sleep(0.2)
+      # Held back until the request is done with the old pool
+      self.assertFalse(replaced.is_set())
+      self.assertIs(self.keeper.pool, pool)
+      self.assertEqual(pool.getRoutes(*self.args), self.expected)
+    self.assertTrue(replaced.wait(30))
+    thread.join()
+    self.assertIsNot(self.keeper.pool, pool)
+
+  def testReplaceUnderLoad(self):
+    # Requests running all through several replacements all succeed
+    errors = []
+    answers = []
+    stop = threading.Event()
+    def requests():
+      while not stop.is_set():
+        try:
+          with self.keeper.using() as pool:
+            answers.append(pool.getRoutes(*self.args))
+        except Exception as e:
+          errors.append(e)
+    threads = [threading.Thread(target=requests) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    try:
+      for i in range(3):
+        time.sleep(0.1)
+        self.replace()
+    finally:
+      stop.set()
+      for thread in threads:
+        thread.join(30)
+    self.assertEqual(errors, [])
+    self.assertGreater(len(answers), 0)
+    for answer in answers:
+      self.assertEqual(answer, self.expected)
+
+if __name__ == '__main__':
+  unittest.main()
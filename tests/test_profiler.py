@@ -0,0 +1,78 @@
+#----------------------------------------------------------------------------
+# Request profiler with calls that overlap
+#----------------------------------------------------------------------------
+import threading
+import unittest
+
+import graphs
+import profiler
+from profiler import RequestProfiler
+
+THREADS = 8
+
+def work(n, barrier=None):
+  if barrier is not None:
+    # Every call is running before any of them finishes
+    barrier.wait(30)
+  return(sum(i * i for i in range(n)))
+
+class BusyProfile:
+  """A cProfile.Profile as Python 3.12 has it when another is active"""
+  def enable(self):
+    raise ValueError('Another profiling tool is already active')
+
+class ProfilerTest(unittest.TestCase):
+  def setUp(self):
+    self.cProfile = profiler.cProfile
+
+  def tearDown(self):
+    profiler.cProfile = self.cProfile
+
+  def overlapping(self, sampler):
+    """Make THREADS calls through sampler at once, and return their
+    results"""
+    barrier = threading.Barrier(THREADS)
+    results = [None] * THREADS
+    def one(i):
+      results[i] = sampler.call(work, 1000 + i, barrier)
+    threads = [threading.Thread(target=one, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(60)
+    return(results)
+
+  def testOverlapping(self):
+    sampler = RequestProfiler(sampleRate=1.0)
+    self.assertEqual(self.overlapping(sampler), [work(1000 + i) for i in range(THREADS)])
+    summary = sampler.summary()
+    self.assertEqual(summary['requests'], THREADS)
+    # Only one of them was run under cProfile
+    self.assertEqual(summary['sampled'], 1)
+    self.assertFalse(sampler.profiling.locked())
+    self.assertIn('work', sampler.report())
+    # Once it is done, the next sampled call is profiled
+    self.assertEqual(sampler.call(work, 10), work(10))
+    self.assertEqual(sampler.summary()['sampled'], 2)
+
+  def testProfilerBusy(self):
+    # Another profiler is active: calls run, and aren't sampled
+    profiler.cProfile = type('cProfile', (), {'Profile': BusyProfile})
+    sampler = RequestProfiler(sampleRate=1.0)
+    self.assertEqual(self.overlapping(sampler), [work(1000 + i) for i in range(THREADS)])
+    self.assertEqual(sampler.summary()['sampled'], 0)
+    self.assertFalse(sampler.profiling.locked())
+
+  def testProfilerFails(self):
+    sampler = RequestProfiler(sampleRate=1.0)
+    def broken(profile, elapsed):
+      raise TypeError('no stats')
+    sampler.record = broken
+    with graphs.quiet():
+      self.assertEqual(sampler.call(work, 10), work(10))
+      self.assertRaises(ZeroDivisionError, sampler.call, lambda: 1 / 0)
+    self.assertFalse(sampler.profiling.locked())
+    self.assertEqual(sampler.active, {})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,103 @@
+#----------------------------------------------------------------------------
+# Reloading risk data while the router is in use
+#----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import graphs
+from route import Router
+
+class ReloadTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.data = graphs.riskData()
+    # A pair of nodes with a route of a few links
+    router = Router(data=self.data)
+    for start, end in graphs.pairs(self.data, 100, seed=5):
+      with graphs.quiet():
+        result, route = router.doRoute(start, end, 1, 0)
+      if result == 'success' and len(route) > 3:
+        break
+    self.start = start
+    self.end = end
+    self.route = route
+    # The same risks, with the route's links made much riskier: in full,
+    # and as a delta file of just those links
+    self.riskier = dict((fr, dict((to, list(risk)) for (to, risk) in links.items()))
+                        for (fr, links) in self.data.routing.items())
+    changes = {}
+    for fr, to in zip(route, route[1:]):
+      self.riskier[fr][to][0] = self.riskier[fr][to][0] + 5
+      changes.setdefault(fr, {})[to] = self.riskier[fr][to]
+    self.fullFile = os.path.join(self.directory, 'routing.csv')
+    self.deltaFile = os.path.join(self.directory, 'delta.csv')
+    graphs.writeRisk(self.fullFile, self.riskier)
+    graphs.writeRisk(self.deltaFile, changes)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def cached(self, router, dataset=None):
+    stats = {}
+    with graphs.quiet():
+      found = router.cachedRoute('forward', self.start, self.end, 1, 0, dataset, stats)
+    return(found, stats)
+
+  def expected(self):
+    data = graphs.riskData()
+    data.routing = self.riskier
+    with graphs.quiet():
+      return(Router(data=data).doRoute(self.start, self.end, 1, 0))
+
+  def testReload(self):
+    expected = self.expected()
+    self.assertNotEqual(expected[1], self.route)
+    for compact in (False, True):
+      for filename, delta in ((self.fullFile, False), (self.deltaFile, True)):
+        router = Router(data=graphs.riskData(), compact=compact)
+        self.assertEqual(self.cached(router)[0], ('success', self.route))
+        old = router.dataset
+        self.assertTrue(router.reloadRisk(filename, delta, wait=True))
+        self.assertEqual(router.riskVersion(), 1)
+        self.assertEqual(router.reloadState['state'], 'idle')
+        found, stats = self.cached(router)
+        self.assertFalse(stats['cached'])
+        self.assertEqual(found, expected)
+        # A query that picked up the old data still finishes on it
+        self.assertEqual(self.cached(router, old)[0], ('success', self.route))
+        self.assertEqual(self.cached(router)[0], expected)
+
+  def testBackground(self):
+    router = Router(data=self.data)
+    self.cached(router)
+    versions = []
+    done = threading.Event()
+    def reloaded(version):
+      versions.append(version)
+      done.set()
+    self.assertTrue(router.reloadRisk(self.fullFile, done=reloaded))
+    self.assertTrue(done.wait(30))
+    self.assertEqual(versions, [1])
+    self.assertEqual(self.cached(router)[0], self.expected())
+
+  def testOneAtATime(self):
+    router = Router(data=self.data)
+    router.reloadLock.acquire()
+    try:
+      self.assertFalse(router.reloadRisk(self.fullFile, wait=True))
+    finally:
+      router.reloadLock.release()
+    self.assertEqual(router.riskVersion(), 0)
+
+  def testFailed(self):
+    router = Router(data=self.data)
+    self.assertTrue(router.reloadRisk(os.path.join(self.directory, 'none.csv'), wait=True))
+    self.assertEqual(router.reloadState['state'], 'failed')
+    self.assertEqual(router.riskVersion(), 0)
+    self.assertEqual(self.cached(router)[0], ('success', self.route))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+#----------------------------------------------------------------------------
+# Chunked risk file reader against the line-at-a-time parser
+#----------------------------------------------------------------------------
+import os
+import shutil
+import random
+import tempfile
+import unittest
+
+import graphs
+import riskCsv
+
+def lines(count, width, seed=1):
+  """count random risk file lines of width fields"""
+  rnd = random.Random(seed)
+  found = []
+  for i in range(count):
+    fields = [str(rnd.randint(1, 10 ** 9)), str(rnd.randint(1, 10 ** 9))]
+    fields.extend(repr(rnd.uniform(-90, 90)) for j in range(width - 4))
+    fields.extend(repr(rnd.gauss(0, 1)) for j in range(2))
+    found.append(','.join(fields) + '\n')
+  return(found)
+
+class RiskCsvTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'routing.csv')
+    self.numpy = riskCsv.numpy
+
+  def tearDown(self):
+    riskCsv.numpy = self.numpy
+    shutil.rmtree(self.directory)
+
+  def write(self, text, newline='\n'):
+    with open(self.filename, 'w', newline=newline) as f:
+      f.write(text)
+
+  def reference(self, positions):
+    """The file read by the line parser alone"""
+    columns = riskCsv.RiskColumns()
+    if positions:
+      columns.positions = tuple([] for i in range(4))
+    with open(self.filename) as f:
+      riskCsv.addLines(columns, f.readlines())
+    return(columns)
+
+  def check(self, positions=False, chunkSizes=(riskCsv.CHUNK_SIZE, 200)):
+    """Read the file with NumPy (if installed) and without, in big and
+    small chunks, and compare with the line parser"""
+    expected = self.reference(positions)
+    for numpy in set([self.numpy, None]):
+      riskCsv.numpy = numpy
+      for chunkSize in chunkSizes:
+        columns = riskCsv.readColumns(self.filename, positions, chunkSize)
+        for name in ('parents', 'children', 'risk0', 'risk1'):
+          self.assertEqual(list(getattr(columns, name)), list(getattr(expected, name)))
+        if expected.positions is None:
+          self.assertIsNone(columns.positions)
+        else:
+          self.assertEqual([list(c) for c in columns.positions], [list(c) for c in expected.positions])
+    return(expected)
+
+  def testBundledFile(self):
+    shutil.copy(graphs.RISK_FILE, self.filename)
+    self.assertGreater(len(self.check(chunkSizes=(riskCsv.CHUNK_SIZE, 4096))), 1000)
+
+  def testPositionColumns(self):
+    self.write(''.join(lines(50, 8)))
+    columns = self.check(positions=True)
+    self.assertEqual(len(columns.positions[0]), 50)
+    # Without positions asked for, the risks are still the last two fields
+    self.check()
+
+  def testCrlf(self):
+    self.write(''.join(lines(50, 4)), newline='\r\n')
+    with open(self.filename, 'rb') as f:
+      self.assertIn(b'\r\n', f.read())
+    self.check()
+
+  def testNoFinalNewline(self):
+    self.write(''.join(lines(10, 4))[:-1])
+    self.assertEqual(len(self.check()), 10)
+
+  def testRagged(self):
+    # A 3-field and a 5-field line have as many commas as two 4-field lines
+    ragged = lines(20, 4)
+    ragged[5] = '11,12,0.5\n'
+    ragged[9] = '13,14,40.7,0.25,0.75\n'
+    self.write(''.join(ragged))
+    columns = self.check()
+    self.assertEqual((columns.parents[9], columns.risk0[9], columns.risk1[9]), (13, 0.25, 0.75))
+    # Some lines with positions and some without: none are kept
+    self.write(''.join(lines(10, 8) + lines(10, 4, seed=2)))
+    self.assertIsNone(self.check(positions=True).positions)
+
+  def testBlankLines(self):
+    self.write(''.join(lines(5, 4)) + '\n' + ''.join(lines(5, 4, seed=2)))
+    self.assertEqual(len(self.check()), 10)
+
+if __name__ == '__main__':
+  unittest.main()
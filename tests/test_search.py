@@ -0,0 +1,147 @@
+#----------------------------------------------------------------------------
+# Searches on the bundled routing.csv against reference searches
+#
+# The forward search has to give exactly the routes the original
+# sorted-list search did, which referenceRoute keeps a copy of.  The
+# searches that promise the cheapest route are checked against a plain
+# Dijkstra.
+#----------------------------------------------------------------------------
+import gc
+import math
+import weakref
+import unittest
+
+import graphs
+from route import Router
+from compactGraph import CompactGraph
+
+def referenceRoute(data, start, end, alpha, beta):
+  """The original Router.doRoute: a queue kept sorted by inserting into a
+  list, a closed list, and routes carried along as comma-joined strings"""
+  def distance(n1, n2):
+    lat1, lon1 = data.rnodes[n1]
+    lat2, lon2 = data.rnodes[n2]
+    return(math.sqrt((lat2 - lat1) ** 2 + (lon2 - lon1) ** 2))
+
+  def addToQueue(fr, to, queueSoFar, weight):
+    for test in queue:
+      if test['end'] == to:
+        return
+    if weight == 0:
+      return
+    cost = alpha * math.exp(data.routing[fr][to][0]) + beta * math.exp(data.routing[fr][to][1])
+    distanceSoFar = queueSoFar['distance']
+    item = {'distance': distanceSoFar + cost,
+            'maxdistance': distanceSoFar + distance(to, end),
+            'nodes': queueSoFar['nodes'] + "," + str(to),
+            'end': to}
+    for count, test in enumerate(queue):
+      if test['maxdistance'] > item['maxdistance']:
+        queue.insert(count, item)
+        break
+    else:
+      queue.append(item)
+
+  closed = [start]
+  queue = []
+  blank = {'end': -1, 'distance': 0, 'nodes': str(start)}
+  try:
+    for i, weight in data.routing[start].items():
+      addToQueue(start, i, blank, weight)
+  except KeyError:
+    return('no_such_node', [])
+  count = 0
+  while count < 1000000:
+    count = count + 1
+    try:
+      item = queue.pop(0)
+    except IndexError:
+      return('no_route', [])
+    x = item['end']
+    if x in closed:
+      continue
+    if x == end:
+      return('success', [int(i) for i in item['nodes'].split(",")])
+    closed.append(x)
+    try:
+      for i, weight in data.routing[x].items():
+        if not i in closed:
+          addToQueue(x, i, item, weight)
+    except KeyError:
+      pass
+  return('gave_up', [])
+
+class ForwardSearchTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.data = graphs.riskData()
+    cls.router = Router(data=cls.data)
+
+  def testSameRoutesAsReference(self):
+    for n, (start, end) in enumerate(graphs.pairs(self.data, 24)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      with graphs.quiet():
+        found = self.router.doRoute(start, end, alpha, beta)
+      self.assertEqual(found, referenceRoute(self.data, start, end, alpha, beta))
+
+  def testGridSameRoutesAsReference(self):
+    # Lots of nodes on a grid are the same distance from the end, so this
+    # checks that equal queue entries still come off in the old order
+    data = graphs.gridData(12)
+    router = Router(data=data)
+    for n, (start, end) in enumerate(graphs.pairs(data, 24, seed=4)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      with graphs.quiet():
+        found = router.doRoute(start, end, alpha, beta)
+      self.assertEqual(found, referenceRoute(data, start, end, alpha, beta))
+
+  def testUnknownStart(self):
+    with graphs.quiet():
+      result, route = self.router.doRoute(-1, min(self.data.routing))
+    self.assertEqual((result, route), ('no_such_node', []))
+
+  def testUnknownMode(self):
+    start, end = graphs.pairs(self.data, 1)[0]
+    with self.assertRaises(ValueError):
+      self.router.search(start, end, mode='sideways')
+
+  def testCompactGraphSameRoutes(self):
+    compact = Router(data=self.data, compact=True)
+    self.assertIsInstance(compact.graph, CompactGraph)
+    for start, end in graphs.pairs(self.data, 40, seed=2):
+      with graphs.quiet():
+        self.assertEqual(compact.doRoute(start, end), self.router.doRoute(start, end))
+
+  def testCompactGraphDropsDicts(self):
+    data = graphs.riskData()
+    held = weakref.ref(data)
+    compact = Router(data=data, compact=True)
+    del data
+    gc.collect()
+    # Nothing in the router keeps the LoadOsm dicts alive
+    self.assertIsNone(held())
+    self.assertIsNone(compact.data)
+    start, end = graphs.pairs(self.data, 1, seed=2)[0]
+    with graphs.quiet():
+      self.assertEqual(compact.doRoute(start, end), self.router.doRoute(start, end))
+
+class ShortestSearchTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.data = graphs.riskData()
+    cls.router = Router(data=cls.data, compact=True)
+
+  def testBidirectionalIsCheapest(self):
+    for n, (start, end) in enumerate(graphs.pairs(self.data, 40, seed=3)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      best = graphs.dijkstra(self.router.graph, start, alpha, beta).get(end)
+      result, route = self.router.doRouteBidirectional(start, end, alpha, beta)
+      if best is None:
+        self.assertEqual(result, 'no_route')
+        continue
+      self.assertEqual(result, 'success')
+      self.assertEqual((route[0], route[-1]), (start, end))
+      self.assertAlmostEqual(graphs.routeCost(self.data, route, alpha, beta), best)
+
+if __name__ == '__main__':
+  unittest.main()
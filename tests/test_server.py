@@ -0,0 +1,91 @@
+#----------------------------------------------------------------------------
+# The HTTP server: its routing set up, from its command line, and /metrics
+#----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+import graphs
+import route
+try:
+  import server
+except ImportError:  # cherrypy isn't installed
+  server = None
+
+@unittest.skipIf(server is None, "needs cherrypy")
+class ServerTest(unittest.TestCase):
+  def setUp(self):
+    # The server reads lowertown.osm and routing.csv from where it runs
+    self.cwd = os.getcwd()
+    self.directory = tempfile.mkdtemp()
+    os.chdir(self.directory)
+    self.nodes, ways = benchmark.gridGraph(400)
+    benchmark.writeOsm('lowertown.osm', self.nodes, ways)
+    benchmark.writeRisk('routing.csv', ways)
+    self.landmarkSearch = route.Search.landmarkSearch
+    self.landmarkSearches = 0
+
+  def tearDown(self):
+    route.Search.landmarkSearch = self.landmarkSearch
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def countLandmarkSearches(self):
+    test = self
+    def counted(search, start, end):
+      test.landmarkSearches = test.landmarkSearches + 1
+      return(test.landmarkSearch(search, start, end))
+    route.Search.landmarkSearch = counted
+
+  def query(self, app):
+    ids = sorted(self.nodes)
+    start = self.nodes[ids[0]]
+    end = self.nodes[ids[-1]]
+    with graphs.quiet():
+      return(app.routeQuery(start[0], start[1], end[0], end[1], 1, .1, None, None, None, 0))
+
+  def testLandmarks(self):
+    args = server.parseArgs(['--landmarks', '--landmark-count', '3'])
+    self.assertEqual((args.landmarks, args.landmark_count), (True, 3))
+    with graphs.quiet():
+      app = server.makeServer(args)
+    self.assertIsNotNone(app.route.landmarks)
+    self.assertEqual(len(app.route.landmarks.nodes), 3)
+    self.assertTrue(os.path.exists('routing.csv.landmarks'))
+    self.countLandmarkSearches()
+    found = self.query(app)
+    self.assertEqual(found['status'], 'success')
+    self.assertGreater(self.landmarkSearches, 0)
+    # The cheapest route, as bidirectional search finds it
+    ends = self.nodes[min(self.nodes)] + self.nodes[max(self.nodes)]
+    with graphs.quiet():
+      self.assertEqual(found['coords'], route.Router().getRoutes(*(ends + (1, .1, 'bidirectional'))))
+
+  def testNoLandmarks(self):
+    args = server.parseArgs([])
+    self.assertEqual((args.landmarks, args.landmark_count), (False, 6))
+    with graphs.quiet():
+      app = server.makeServer(args)
+    self.assertIsNone(app.route.landmarks)
+    self.countLandmarkSearches()
+    self.assertEqual(self.query(app)['status'], 'success')
+    self.assertEqual(self.landmarkSearches, 0)
+
+  def testMetrics(self):
+    with graphs.quiet():
+      app = server.makeServer(server.parseArgs([]))
+    self.assertEqual(self.query(app)['status'], 'success')
+    text = app.metrics()
+    self.assertTrue(server.cherrypy.response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+    lines = text.splitlines()
+    self.assertIn('pyroute_queries_total{status="success"} 1', lines)
+    self.assertIn('pyroute_query_phase_seconds_count{phase="total"} 1', lines)
+    self.assertIn('pyroute_query_phase_seconds_bucket{phase="search",le="+Inf"} 1', lines)
+    self.assertIn('# TYPE pyroute_risk_version gauge', lines)
+    self.assertIn('pyroute_risk_version 0', lines)
+    self.assertIn('pyroute_worker_processes 0', lines)
+
+if __name__ == '__main__':
+  unittest.main()
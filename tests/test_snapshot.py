@@ -0,0 +1,124 @@
+#----------------------------------------------------------------------------
+# Binary snapshots of the compact graph
+#----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+
+import graphs
+from route import Search
+from compactGraph import CompactGraph, SNAPSHOT_HEADER, loadSnapshot
+
+OSM = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="40.700" lon="-74.000"/>
+  <node id="2" lat="40.701" lon="-74.000"/>
+  <node id="3" lat="40.701" lon="-74.001"/>
+  <way id="10">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <tag k="highway" v="footway"/>
+  </way>
+</osm>
+'''
+
+class SnapshotTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'graph.snap')
+    self.source = os.path.join(self.directory, 'routing.csv')
+    shutil.copy(graphs.RISK_FILE, self.source)
+    self.data = graphs.riskData()
+    self.graph = CompactGraph.fromLoadOsm(self.data)
+    self.graph.saveSnapshot(self.filename, [self.source], transport='foot')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testSameGraph(self):
+    mapped = CompactGraph.openSnapshot(self.filename, [self.source], verify=True)
+    self.assertIsNotNone(mapped)
+    self.assertEqual(mapped.meta['transport'], 'foot')
+    for saved, loaded in zip(self.graph.arrays(), mapped.arrays()):
+      self.assertEqual(list(saved), list(loaded))
+    for start, end in graphs.pairs(self.data, 20):
+      for mode in ('forward', 'bidirectional'):
+        with graphs.quiet():
+          expected = Search(self.graph, start, end, 1, .1).run(mode)
+          found = Search(mapped, start, end, 1, .1).run(mode)
+        self.assertEqual(found, expected)
+
+  def testStale(self):
+    with open(self.source, 'a') as f:
+      f.write('1,2,0.5,0.5\n')
+    self.assertIsNone(CompactGraph.openSnapshot(self.filename, [self.source]))
+    # Without sources to compare, it still opens
+    self.assertIsNotNone(CompactGraph.openSnapshot(self.filename))
+
+  def testDamaged(self):
+    with open(self.filename, 'r+b') as f:
+      f.seek(-8, os.SEEK_END)
+      f.write(b'\xff' * 8)
+    self.assertIsNotNone(CompactGraph.openSnapshot(self.filename, [self.source]))
+    self.assertIsNone(CompactGraph.openSnapshot(self.filename, [self.source], verify=True))
+
+  def testTruncated(self):
+    with open(self.filename, 'r+b') as f:
+      f.truncate(os.path.getsize(self.filename) - 8)
+    self.assertIsNone(CompactGraph.openSnapshot(self.filename))
+    with open(self.filename, 'r+b') as f:
+      f.truncate(SNAPSHOT_HEADER.size - 1)
+    self.assertIsNone(CompactGraph.openSnapshot(self.filename))
+
+  def testDamagedMetadata(self):
+    for damage in (b'\xff', b'x'):
+      with open(self.filename, 'r+b') as f:
+        f.seek(SNAPSHOT_HEADER.size)
+        f.write(damage)
+      self.assertIsNone(CompactGraph.openSnapshot(self.filename))
+
+  def testRebuildDamaged(self):
+    osmFile = os.path.join(self.directory, 'map.osm')
+    riskFile = os.path.join(self.directory, 'risk.csv')
+    with open(osmFile, 'w') as f:
+      f.write(OSM)
+    with open(riskFile, 'w') as f:
+      f.write('1,2,0.1,0.2\n2,3,0.3,0.4\n3,2,0.5,0.6\n')
+    built = loadSnapshot(self.filename, osmFile, riskFile, 'foot')
+    expected = [list(a) for a in built.arrays()]
+    self.assertEqual(expected[0], [1, 2, 3])
+    # Damaged metadata, and a damaged payload that only the checksum shows
+    for offset, damage in ((SNAPSHOT_HEADER.size, b'\xff'), (-8, b'\xff' * 8)):
+      with open(self.filename, 'r+b') as f:
+        f.seek(offset, os.SEEK_SET if offset >= 0 else os.SEEK_END)
+        f.write(damage)
+      graph = loadSnapshot(self.filename, osmFile, riskFile, 'foot', verify=True)
+      self.assertIsNotNone(graph)
+      self.assertEqual([list(a) for a in graph.arrays()], expected)
+
+  def testChecksumOptional(self):
+    osmFile = os.path.join(self.directory, 'map.osm')
+    riskFile = os.path.join(self.directory, 'risk.csv')
+    with open(osmFile, 'w') as f:
+      f.write(OSM)
+    with open(riskFile, 'w') as f:
+      f.write('1,2,0.1,0.2\n2,3,0.3,0.4\n3,2,0.5,0.6\n')
+    built = loadSnapshot(self.filename, osmFile, riskFile, 'foot')
+    expected = [list(a) for a in built.arrays()]
+    with open(self.filename, 'r+b') as f:
+      f.seek(-8, os.SEEK_END)
+      f.write(b'\xff' * 8)
+    # By default only the header and the sources are checked, so the damage
+    # goes unseen
+    graph = loadSnapshot(self.filename, osmFile, riskFile, 'foot')
+    self.assertNotEqual([list(a) for a in graph.arrays()], expected)
+    graph = loadSnapshot(self.filename, osmFile, riskFile, 'foot', verify=True)
+    self.assertEqual([list(a) for a in graph.arrays()], expected)
+
+  def testMissing(self):
+    self.assertIsNone(CompactGraph.openSnapshot(os.path.join(self.directory, 'none.snap')))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+#----------------------------------------------------------------------------
+# One Router serving many threads at once
+#----------------------------------------------------------------------------
+import sys
+import threading
+import unittest
+
+import graphs
+from route import Router
+
+def queries(data, count, seed=1):
+  """(lat1, lon1, lat2, lon2, alpha, beta, mode) for count random pairs"""
+  found = []
+  for n, (start, end) in enumerate(graphs.pairs(data, count, seed)):
+    alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+    mode = ('forward', 'bidirectional')[n % 2]
+    found.append(tuple(data.rnodes[start]) + tuple(data.rnodes[end]) + (alpha, beta, mode))
+  return(found)
+
+class ThreadsTest(unittest.TestCase):
+  def checkThreaded(self, router, expected, work, threads=8):
+    results = [None] * len(work)
+    errors = []
+    def serve(i):
+      try:
+        for j in range(i, len(work), threads):
+          results[j] = router.getRoutes(*work[j])
+      except Exception as e:
+        errors.append(e)
+    # Switch threads often, so that searches really do interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    with graphs.quiet():
+      running = [threading.Thread(target=serve, args=(i,)) for i in range(threads)]
+      for thread in running:
+        thread.start()
+      for thread in running:
+        thread.join()
+    sys.setswitchinterval(interval)
+    self.assertEqual(errors, [])
+    self.assertEqual(results, expected)
+
+  def testSameAsSequential(self):
+    data = graphs.gridData(20)
+    work = queries(data, 120)
+    for compact in (False, True):
+      with graphs.quiet():
+        expected = [Router(data=data, compact=compact).getRoutes(*query) for query in work]
+      router = Router(data=data, compact=compact)
+      # Once searching, and again from the cache
+      self.checkThreaded(router, expected, work)
+      self.checkThreaded(router, expected, work)
+
+  def testHierarchyNotBuiltOnDemand(self):
+    data = graphs.gridData(5)
+    router = Router(data=data)
+    start, end = graphs.pairs(data, 1)[0]
+    search = router.search(start, end, mode='hierarchy')
+    self.assertEqual(search.result, 'no_hierarchy')
+    self.assertIsNone(router.hierarchy)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+#----------------------------------------------------------------------------
+# Tile numbering for many points at once, and the tiles along a line
+#----------------------------------------------------------------------------
+import random
+import unittest
+
+import tilenames
+
+ZOOM = 15
+
+def randomPoints(count, seed=1):
+  rnd = random.Random(seed)
+  return([(rnd.uniform(-85, 85), rnd.uniform(-180, 180)) for i in range(count)])
+
+def crossed(x1, y1, x2, y2, steps=2000):
+  """Tiles under points spaced evenly along a tile-space line"""
+  return(set((int(x1 + (x2 - x1) * i / steps), int(y1 + (y2 - y1) * i / steps))
+             for i in range(steps + 1)))
+
+class ArrayTest(unittest.TestCase):
+  """The ...Array functions, with NumPy (if installed) and without, against
+  the functions for one point"""
+  def setUp(self):
+    self.numpy = tilenames.numpy
+    self.points = randomPoints(200)
+    # Around New York too, where the tiles are small
+    self.points.extend((40.7 + i * 0.001, -74.0 - i * 0.0013) for i in range(50))
+    self.lats = [lat for (lat, lon) in self.points]
+    self.lons = [lon for (lat, lon) in self.points]
+
+  def tearDown(self):
+    tilenames.numpy = self.numpy
+
+  def branches(self):
+    for numpy in set([self.numpy, None]):
+      tilenames.numpy = numpy
+      yield(numpy)
+
+  def assertClose(self, found, expected):
+    found = [float(i) for i in found]
+    self.assertEqual(len(found), len(expected))
+    for a, b in zip(found, expected):
+      self.assertAlmostEqual(a, b, delta=1e-9 * max(1, abs(b)))
+
+  def testLatLon(self):
+    for numpy in self.branches():
+      x, y = tilenames.latlon2relativeXYArray(self.lats, self.lons)
+      expected = [tilenames.latlon2relativeXY(lat, lon) for (lat, lon) in self.points]
+      self.assertClose(x, [i for (i, j) in expected])
+      self.assertClose(y, [j for (i, j) in expected])
+      x, y = tilenames.latlon2xyArray(self.lats, self.lons, ZOOM)
+      expected = [tilenames.latlon2xy(lat, lon, ZOOM) for (lat, lon) in self.points]
+      self.assertClose(x, [i for (i, j) in expected])
+      self.assertClose(y, [j for (i, j) in expected])
+
+  def testTileXY(self):
+    for numpy in self.branches():
+      for z in (0, 10, ZOOM, 18):
+        x, y = tilenames.tileXYArray(self.lats, self.lons, z)
+        expected = [tilenames.tileXY(lat, lon, z) for (lat, lon) in self.points]
+        self.assertEqual(list(zip([int(i) for i in x], [int(j) for j in y])), expected)
+
+  def testEdges(self):
+    tiles = [tilenames.tileXY(lat, lon, ZOOM) for (lat, lon) in self.points]
+    xs = [x for (x, y) in tiles]
+    ys = [y for (x, y) in tiles]
+    for numpy in self.branches():
+      lat, lon = tilenames.xy2latlonArray(xs, ys, ZOOM)
+      expected = [tilenames.xy2latlon(x, y, ZOOM) for (x, y) in tiles]
+      self.assertClose(lat, [i for (i, j) in expected])
+      self.assertClose(lon, [j for (i, j) in expected])
+      edges = tilenames.tileEdgesArray(xs, ys, ZOOM)
+      self.assertEqual(len(edges), 4)
+      expected = [tilenames.tileEdges(x, y, ZOOM) for (x, y) in tiles]
+      for i in range(4):
+        self.assertClose(edges[i], [e[i] for e in expected])
+
+  def testEmpty(self):
+    for numpy in self.branches():
+      for found in (tilenames.latlon2relativeXYArray([], []), tilenames.latlon2xyArray([], [], ZOOM),
+                    tilenames.tileXYArray([], [], ZOOM), tilenames.xy2latlonArray([], [], ZOOM)):
+        self.assertEqual([len(column) for column in found], [0, 0])
+      self.assertEqual([len(column) for column in tilenames.tileEdgesArray([], [], ZOOM)], [0] * 4)
+
+class LineTest(unittest.TestCase):
+  def checkSteps(self, tiles):
+    """Each tile is next to the one before, and none comes twice"""
+    self.assertEqual(len(set(tiles)), len(tiles))
+    for (x1, y1), (x2, y2) in zip(tiles, tiles[1:]):
+      self.assertEqual(abs(x2 - x1) + abs(y2 - y1), 1)
+
+  def testLineTiles(self):
+    rnd = random.Random(2)
+    # Every direction, along an axis, and within one tile
+    lines = [(10.5, 10.5, 13.2, 10.5), (10.5, 10.5, 7.2, 10.5), (10.5, 10.5, 10.5, 14.9),
+             (10.5, 10.5, 10.5, 6.1), (10.5, 10.5, 10.7, 10.9), (10.5, 10.5, 10.5, 10.5)]
+    for i in range(200):
+      lines.append(tuple(rnd.uniform(0, 20) for j in range(4)))
+    for x1, y1, x2, y2 in lines:
+      tiles = list(tilenames.lineTiles(x1, y1, x2, y2))
+      self.assertEqual(tiles[0], (int(x1), int(y1)))
+      self.assertEqual(tiles[-1], (int(x2), int(y2)))
+      self.assertEqual(len(tiles), abs(int(x2) - int(x1)) + abs(int(y2) - int(y1)) + 1)
+      self.checkSteps(tiles)
+      self.assertTrue(crossed(x1, y1, x2, y2) <= set(tiles))
+
+  def testAlongLine(self):
+    self.assertEqual(tilenames.tilesAlongLine([], ZOOM), [])
+    point = (40.7, -74.0)
+    self.assertEqual(tilenames.tilesAlongLine([point], ZOOM), [tilenames.tileXY(point[0], point[1], ZOOM)])
+    for seed in range(20):
+      rnd = random.Random(seed)
+      points = [(40.7 + rnd.uniform(-0.05, 0.05), -74.0 + rnd.uniform(-0.05, 0.05)) for i in range(4)]
+      tiles = tilenames.tilesAlongLine(points, ZOOM)
+      xy = [tilenames.latlon2xy(lat, lon, ZOOM) for (lat, lon) in points]
+      self.assertEqual(tiles[0], tilenames.tileXY(points[0][0], points[0][1], ZOOM))
+      self.assertEqual(len(set(tiles)), len(tiles))
+      expected = set()
+      for (x1, y1), (x2, y2) in zip(xy, xy[1:]):
+        expected.update(tilenames.lineTiles(x1, y1, x2, y2))
+        self.assertTrue(crossed(x1, y1, x2, y2) <= set(tiles))
+      self.assertEqual(set(tiles), expected)
+      # One leg: in order from one end to the other
+      tiles = tilenames.tilesAlongLine(points[:2], ZOOM)
+      self.checkSteps(tiles)
+      self.assertEqual(tiles[-1], tilenames.tileXY(points[1][0], points[1][1], ZOOM))
+
+  def testBox(self):
+    s, w, n, e = tilenames.tileEdges(100, 200, 10)
+    # A box inside one tile, and one from the middle of a tile to the
+    # middle of another, two across and three down
+    self.assertEqual(tilenames.tilesInBox(s + 0.01, w + 0.01, n - 0.01, e - 0.01, 10), [(100, 200)])
+    n, w = tilenames.xy2latlon(100.5, 200.5, 10)
+    s, e = tilenames.xy2latlon(101.5, 202.5, 10)
+    tiles = tilenames.tilesInBox(s, w, n, e, 10)
+    self.assertEqual(tiles, [(x, y) for y in (200, 201, 202) for x in (100, 101)])
+
+if __name__ == '__main__':
+  unittest.main()
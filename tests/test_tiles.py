@@ -0,0 +1,295 @@
+#----------------------------------------------------------------------------
+# Tiles: their binary graph files, the tile store, and tile downloads
+#----------------------------------------------------------------------------
+import os
+import shutil
+import time
+import tempfile
+import unittest
+
+import graphs
+import tiledata
+import tilenames
+from route import Router
+from tiledGraph import Tile, TileStore, TILE_HEADER
+
+ZOOM = 15
+
+def writeTileTree(directory, data, name='%s/%d/%d/%d/data.osm.pkl'):
+  """Write a LoadOsm's nodes and links out as OSM data for each zoom-15
+  tile, holding every link that touches the tile, as a download would.
+  name is filled in with directory and the tile's zoom, x and y.  Returns
+  the tiles written."""
+  home = dict((node, tilenames.tileXY(pos[0], pos[1], ZOOM)) for (node, pos) in data.rnodes.items())
+  tiles = {}
+  for fr, links in data.routing.items():
+    for to in links:
+      if fr < to or not fr in data.routing.get(to, {}):
+        for key in set([home[fr], home[to]]):
+          tiles.setdefault(key, []).append((fr, to))
+  for (x, y), ways in tiles.items():
+    filename = name % (directory, ZOOM, x, y)
+    if not os.path.exists(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+      f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+      for node in sorted(set(node for way in ways for node in way)):
+        f.write(' <node id="%d" lat="%r" lon="%r"/>\n' % (node, data.rnodes[node][0], data.rnodes[node][1]))
+      for i, (fr, to) in enumerate(ways):
+        f.write(' <way id="%d"><nd ref="%d"/><nd ref="%d"/><tag k="highway" v="residential"/></way>\n'
+                % (i + 1, fr, to))
+      f.write('</osm>\n')
+  return(sorted(tiles))
+
+def sampleTile():
+  """A tile of three own nodes, linked to each other and to a node beyond
+  the tile's edge"""
+  positions = {1: (40.70, -74.00), 2: (40.70, -74.01), 3: (40.71, -74.00), 9: (40.80, -74.00)}
+  links = {1: {2: 1.0, 3: 2.0}, 2: {1: 1.0}, 3: {9: 3.0}}
+  reverse = {1: {2: 1.0}, 2: {1: 1.0}, 3: {1: 2.0, 9: 3.0}}
+  return(Tile((9647, 12320), links, reverse, positions, 1234567890.5))
+
+class TileFileTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'graph-foot.bin')
+    self.tile = sampleTile()
+    self.tile.save(self.filename, 'foot', 15)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testSameTile(self):
+    tile = Tile.read(self.filename, 'foot', 15, self.tile.key)
+    self.assertIsNotNone(tile)
+    self.assertEqual(tile.key, self.tile.key)
+    self.assertEqual(tile.created, self.tile.created)
+    self.assertEqual(tile.links, self.tile.links)
+    self.assertEqual(tile.reverse, self.tile.reverse)
+    self.assertEqual(tile.positions, self.tile.positions)
+    self.assertEqual(tile.grid.nearest(40.7001, -74.0001), [1])
+    self.assertEqual(tile.size(), self.tile.size())
+
+  def testOtherTile(self):
+    self.assertIsNone(Tile.read(self.filename, 'cycle', 15, self.tile.key))
+    self.assertIsNone(Tile.read(self.filename, 'foot', 16, self.tile.key))
+    self.assertIsNone(Tile.read(self.filename, 'foot', 15, (9647, 12321)))
+
+  def testDamaged(self):
+    with open(self.filename, 'r+b') as f:
+      f.seek(TILE_HEADER.size)
+      f.write(b'\xff')
+    self.assertIsNone(Tile.read(self.filename, 'foot', 15, self.tile.key))
+
+  def testTruncated(self):
+    with open(self.filename, 'r+b') as f:
+      f.truncate(os.path.getsize(self.filename) - 1)
+    self.assertIsNone(Tile.read(self.filename, 'foot', 15, self.tile.key))
+
+  def testMissing(self):
+    self.assertIsNone(Tile.read(os.path.join(self.directory, 'none.bin'), 'foot', 15, self.tile.key))
+
+class TiledGraphTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    # A street grid about three tiles across, with links both ways (the
+    # foot routing in tiles ignores oneway streets)
+    cls.data = graphs.gridData(40, oneWay=0)
+    cls.directory = tempfile.mkdtemp()
+    cls.cacheDir = os.path.join(cls.directory, 'cache')
+    cls.tiles = writeTileTree(cls.cacheDir, cls.data)
+    cls.riskFile = os.path.join(cls.directory, 'routing.csv')
+    graphs.writeRisk(cls.riskFile, cls.data.routing)
+    cls.full = Router(data=cls.data)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  def checkSameRoutes(self, router, count, seed=1, modes=('forward', 'bidirectional')):
+    for n, (start, end) in enumerate(graphs.pairs(self.data, count, seed)):
+      alpha, beta = graphs.WEIGHTINGS[n % len(graphs.WEIGHTINGS)]
+      ends = tuple(self.data.rnodes[start]) + tuple(self.data.rnodes[end])
+      for mode in modes:
+        with graphs.quiet():
+          found = router.getRoutes(*(ends + (alpha, beta, mode)))
+          expected = self.full.getRoutes(*(ends + (alpha, beta, mode)))
+        self.assertEqual(found, expected)
+        self.assertTrue(found)
+
+  def testSameRoutes(self):
+    self.assertGreater(len(self.tiles), 4)
+    router = Router(tiles=self.cacheDir, riskFile=self.riskFile)
+    self.checkSameRoutes(router, 20)
+    # Every tile was built into a graph file
+    store = router.graph.store
+    for x, y in self.tiles:
+      self.assertTrue(os.path.exists(store.graphFile((x, y))))
+
+  def testOnDemand(self):
+    store = TileStore(self.cacheDir, 'foot', prefetchTiles=0)
+    router = Router(tiles=self.cacheDir, riskFile=self.riskFile)
+    router.graph.store = store
+    self.assertEqual(store.loads, 0)
+    # Two nodes near each other in one corner only need the tiles there
+    start = min(self.data.rnodes)
+    end = start + 41
+    ends = tuple(self.data.rnodes[start]) + tuple(self.data.rnodes[end])
+    with graphs.quiet():
+      self.assertEqual(router.getRoutes(*(ends + (1, .1))), self.full.getRoutes(*(ends + (1, .1))))
+    self.assertGreater(store.loads, 0)
+    self.assertLess(len(store.loadedTiles()), len(self.tiles))
+
+  def testBudget(self):
+    # Less than a tile: tiles are dropped and loaded again all the time
+    router = Router(tiles=self.cacheDir, riskFile=self.riskFile, tileBudget=20000)
+    self.checkSameRoutes(router, 3, seed=2, modes=('forward',))
+    store = router.graph.store
+    self.assertGreater(store.tiles.evictions, 0)
+    self.assertGreater(store.loads, len(self.tiles))
+    self.assertEqual(len(store.loadedTiles()), 1)
+
+  def testDroppedHomes(self):
+    router = Router(tiles=self.cacheDir, riskFile=self.riskFile, tileBudget=20000)
+    self.checkSameRoutes(router, 2, seed=3, modes=('forward',))
+    store = router.graph.store
+    # Only the loaded tile's nodes are in homes; the rest are in dropped,
+    # and what they use comes out of the budget
+    loaded = set(tile.key for tile in store.loadedTiles())
+    self.assertTrue(set(store.homes.values()) <= loaded | set(store.dropped))
+    self.assertLess(len(store.homes), len(self.data.rnodes))
+    self.assertEqual(store.droppedCount, sum(len(ids) for ids in store.dropped.values()))
+    self.assertEqual(store.tiles.maxsize, 20000 - 8 * store.droppedCount)
+    for node in self.data.rnodes:
+      if node in store.homes:
+        continue
+      home = store.home(node)
+      self.assertNotIn(home, loaded)
+      self.assertEqual(router.graph.position(node), tuple(self.data.rnodes[node]))
+      # That loaded its tile again, so it is back in homes
+      self.assertEqual(store.homes[node], home)
+      self.assertNotIn(node, store.dropped.get(home, ()))
+      break
+    else:
+      self.fail("No node was dropped")
+    nodes = store.nodeIds()
+    self.assertEqual(len(nodes), len(set(nodes)))
+    self.assertTrue(set(nodes) <= set(self.data.rnodes))
+    self.assertRaises(KeyError, store.home, -1)
+
+  def testNotCombined(self):
+    for option in ('compact', 'snapshot', 'hierarchy', 'landmarks'):
+      with self.assertRaises(ValueError):
+        Router(tiles=self.cacheDir, riskFile=self.riskFile, **{option: True})
+    router = Router(tiles=self.cacheDir, riskFile=self.riskFile)
+    self.assertRaises(ValueError, router.useHierarchy)
+    self.assertRaises(ValueError, router.useLandmarks)
+
+  def testPrefetch(self):
+    store = TileStore(self.cacheDir, 'foot')
+    corners = sorted(self.data.rnodes)
+    start = self.data.rnodes[corners[0]]
+    end = self.data.rnodes[corners[-1]]
+    store.prefetch(start[0], start[1], end[0], end[1])
+    # One prefetch thread, so once this has run the prefetches have too
+    store.prefetcher.submit(lambda: None).result()
+    along = tilenames.tilesAlongLine([tuple(start), tuple(end)], ZOOM)
+    self.assertGreater(len(along), 2)
+    for key in along:
+      self.assertIn(key, store.tiles)
+    self.assertEqual(store.loads, len(along))
+
+class TileDataTest(unittest.TestCase):
+  """Tiles fetched from a directory of fixture files through a file:// source"""
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.fixtures = os.path.join(self.directory, 'fixtures')
+    self.cacheDir = os.path.join(self.directory, 'cache')
+    self.data = graphs.gridData(12, oneWay=0)
+    tiles = writeTileTree(self.fixtures, self.data, name='%s/%d/%d/%d.osm')
+    self.key = tiles[0]
+    self.fixture = '%s/%d/%d/%d.osm' % ((self.fixtures, ZOOM) + self.key)
+    self.source = 'file://' + self.fixtures + '/{z}/{x}/{y}.osm'
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def store(self, maxAge):
+    return(TileStore(self.cacheDir, 'foot', download=True, prefetchTiles=0,
+                     maxAge=maxAge, source=self.source))
+
+  def fetch(self, maxAge=None, download=True):
+    with graphs.quiet():
+      return(tiledata.GetOsmTileData(ZOOM, self.key[0], self.key[1], self.cacheDir,
+                                     download, maxAge, self.source))
+
+  def emptyFixture(self):
+    with open(self.fixture, 'w') as f:
+      f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n</osm>\n')
+
+  def testDownload(self):
+    self.assertIsNone(self.fetch(download=False))
+    filename = self.fetch()
+    self.assertEqual(filename, '%s/%d/%d/%d/data.osm.pkl' % ((self.cacheDir, ZOOM) + self.key))
+    with open(filename) as f, open(self.fixture) as g:
+      self.assertEqual(f.read(), g.read())
+    self.assertEqual(self.fetch(download=False), filename)
+
+  def testExpiry(self):
+    filename = self.fetch()
+    self.emptyFixture()
+    # Fresh enough, or no maxAge: the cached copy is used
+    self.assertEqual(self.fetch(maxAge=3600), filename)
+    self.assertEqual(self.fetch(), filename)
+    self.assertGreater(os.path.getsize(filename), os.path.getsize(self.fixture))
+    # Expired: downloaded again, unless downloads are off
+    old = time.time() - 7200
+    os.utime(filename, (old, old))
+    self.assertEqual(self.fetch(maxAge=3600, download=False), filename)
+    self.assertGreater(os.path.getsize(filename), os.path.getsize(self.fixture))
+    self.assertEqual(self.fetch(maxAge=3600), filename)
+    self.assertEqual(os.path.getsize(filename), os.path.getsize(self.fixture))
+
+  def testFailedRefresh(self):
+    filename = self.fetch()
+    size = os.path.getsize(filename)
+    os.remove(self.fixture)
+    old = time.time() - 7200
+    os.utime(filename, (old, old))
+    # Stale data is kept when it can't be downloaded again
+    self.assertEqual(self.fetch(maxAge=3600), filename)
+    self.assertEqual(os.path.getsize(filename), size)
+    self.assertFalse(os.path.exists(filename + '.tmp'))
+    # With nothing cached, the failure is passed on
+    shutil.rmtree(self.cacheDir)
+    self.assertRaises((IOError, OSError), self.fetch)
+
+  def testBuildTile(self):
+    store = self.store(3600)
+    tile = store.load(self.key)
+    self.assertEqual(tile.links, store.parse(self.key, self.fixture).links)
+    self.assertTrue(tile.links)
+    self.assertTrue(os.path.exists(store.graphFile(self.key)))
+    # The OSM data is dropped once the graph file is built
+    self.assertFalse(os.path.exists('%s/%d/%d/%d/data.osm.pkl' % ((self.cacheDir, ZOOM) + self.key)))
+    self.assertEqual(store.load(self.key).links, tile.links)
+
+  def testRebuildExpired(self):
+    tile = self.store(3600).load(self.key)
+    self.emptyFixture()
+    # Make the graph file two hours old
+    filename = self.store(3600).graphFile(self.key)
+    old = Tile.read(filename, 'foot', ZOOM, self.key)
+    old.created = time.time() - 7200
+    old.save(filename, 'foot', ZOOM)
+    # Without a maxAge it is kept, and so is a tile that hasn't expired
+    self.assertEqual(self.store(None).load(self.key).links, tile.links)
+    self.assertEqual(self.store(3 * 3600).load(self.key).links, tile.links)
+    # Expired, it is built again from the new data
+    rebuilt = self.store(3600).load(self.key)
+    self.assertEqual(rebuilt.links, {})
+    self.assertGreater(rebuilt.created, old.created + 3600)
+    self.assertEqual(Tile.read(filename, 'foot', ZOOM, self.key).links, {})
+
+if __name__ == '__main__':
+  unittest.main()
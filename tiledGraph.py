@@ -0,0 +1,457 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Routing graph loaded a tile at a time, as searches reach it
+#
+# Map data is kept as zoom-15 tiles in a cache/z/x/y tree (see tiledata).
+# Each node belongs to the tile its position falls in, and that tile holds
+# all of the node's links, because OSM tile data includes every way that
+# touches the tile.  So a search only needs a node's own tile to expand it,
+# and tiles are loaded the first time the search frontier needs one.
+#
+# The raw OSM data of a tile is parsed once, and the tile's part of the
+# graph saved next to it as graph-<transport>.bin, which later loads read
+# instead.  The file holds a header (see TILE_HEADER) then flat arrays:
+#
+#   ids[i], lat[i], lon[i]      the tile's own nodes, then its boundary
+#                               nodes (the far ends of links leaving it)
+#   froms[e], tos[e]            node numbers of each link to or from an
+#                               own node
+#   weights[e]                  the link's transport weight
+#
+# With a maxAge, tiles older than that are built again from fresh data.
+#
+# Loaded tiles are kept in an LRU with a memory budget, and the least
+# recently used are dropped once it is full; they are loaded again if a
+# search comes back to them.  A Router can also prefetch the tiles along
+# the line from start to target in the background, ahead of the search.
+#
+# Edge costs come from the risk data (LoadOsm.readInRisk's dict) as for
+# the other graphs; links that aren't in it get DEFAULT_RISK.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import os
+import sys
+import math
+import time
+import zlib
+import struct
+import bisect
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import tiledata
+import tilenames
+import nodeGrid
+import lruCache
+
+# Risk of a link with no entry in the risk data
+DEFAULT_RISK = (0.0, 0.0)
+# Rough memory used by a loaded node and by a link, for the budget
+NODE_BYTES = 350
+LINK_BYTES = 150
+# Memory used by the id of a node in a dropped tile (see TileStore.dropped)
+DROPPED_BYTES = 8
+
+TILE_MAGIC = b'PYRTILE\0'
+TILE_VERSION = 1
+# magic, version, transport, zoom, x, y, time built, own node count, node
+# count, link count, payload crc32
+TILE_HEADER = struct.Struct('<8sI8sIIIdIIII')
+
+class Tile:
+  """The part of the graph whose nodes lie in one tile"""
+  def __init__(self, key, links=None, reverse=None, positions=None, created=None):
+    self.key = key
+    self.created = created or time.time()
+    # {node: {child: weight}} and {node: {parent: weight}}, for the
+    # tile's own nodes
+    self.links = links or {}
+    self.reverse = reverse or {}
+    # {node: (lat, lon)} of every node on the tile's ways, including
+    # the ends of links leading out of it
+    self.positions = positions or {}
+    # Spatial index of the tile's own nodes
+    self.grid = nodeGrid.NodeGrid()
+    for node in self.links:
+      pos = self.positions[node]
+      self.grid.add(node, pos[0], pos[1])
+
+  def size(self):
+    """Rough number of bytes the tile takes up"""
+    links = sum(len(l) for l in self.links.values()) + sum(len(l) for l in self.reverse.values())
+    return(NODE_BYTES * (len(self.positions) + len(self.links)) + LINK_BYTES * links)
+
+  def arrays(self):
+    """The tile as [ids, lat, lon, froms, tos, weights], and the number of
+    own nodes at the start of ids"""
+    own = set(self.links)
+    own.update(self.reverse)
+    nodes = sorted(own)
+    nodes.extend(sorted(set(self.positions) - own))
+    number = dict((node, i) for (i, node) in enumerate(nodes))
+    froms = array('i')
+    tos = array('i')
+    weights = array('d')
+    for fr, links in self.links.items():
+      for to, weight in links.items():
+        froms.append(number[fr])
+        tos.append(number[to])
+        weights.append(weight)
+    for to, links in self.reverse.items():
+      for fr, weight in links.items():
+        if not fr in own:
+          froms.append(number[fr])
+          tos.append(number[to])
+          weights.append(weight)
+    ids = array('q', nodes)
+    lat = array('d', [self.positions[node][0] for node in nodes])
+    lon = array('d', [self.positions[node][1] for node in nodes])
+    return([ids, lat, lon, froms, tos, weights], len(own))
+
+  def save(self, filename, transport, zoom):
+    """Write the tile to a graph file"""
+    arrays, own = self.arrays()
+    if sys.byteorder == 'big':
+      for a in arrays:
+        a.byteswap()
+    crc = 0
+    for a in arrays:
+      crc = zlib.crc32(memoryview(a).cast('B'), crc)
+    x, y = self.key
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+      f.write(TILE_HEADER.pack(TILE_MAGIC, TILE_VERSION, transport.encode('ascii'),
+        zoom, x, y, self.created, own, len(arrays[0]), len(arrays[3]), crc & 0xffffffff))
+      for a in arrays:
+        f.write(memoryview(a).cast('B'))
+    os.rename(tmpname, filename)
+
+  @classmethod
+  def read(cls, filename, transport, zoom, key):
+    """Load a tile from a graph file.
+
+    Returns None if the file is missing, damaged, or was written by another
+    version or for another transport or tile."""
+    try:
+      with open(filename, 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      return(None)
+    if len(data) < TILE_HEADER.size:
+      return(None)
+    magic, version, mode, z, x, y, created, own, n, e, crc = TILE_HEADER.unpack_from(data, 0)
+    if (magic != TILE_MAGIC or version != TILE_VERSION
+        or mode.rstrip(b'\0') != transport.encode('ascii') or (z, x, y) != (zoom,) + tuple(key)):
+      return(None)
+    offset = TILE_HEADER.size
+    layout = (('q', n), ('d', n), ('d', n), ('i', e), ('i', e), ('d', e))
+    if len(data) != offset + sum(array(code).itemsize * count for (code, count) in layout):
+      return(None)
+    if zlib.crc32(data[offset:]) & 0xffffffff != crc:
+      return(None)
+    arrays = []
+    for code, count in layout:
+      a = array(code)
+      a.frombytes(data[offset:offset + a.itemsize * count])
+      if sys.byteorder == 'big':
+        a.byteswap()
+      arrays.append(a)
+      offset = offset + a.itemsize * count
+    ids, lat, lon, froms, tos, weights = arrays
+    positions = dict(zip(ids, zip(lat, lon)))
+    links = {}
+    reverse = {}
+    for fr, to, weight in zip(froms, tos, weights):
+      if fr < own:
+        links.setdefault(ids[fr], {})[ids[to]] = weight
+      if to < own:
+        reverse.setdefault(ids[to], {})[ids[fr]] = weight
+    return(cls(tuple(key), links, reverse, positions, created))
+
+class TileStore:
+  """Tiles loaded from a tile cache directory, within a memory budget"""
+  def __init__(self, cacheDir='cache', transport='foot', maxBytes=256 << 20,
+               download=False, prefetchWorkers=1, prefetchTiles=16,
+               maxAge=None, source=tiledata.OSM_API):
+    self.cacheDir = cacheDir
+    self.transport = transport
+    self.download = download
+    self.maxAge = maxAge
+    self.source = source
+    self.zoom = tiledata.DownloadLevel()
+    self.maxBytes = maxBytes
+    self.tiles = lruCache.LRUCache(maxBytes, weigh=Tile.size, evicted=self.evicted)
+    # Tile of each node of the loaded tiles (counted in their size).  When
+    # a tile is dropped, its nodes' ids move to a sorted array per home
+    # tile in dropped, so that searches and cached routes can still find
+    # their way back to it.  Those ids come out of the budget too.
+    self.homes = {}
+    self.dropped = {}
+    self.droppedCount = 0
+    self.lock = threading.Lock()
+    # Events for the tiles being loaded right now
+    self.loading = {}
+    self.loads = 0
+    self.prefetchTiles = prefetchTiles
+    self.prefetcher = ThreadPoolExecutor(prefetchWorkers)
+
+  def tileKey(self, lat, lon):
+    return(tilenames.tileXY(lat, lon, self.zoom))
+
+  def tile(self, key):
+    """The tile with this (x, y), loading it if need be"""
+    tile = self.tiles.get(key)
+    if tile is not None:
+      return(tile)
+    with self.lock:
+      event = self.loading.get(key)
+      owner = event is None
+      if owner:
+        event = self.loading[key] = threading.Event()
+    if not owner:
+      # Somebody else is loading it
+      event.wait()
+      tile = self.tiles.get(key)
+      if tile is not None:
+        return(tile)
+      return(self.tile(key))
+    try:
+      tile = self.load(key)
+      with self.lock:
+        for node, pos in tile.positions.items():
+          self.homes.setdefault(node, self.tileKey(pos[0], pos[1]))
+        ids = self.dropped.pop(key, None)
+        if ids is not None:
+          kept = array('q', [node for node in ids if not node in tile.positions])
+          if kept:
+            self.dropped[key] = kept
+          self.droppedCount = self.droppedCount - len(ids) + len(kept)
+          self.fitBudget()
+        self.loads = self.loads + 1
+      self.tiles.put(key, tile)
+    finally:
+      with self.lock:
+        del self.loading[key]
+      event.set()
+    return(tile)
+
+  def evicted(self, key, tile):
+    """Move the homes of a dropped tile's nodes to dropped, but for those
+    whose own tile is still loaded"""
+    moved = {}
+    with self.lock:
+      for node in tile.positions:
+        home = self.homes.get(node)
+        if home is None or home in self.tiles or home in self.loading:
+          continue
+        del self.homes[node]
+        moved.setdefault(home, []).append(node)
+      for home, nodes in moved.items():
+        ids = self.dropped.get(home, ())
+        merged = array('q', sorted(set(ids).union(nodes)))
+        self.dropped[home] = merged
+        self.droppedCount = self.droppedCount - len(ids) + len(merged)
+      self.fitBudget()
+
+  def fitBudget(self):
+    """Leave the tiles what the dropped tiles' node ids don't use of the
+    budget"""
+    self.tiles.maxsize = max(0, self.maxBytes - DROPPED_BYTES * self.droppedCount)
+
+  def home(self, node):
+    """The (x, y) of the tile a node is in, loaded or not"""
+    key = self.homes.get(node)
+    if key is not None:
+      return(key)
+    with self.lock:
+      for key, ids in self.dropped.items():
+        i = bisect.bisect_left(ids, node)
+        if i < len(ids) and ids[i] == node:
+          return(key)
+    raise KeyError(node)
+
+  def nodeIds(self):
+    """Every node seen so far"""
+    with self.lock:
+      nodes = set(self.homes)
+      for ids in self.dropped.values():
+        nodes.update(ids)
+    return(list(nodes))
+
+  def graphFile(self, key):
+    x, y = key
+    return('%s/%d/%d/%d/graph-%s.bin' % (self.cacheDir, self.zoom, x, y, self.transport))
+
+  def load(self, key):
+    """Read a tile from its graph file, building that from the tile's OSM
+    data first if it is missing or out of date (empty if there is no data)"""
+    x, y = key
+    filename = self.graphFile(key)
+    cached = Tile.read(filename, self.transport, self.zoom, key)
+    if cached is not None and (self.maxAge is None or time.time() - cached.created <= self.maxAge):
+      return(cached)
+    try:
+      source = tiledata.GetOsmTileData(self.zoom, x, y, self.cacheDir,
+        self.download, self.maxAge, self.source)
+    except (IOError, OSError) as e:
+      print("Couldn't get tile %d,%d: %s" % (x, y, e))
+      source = None
+    if source is None:
+      return(cached or Tile(key))
+    if cached is not None and cached.created >= os.path.getmtime(source):
+      # Nothing newer to build it from
+      return(cached)
+    tile = self.parse(key, source)
+    try:
+      tile.save(filename, self.transport, self.zoom)
+    except (IOError, OSError) as e:
+      print("Couldn't save tile %d,%d: %s" % (x, y, e))
+      return(tile)
+    if self.download:
+      # It can be downloaded again when the tile expires
+      os.remove(source)
+    return(tile)
+
+  def parse(self, key, filename):
+    """The tile's part of the graph, from its OSM data"""
+    from loadOsm import LoadOsm
+    data = LoadOsm(self.transport)
+    data.loadOsm(filename)
+    positions = dict((node, tuple(pos)) for (node, pos) in data.rnodes.items())
+    nodes = list(positions)
+    xs, ys = tilenames.tileXYArray([positions[node][0] for node in nodes],
+                                   [positions[node][1] for node in nodes], self.zoom)
+    own = set(node for (node, x, y) in zip(nodes, xs, ys) if (x, y) == key)
+    links = {}
+    reverse = {}
+    used = {}
+    for fr, children in data.routing.items():
+      if not fr in positions:
+        continue
+      for to, weight in children.items():
+        if weight == 0 or not to in positions:
+          continue
+        if fr in own:
+          links.setdefault(fr, {})[to] = weight
+        if to in own:
+          reverse.setdefault(to, {})[fr] = weight
+        if fr in own or to in own:
+          used[fr] = positions[fr]
+          used[to] = positions[to]
+    return(Tile(key, links, reverse, used))
+
+  def loadedTiles(self):
+    with self.tiles.lock:
+      return([value for (value, expires, weight) in self.tiles.entries.values()])
+
+  def prefetch(self, lat1, lon1, lat2, lon2):
+    """Load the tiles along the line from one position to another in the
+    background, nearest the first one first"""
+    keys = tilenames.tilesAlongLine([(lat1, lon1), (lat2, lon2)], self.zoom)
+    for key in keys[:self.prefetchTiles]:
+      if not key in self.tiles:
+        self.prefetcher.submit(self.tile, key)
+
+class TiledGraph:
+  """Search interface (as LoadOsm's) over the tiles of a TileStore.
+
+  Nodes are addressed by their OSM ids."""
+  def __init__(self, store, risk=None):
+    self.store = store
+    self.risk = risk or {}
+
+  def withRisk(self, routing):
+    """The same tiles, with other risk data"""
+    return(TiledGraph(self.store, routing))
+
+  def routing(self):
+    return(self.risk)
+
+  def nodeTile(self, node_id):
+    return(self.store.tile(self.store.home(node_id)))
+
+  def nodeIndex(self, node_id):
+    self.store.home(node_id)
+    return(node_id)
+
+  def nodeId(self, node_id):
+    return(node_id)
+
+  def position(self, node_id):
+    pos = self.nodeTile(node_id).positions.get(node_id)
+    if pos is None:
+      # Its own tile isn't in the cache, but a neighbour knows where it is
+      for tile in self.store.loadedTiles():
+        pos = tile.positions.get(node_id)
+        if pos is not None:
+          break
+      else:
+        raise KeyError(node_id)
+    return(pos)
+
+  def nodeIds(self):
+    return(self.store.nodeIds())
+
+  def __len__(self):
+    """Number of nodes in the loaded tiles"""
+    return(sum(len(tile.links) for tile in self.store.loadedTiles()))
+
+  def weighting(self, alpha, beta):
+    return((alpha, beta))
+
+  def neighbours(self, node_id, weighting):
+    """Yield (node, cost) for each link leaving a node"""
+    alpha, beta = weighting
+    risks = self.risk.get(node_id, {})
+    for i in self.nodeTile(node_id).links.get(node_id, {}):
+      risk = risks.get(i, DEFAULT_RISK)
+      yield i, alpha*math.exp(risk[0])+beta*math.exp(risk[1])
+
+  def reverseNeighbours(self, node_id, weighting):
+    """Yield (node, cost) for each link leading into a node"""
+    alpha, beta = weighting
+    for i in self.nodeTile(node_id).reverse.get(node_id, {}):
+      risk = self.risk.get(i, {}).get(node_id, DEFAULT_RISK)
+      yield i, alpha*math.exp(risk[0])+beta*math.exp(risk[1])
+
+  def findNode(self, lat, lon):
+    """Find the nearest node, loading the tiles around lat/lon as needed"""
+    store = self.store
+    x, y = store.tileKey(lat, lon)
+    found = store.tile((x, y)).grid.nearestEntries(lat, lon, 1)
+    if found:
+      # A node in a neighbouring tile can only be nearer if the tile's
+      # edge is nearer than the node we found
+      pos = found[0][1]
+      s, w, n, e = tilenames.tileEdges(x, y, store.zoom)
+      reach = math.sqrt((pos[0] - lat) ** 2 + (pos[1] - lon) ** 2)
+      if min(lat - s, n - lat, lon - w, e - lon) >= reach:
+        return(found[0][0])
+    best = None
+    bestDist = None
+    for dx in (-1, 0, 1):
+      for dy in (-1, 0, 1):
+        for node, pos in store.tile((x + dx, y + dy)).grid.nearestEntries(lat, lon, 1):
+          dist = (pos[0] - lat) ** 2 + (pos[1] - lon) ** 2
+          if bestDist is None or dist < bestDist:
+            best = node
+            bestDist = dist
+    return(best)
+
+  def findNodes(self, points):
+    return([self.findNode(lat, lon) for (lat, lon) in points])
+
+  def prefetch(self, lat1, lon1, lat2, lon2):
+    self.store.prefetch(lat1, lon1, lat2, lon2)
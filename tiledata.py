@@ -3,7 +3,11 @@
 # Download OSM data covering the area of a slippy-map tile 
 #
 # Features:
-#  * Cached (all downloads stored in cache/z/x/y/data.osm)
+#  * Cached (all downloads stored in cache/z/x/y/data.osm.pkl)
+#  * Optional expiry: cached data older than maxAge seconds is downloaded
+#    again, and kept if the download fails
+#  * The source is a URL template, so a local server or a directory of
+#    fixture files (file:// URLs) can stand in for the OSM API
 #----------------------------------------------------------------------------
 # Copyright 2008, Oliver White
 #
@@ -21,6 +25,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #---------------------------------------------------------------------------
 import os
+import time
 import pickle
 try:  # Python 3.x
   from urllib.request import urlretrieve
@@ -33,26 +38,49 @@ def DownloadLevel():
   """All primary downloads are done at a particular zoom level"""
   return(15)
 
-def GetOsmTileData(z,x,y):
-  """Download OSM data for the region covering a slippy-map tile"""
+# Where tiles are downloaded from; filled in with the tile's z, x, y and its
+# edges s, w, n, e
+OSM_API = 'http://api.openstreetmap.org/api/0.6/map?bbox={w},{s},{e},{n}'
+
+def GetOsmTileData(z,x,y,cacheDir='cache',download=True,maxAge=None,source=OSM_API):
+  """Download OSM data for the region covering a slippy-map tile.
+
+  With download unset, only what is already in cacheDir is used, and None
+  is returned for tiles that aren't there.  Cached data older than maxAge
+  seconds is downloaded again."""
   if(x < 0 or y < 0 or z < 0 or z > 25):
     print("Disallowed (%d,%d) at zoom level %d" % (x, y, z))
     return
   
-  directory = 'cache/%d/%d/%d' % (z,x,y)
+  directory = '%s/%d/%d/%d' % (cacheDir,z,x,y)
   filename = '%s/data.osm.pkl' % (directory)
-  if(not os.path.exists(directory)):
-    os.makedirs(directory)
 
   if(z == DownloadLevel()):
+    cached = os.path.exists(filename)
+    if(cached and (maxAge is None or Age(filename) <= maxAge)):
+      return(filename)
+    if(not download):
+      return(cached and filename or None)
+    if(not os.path.exists(directory)):
+      os.makedirs(directory)
+
     # Download the data
     s,w,n,e = tileEdges(x,y,z)
     # /api/0.6/map?bbox=left,bottom,right,top
-    URL = 'http://api.openstreetmap.org/api/0.6/map?bbox={},{},{},{}'.format(w,s,e,n)
+    URL = source.format(z=z,x=x,y=y,s=s,w=w,n=n,e=e)
 
-     
-    if(not os.path.exists(filename)): # TODO: allow expiry of old data
-      urlretrieve(URL, filename)
+    tmpname = filename + '.tmp'
+    try:
+      urlretrieve(URL, tmpname)
+    except (IOError, OSError):
+      if(os.path.exists(tmpname)):
+        os.remove(tmpname)
+      if(not cached):
+        raise
+      # Stale data is better than none
+      print("Couldn't refresh %s, using cached copy" % filename)
+      return(filename)
+    os.rename(tmpname, filename)
     return(filename)
     
   elif(z > DownloadLevel()):
@@ -61,9 +89,13 @@ def GetOsmTileData(z,x,y):
       z = z - 1
       x = int(x / 2)
       y = int(y / 2)
-    return(GetOsmTileData(z,x,y))
+    return(GetOsmTileData(z,x,y,cacheDir,download,maxAge,source))
   return(None)
 
+def Age(filename):
+  """Seconds since a file was last written"""
+  return(time.time() - os.path.getmtime(filename))
+
 if(__name__ == "__main__"):
   """test mode"""
   print(GetOsmTileData(15, 7700, 13546))
@@ -5,10 +5,18 @@
 # 
 # http://wiki.openstreetmap.org/index.php/Slippy_map_tilenames
 # 
+# The ...Array functions do the same for many points at once, with numpy
+# arrays if numpy is available (lists otherwise), and tilesInBox and
+# tilesAlongLine list the tiles that cover an area or a route
+#
 # Written by Oliver White, 2007
 # This file is public-domain
 #-------------------------------------------------------
 from math import *
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 def numTiles(z):
   return(pow(2,z))
@@ -61,6 +69,105 @@ def tileEdges(x,y,z):
 def mercatorToLat(mercatorY):
   return(degrees(atan(sinh(mercatorY))))
 
+def latlon2relativeXYArray(lats,lons):
+  if(numpy is None):
+    return(unzip([latlon2relativeXY(lat,lon) for (lat,lon) in zip(lats,lons)]))
+  lats = numpy.radians(numpy.asarray(lats, dtype=float))
+  x = (numpy.asarray(lons, dtype=float) + 180) / 360
+  y = (1 - numpy.log(numpy.tan(lats) + 1 / numpy.cos(lats)) / pi) / 2
+  return(x,y)
+
+def latlon2xyArray(lats,lons,z):
+  n = numTiles(z)
+  x,y = latlon2relativeXYArray(lats,lons)
+  if(numpy is None):
+    return([n*i for i in x], [n*i for i in y])
+  return(n*x, n*y)
+
+def tileXYArray(lats,lons,z):
+  x,y = latlon2xyArray(lats,lons,z)
+  if(numpy is None):
+    return([int(i) for i in x], [int(i) for i in y])
+  # astype truncates towards zero, as int() does
+  return(x.astype(numpy.int64), y.astype(numpy.int64))
+
+def xy2latlonArray(x,y,z):
+  if(numpy is None):
+    return(unzip([xy2latlon(i,j,z) for (i,j) in zip(x,y)]))
+  n = numTiles(z)
+  relY = numpy.asarray(y, dtype=float) / n
+  lat = numpy.degrees(numpy.arctan(numpy.sinh(pi * (1 - 2 * relY))))
+  lon = -180.0 + 360.0 * numpy.asarray(x, dtype=float) / n
+  return(lat,lon)
+
+def tileEdgesArray(x,y,z):
+  if(numpy is None):
+    return(unzip([tileEdges(i,j,z) for (i,j) in zip(x,y)], 4))
+  x = numpy.asarray(x)
+  y = numpy.asarray(y)
+  n,w = xy2latlonArray(x,y,z)
+  s,e = xy2latlonArray(x+1,y+1,z)
+  return(s,w,n,e)
+
+def unzip(rows, width=2):
+  """Columns of a list of tuples"""
+  if(not rows):
+    return(tuple([] for i in range(width)))
+  return(tuple(list(column) for column in zip(*rows)))
+
+def tilesInBox(s,w,n,e,z):
+  """Every tile covering a bounding box, row by row from the north-west"""
+  x1,y1 = tileXY(n,w,z)
+  x2,y2 = tileXY(s,e,z)
+  return([(x,y) for y in range(y1,y2+1) for x in range(x1,x2+1)])
+
+def tilesAlongLine(points,z):
+  """The distinct tiles a line through a list of (lat,lon) points passes
+  through, in the order it reaches them.  Each leg is straight on the
+  map (in mercator coordinates)."""
+  if(not points):
+    return([])
+  lats,lons = unzip(points)
+  xs,ys = latlon2xyArray(lats,lons,z)
+  xs = [float(i) for i in xs]
+  ys = [float(i) for i in ys]
+  tiles = [(int(xs[0]),int(ys[0]))]
+  seen = set(tiles)
+  for i in range(1, len(xs)):
+    for tile in lineTiles(xs[i-1],ys[i-1],xs[i],ys[i]):
+      if(not tile in seen):
+        seen.add(tile)
+        tiles.append(tile)
+  return(tiles)
+
+def lineTiles(x1,y1,x2,y2):
+  """Tiles crossed by a straight line between two tile-space points,
+  stepping from one tile to the next across whichever edge comes first"""
+  x,y = int(x1),int(y1)
+  endX,endY = int(x2),int(y2)
+  dx = x2 - x1
+  dy = y2 - y1
+  stepX,nextX,deltaX = lineSteps(x1,x,dx)
+  stepY,nextY,deltaY = lineSteps(y1,y,dy)
+  yield((x,y))
+  for i in range(abs(endX - x) + abs(endY - y)):
+    if(y == endY or (x != endX and nextX < nextY)):
+      x = x + stepX
+      nextX = nextX + deltaX
+    else:
+      y = y + stepY
+      nextY = nextY + deltaY
+    yield((x,y))
+
+def lineSteps(start,tile,d):
+  """Direction along one axis, how far along the line (0..1) the first tile
+  edge is, and how far apart the edges are"""
+  if(d > 0):
+    return(1, (tile + 1 - start) / d, 1 / d)
+  if(d < 0):
+    return(-1, (start - tile) / -d, 1 / -d)
+  return(1, inf, inf)
+
 def tileSizePixels():
   return(256)
 